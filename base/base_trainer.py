@@ -1,6 +1,7 @@
 import torch
 from abc import abstractmethod
 from numpy import inf
+from utils import get_world_size, is_main_process, synchronize
 
 
 class BaseTrainer:
@@ -12,10 +13,20 @@ class BaseTrainer:
         self.logger = config.get_logger('trainer', config['trainer']['verbosity'])
 
         # setup GPU device if available, move models into configured device
-        self.device, device_ids = self._prepare_device(config['n_gpu'])
-        self.model = model.to(self.device)
-        if len(device_ids) > 1:
-            self.model = torch.nn.DataParallel(model, device_ids=device_ids)
+        self.distributed = get_world_size() > 1
+        if self.distributed:
+            # one process per GPU (or CPU process with gloo), launched by torchrun
+            self.device = torch.device('cuda', torch.cuda.current_device()) if torch.cuda.is_available() \
+                else torch.device('cpu')
+            self.model = model.to(self.device)
+            self.model = torch.nn.parallel.DistributedDataParallel(
+                self.model, device_ids=[self.device.index] if self.device.type == 'cuda' else None,
+                find_unused_parameters=config['trainer'].get('find_unused_parameters', True))
+        else:
+            self.device, device_ids = self._prepare_device(config['n_gpu'])
+            self.model = model.to(self.device)
+            if len(device_ids) > 1:
+                self.model = torch.nn.DataParallel(model, device_ids=device_ids)
 
         self.criterion = criterion
         self.optimizer = optimizer
@@ -67,8 +78,9 @@ class BaseTrainer:
             log.update(result)
 
             # print logged informations to the screen
-            for key, value in log.items():
-                self.logger.info('    {:15s}: {}'.format(str(key), value))
+            if is_main_process():
+                for key, value in log.items():
+                    self.logger.info('    {:15s}: {}'.format(str(key), value))
 
             # evaluate models performance according to configured metric, save best checkpoint as model_best
             best = False
@@ -95,8 +107,9 @@ class BaseTrainer:
                                      "Training stops.".format(self.early_stop))
                     break
 
-            if epoch % self.save_period == 0:
+            if epoch % self.save_period == 0 and is_main_process():
                 self._save_checkpoint(epoch, save_best=best)
+            synchronize()
 
     def _prepare_device(self, n_gpu_use):
         """
@@ -146,7 +159,7 @@ class BaseTrainer:
         """
         resume_path = str(resume_path)
         self.logger.info("Loading checkpoint: {} ...".format(resume_path))
-        checkpoint = torch.load(resume_path)
+        checkpoint = torch.load(resume_path, map_location=self.device)
         self.start_epoch = checkpoint['epoch'] + 1
         self.mnt_best = checkpoint['monitor_best']
 
@@ -157,7 +170,8 @@ class BaseTrainer:
         state_dict = {}
         for k, v in checkpoint['state_dict'].items():
             state_dict[k.replace('module.', '')] = v
-        self.model.load_state_dict(state_dict)
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+        model.load_state_dict(state_dict)
 
         # load optimizer state from checkpoint only when optimizer type is not changed.
         #if checkpoint['config']['optimizer']['type'] != self.config['optimizer']['type']:
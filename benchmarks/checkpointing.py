@@ -0,0 +1,151 @@
+"""
+Peak memory and step time of one training forward/backward pass through FeatureNet and the
+CostRegNet of every stage, with activation checkpointing off and on.
+
+    python benchmarks/checkpointing.py --device cuda --batch_size 2 --ndepths 128 32 8
+
+"saved" is the size of the activations autograd keeps between forward and backward, counted
+through saved tensor hooks, so it is meaningful on CPU as well. "peak" is the peak of the CUDA
+caching allocator over one step and is only reported on GPU. Every case runs in a fresh process.
+Before the cases, one step with and without checkpointing checks that the BatchNorm buffers (updated
+once per step) and the gradients match.
+"""
+import argparse
+import copy
+import multiprocessing as mp
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.module import FeatureNet, CostRegNet
+
+# down-sampling of the network input for stage1..3 and the channels of FeatureNet(base_channels=8)
+STAGE_SCALES = [4, 2, 1]
+STAGE_CHANNELS = [32, 16, 8]
+
+
+def saved_bytes(function):
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage() if hasattr(t, 'untyped_storage') else t.storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = function()
+    return out, sum(storages.values())
+
+
+def build_case(args, name, stage):
+    b, h, w = args.batch_size, args.height, args.width
+    if name == 'feature':
+        module = FeatureNet(base_channels=8)
+        inputs = (torch.rand(b, 3, h, w), torch.rand(b, 2) * torch.tensor([w, h]))
+        kwargs = {'temperature': 0.01}
+    else:
+        scale = STAGE_SCALES[stage]
+        module = CostRegNet(STAGE_CHANNELS[stage], args.cr_base_chs[stage])
+        inputs = (torch.rand(b, STAGE_CHANNELS[stage], args.ndepths[stage], h // scale, w // scale, requires_grad=True),)
+        kwargs = {}
+    return module, inputs, kwargs
+
+
+def loss_of(out):
+    if isinstance(out, dict):
+        return sum(o[0].mean() + o[1].mean() for o in out.values())
+    return out.mean()
+
+
+def check_buffers(args):
+    """one training step with and without checkpointing from the same weights, the BatchNorm buffers and the
+    gradients must match"""
+    passed = True
+    for name, stage in [('feature', None), ('cost_reg', 0)]:
+        torch.manual_seed(0)
+        module, inputs, kwargs = build_case(args, name, stage)
+        reference = copy.deepcopy(module)
+        results = []
+        for m, use_checkpoint in [(reference, False), (module, True)]:
+            m.train()
+            m.checkpoint = use_checkpoint
+            loss_of(m(*inputs, **kwargs)).backward()
+            results.append((dict(m.named_buffers()), {k: p.grad for k, p in m.named_parameters() if p.grad is not None}))
+        (buffers, grads), (ckpt_buffers, ckpt_grads) = results
+        ok = all(torch.allclose(buffers[k].double(), ckpt_buffers[k].double()) for k in buffers) and \
+            grads.keys() == ckpt_grads.keys() and \
+            all(torch.allclose(grads[k], ckpt_grads[k], rtol=1e-4, atol=1e-6) for k in grads)
+        passed = passed and ok
+        print('{}: buffers and gradients with checkpointing {}'.format(
+            name if stage is None else '{} stage{}'.format(name, stage + 1), 'ok' if ok else 'MISMATCH'))
+    return passed
+
+
+def run_case(task):
+    args, name, stage, use_checkpoint = task
+    device = torch.device(args.device)
+    module, inputs, kwargs = build_case(args, name, stage)
+    module = module.to(device).train()
+    module.checkpoint = use_checkpoint
+    inputs = tuple(x.to(device).detach().requires_grad_(x.requires_grad) for x in inputs)
+
+    def step():
+        loss_of(module(*inputs, **kwargs)).backward()
+        module.zero_grad(set_to_none=True)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    out, saved = saved_bytes(lambda: module(*inputs, **kwargs))
+    del out
+
+    peak = None
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        step()
+        peak = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+
+    times = []
+    for _ in range(args.repeat):
+        start = time.time()
+        step()
+        times.append(time.time() - start)
+    times.sort()
+    shape = 'x'.join(str(d) for d in inputs[0].shape)
+    return name if stage is None else '{} stage{}'.format(name, stage + 1), shape, use_checkpoint, \
+        saved / 2 ** 20, peak, times[len(times) // 2] * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Activation checkpointing benchmark')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--height', type=int, default=256, help='network input height (image height / 2 with refine)')
+    parser.add_argument('--width', type=int, default=320, help='network input width (image width / 2 with refine)')
+    parser.add_argument('--ndepths', type=int, nargs=3, default=[128, 32, 8])
+    parser.add_argument('--cr_base_chs', type=int, nargs=3, default=[8, 8, 8])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    if not check_buffers(args):
+        sys.exit(1)
+
+    tasks = []
+    for name, stage in [('feature', None), ('cost_reg', 0), ('cost_reg', 1), ('cost_reg', 2)]:
+        for use_checkpoint in [False, True]:
+            tasks.append((args, name, stage, use_checkpoint))
+
+    # a fresh process per case keeps the peak memory of one case out of the next
+    ctx = mp.get_context('spawn')
+    results = []
+    for task in tasks:
+        with ctx.Pool(1) as pool:
+            results.append(pool.apply(run_case, (task,)))
+
+    print('| module | input | checkpoint | saved (MB) | peak (MB) | step time (ms) |')
+    print('|---|---|---|---|---|---|')
+    for name, shape, use_checkpoint, saved, peak, step_time in results:
+        print('| {} | {} | {} | {:.1f} | {} | {:.1f} |'.format(
+            name, shape, 'on' if use_checkpoint else 'off', saved, '-' if peak is None else '{:.1f}'.format(peak), step_time))
@@ -0,0 +1,73 @@
+"""
+Inference latency of CDSMVSNet in eager mode and compiled with torch.compile, through the
+static-shape entry CDSMVSNetInference.
+
+    python benchmarks/compile.py --config configs/config_dtu.json --sizes 512x640 1152x1536
+
+The inputs are a synthetic scene of --num_view views with fixed shapes, the weights are random.
+Latency is the median over --repeat runs after warm-up; the first compiled call is reported
+separately as compile time.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.model import CDSMVSNet, CDSMVSNetInference
+from utils import synthetic_scene
+
+
+def measure(function, inputs, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function(*inputs)
+        if inputs[0].is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Eager vs torch.compile inference latency')
+    parser.add_argument('-c', '--config', default=None, help='take the arch args from a training config')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--sizes', nargs='+', default=['512x640', '1152x1536'], help='image sizes HxW')
+    parser.add_argument('--num_view', type=int, default=5)
+    parser.add_argument('--num_depth', type=int, default=192)
+    parser.add_argument('--temperature', type=float, default=0.01)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--mode', default='default', help='torch.compile mode')
+    args = parser.parse_args()
+
+    arch_args = {"refine": True}
+    if args.config is not None:
+        with open(args.config) as f:
+            arch_args = json.load(f)["arch"]["args"]
+    device = torch.device(args.device)
+    model = CDSMVSNet(**arch_args).to(device).eval()
+    eager = CDSMVSNetInference(model, temperature=args.temperature)
+    compiled = torch.compile(eager, mode=args.mode, dynamic=False)
+
+    results = []
+    with torch.no_grad():
+        for size in args.sizes:
+            height, width = [int(x) for x in size.split('x')]
+            inputs = synthetic_scene(height, width, args.num_view, args.num_depth, device=device)
+            eager(*inputs)
+            eager_time = measure(eager, inputs, args.repeat)
+            compile_time = measure(compiled, inputs, 1)
+            compiled_time = measure(compiled, inputs, args.repeat)
+            results.append((size, eager_time, compile_time, compiled_time))
+            print(size, 'done')
+
+    print('| size | eager (s) | compiled (s) | speedup | compile (s) |')
+    print('|---|---|---|---|---|')
+    for size, eager_time, compile_time, compiled_time in results:
+        print('| {} | {:.3f} | {:.3f} | {:.2f}x | {:.1f} |'.format(size, eager_time, compiled_time,
+                                                                  eager_time / compiled_time, compile_time))
@@ -0,0 +1,123 @@
+"""
+Per-layer inference time of the CostRegNet of every stage and of the 2D BatchNorm blocks (vis, Refinement),
+as built, with the BatchNorms folded into the convolutions and folded plus the channels_last_3d layout.
+
+    python benchmarks/layout.py --device cuda --height 576 --width 768 --ndepths 128 32 8
+
+The times of the direct submodules are taken with forward hooks and synchronized on GPU, the skip additions
+of CostRegNet are only in the total. The weights are random, the max abs difference to the unchanged module
+checks that folding keeps the output. Times are medians over --repeat runs after a warm-up.
+"""
+import argparse
+import copy
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models.module import CostRegNet, ConvBnReLU, Refinement, fuse_bn, channels_last_3d
+
+# down-sampling of the network input for stage1..3 and the channels of FeatureNet(base_channels=8)
+STAGE_SCALES = [4, 2, 1]
+STAGE_CHANNELS = [32, 16, 8]
+VARIANTS = ['eager', 'fold_bn', 'fold_bn+channels_last']
+
+
+def build_cases(args):
+    b, h, w = args.batch_size, args.height, args.width
+    cases = []
+    for stage in range(3):
+        scale = STAGE_SCALES[stage]
+        cases.append(('cost_reg stage{}'.format(stage + 1), CostRegNet(STAGE_CHANNELS[stage], args.cr_base_chs[stage]),
+                      (torch.rand(b, STAGE_CHANNELS[stage], args.ndepths[stage], h // scale, w // scale),)))
+    vis = nn.Sequential(ConvBnReLU(2, 16), ConvBnReLU(16, 16), ConvBnReLU(16, 16), nn.Conv2d(16, 1, 1), nn.Sigmoid())
+    cases.append(('vis stage3', vis, (torch.rand(b, 2, h, w),)))
+    cases.append(('refinement', Refinement(), (torch.rand(b, 3, 2 * h, 2 * w), torch.rand(b, 1, h, w) * 500 + 425,
+                                               torch.full((b,), 425.0), torch.full((b,), 935.0))))
+    for _, module, _ in cases:
+        # running statistics away from the identity, so that folding changes the weights
+        for bn in module.modules():
+            if isinstance(bn, nn.modules.batchnorm._BatchNorm):
+                bn.running_mean.uniform_(-0.1, 0.1)
+                bn.running_var.uniform_(0.5, 2.0)
+    return cases
+
+
+def make_variant(module, variant):
+    module = copy.deepcopy(module).eval()
+    if variant != 'eager':
+        fuse_bn(module)
+    if variant.endswith('channels_last'):
+        channels_last_3d(module)
+    return module
+
+
+def time_layers(module, inputs, repeat, device):
+    sync = torch.cuda.synchronize if device.type == 'cuda' else (lambda: None)
+    layer_times, starts = {}, {}
+
+    def pre_hook(name):
+        def hook(*_):
+            sync()
+            starts[name] = time.time()
+        return hook
+
+    def post_hook(name):
+        def hook(*_):
+            sync()
+            layer_times.setdefault(name, []).append(time.time() - starts[name])
+        return hook
+
+    handles = []
+    for name, child in module.named_children():
+        handles.append(child.register_forward_pre_hook(pre_hook(name)))
+        handles.append(child.register_forward_hook(post_hook(name)))
+    totals = []
+    with torch.no_grad():
+        out = module(*inputs)
+        layer_times.clear()
+        for _ in range(repeat):
+            sync()
+            start = time.time()
+            module(*inputs)
+            sync()
+            totals.append(time.time() - start)
+    for handle in handles:
+        handle.remove()
+    median = lambda times: sorted(times)[len(times) // 2] * 1000
+    return out, {name: median(times) for name, times in layer_times.items()}, median(totals)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-layer time with folded BatchNorm and channels_last_3d')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--height', type=int, default=256, help='network input height (image height / 2 with refine)')
+    parser.add_argument('--width', type=int, default=320, help='network input width (image width / 2 with refine)')
+    parser.add_argument('--ndepths', type=int, nargs=3, default=[128, 32, 8])
+    parser.add_argument('--cr_base_chs', type=int, nargs=3, default=[8, 8, 8])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    for name, module, inputs in build_cases(args):
+        inputs = tuple(x.to(device) for x in inputs)
+        results = {}
+        for variant in VARIANTS:
+            results[variant] = time_layers(make_variant(module, variant).to(device), inputs, args.repeat, device)
+        expected = results['eager'][0]
+        print('{} {}'.format(name, 'x'.join(str(d) for d in inputs[0].shape)))
+        print('| layer | ' + ' | '.join('{} (ms)'.format(v) for v in VARIANTS) + ' |')
+        print('|---|' + '---|' * len(VARIANTS))
+        for layer in results['eager'][1]:
+            # a folded BatchNorm is gone from the other variants
+            print('| {} | '.format(layer) + ' | '.join('{:.2f}'.format(results[v][1][layer]) if layer in results[v][1]
+                                                       else '-' for v in VARIANTS) + ' |')
+        print('| total | ' + ' | '.join('{:.2f}'.format(results[v][2]) for v in VARIANTS) + ' |')
+        print('| max abs diff | ' + ' | '.join('{:.2e}'.format((results[v][0] - expected).abs().max().item())
+                                               for v in VARIANTS) + ' |')
+        print()
@@ -0,0 +1,121 @@
+"""
+Count the host-device synchronisations of a training step.
+
+    python benchmarks/sync_check.py --config configs/config_dtu.json --steps 3
+
+Every op that needs the value of a tensor on the host (item(), float(), bool(), nonzero, boolean
+indexing, copies from the GPU) is counted while the steps run, together with the line of the repo
+that issued it. The ops are caught at the dispatcher, so the check works on CPU too (torch >= 1.13).
+"""
+import argparse
+import collections
+import json
+import os
+import sys
+import traceback
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+import datasets.data_loaders as module_data
+import models.model as module_arch
+import models.losses as module_loss
+from utils import todevice
+
+aten = torch.ops.aten
+SYNC_OPS = {aten._local_scalar_dense.default, aten.is_nonzero.default, aten.equal.default,
+            aten.nonzero.default, aten.masked_select.default, aten.unique_dim.default,
+            aten._unique2.default, aten.repeat_interleave.Tensor}
+INDEX_OPS = {aten.index.Tensor, aten.index_put.default, aten.index_put_.default}
+COPY_OPS = {aten._to_copy.default, aten.copy_.default}
+
+
+def is_bool_index(indices):
+    return any(i is not None and i.dtype in (torch.bool, torch.uint8) for i in indices)
+
+
+def is_device_to_host(func, args, kwargs):
+    if func is aten.copy_.default:
+        dst, src = args[0], args[1]
+        return src.is_cuda and not dst.is_cuda
+    device = kwargs.get('device')
+    return args[0].is_cuda and device is not None and torch.device(device).type == 'cpu'
+
+
+class SyncCounter(TorchDispatchMode):
+    """counts the ops that wait for the device, keyed by op name and the repo line issuing them"""
+
+    def __init__(self):
+        super().__init__()
+        self.counts = collections.Counter()
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func in SYNC_OPS or (func in INDEX_OPS and is_bool_index(args[1])) or \
+                (func in COPY_OPS and is_device_to_host(func, args, kwargs)):
+            self.counts[(str(func.overloadpacket.__name__), self.caller())] += 1
+        return func(*args, **kwargs)
+
+    @staticmethod
+    def caller():
+        for frame in reversed(traceback.extract_stack()[:-2]):
+            if frame.filename.startswith(ROOT) and not frame.filename.endswith('sync_check.py'):
+                return '{}:{}'.format(os.path.relpath(frame.filename, ROOT), frame.lineno)
+        return '<torch>'
+
+
+def build(config):
+    dl_args = dict(config['data_loader'][0]['args'])
+    dl_args['data_list'] = dl_args.pop('train_data_list')
+    del dl_args['val_data_list']
+    data_loader = getattr(module_data, config['data_loader'][0]['type'])(**dl_args)
+    model = getattr(module_arch, config['arch']['type'])(**config['arch']['args'])
+    criterion = getattr(module_loss, config['loss'])
+    optimizer = getattr(torch.optim, config['optimizer']['type'])(model.parameters(), **config['optimizer']['args'])
+    return data_loader, model, criterion, optimizer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count host-device syncs per training step')
+    parser.add_argument('-c', '--config', default='configs/config_dtu.json')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--temperature', type=float, default=0.01)
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    device = torch.device(args.device)
+    data_loader, model, criterion, optimizer = build(config)
+    model = model.to(device).train()
+    dlossw = config['trainer']['dlossw']
+
+    # the same work as Trainer._train_epoch does for one batch, metrics kept on the device
+    sums, num_steps = {}, 0
+    for step, sample in zip(range(args.steps), data_loader):
+        counter = SyncCounter()
+        with counter:
+            sample_cuda = todevice(sample, device)
+            depth_values = sample_cuda["depth_values"]
+            depth_interval = depth_values[:, 1] - depth_values[:, 0]
+            optimizer.zero_grad()
+            outputs, refine_depth_map = model(sample_cuda["imgs"], sample_cuda["proj_matrices"], depth_values,
+                                              gt_depths=sample_cuda["depth"], temperature=args.temperature)
+            loss, depth_loss = criterion(outputs, refine_depth_map, sample_cuda["depth"], sample_cuda["mask"],
+                                         dlossw=dlossw, depth_interval=depth_interval)
+            loss.backward()
+            optimizer.step()
+            for k, v in {"loss": loss, "depth_loss": depth_loss}.items():
+                sums[k] = sums.get(k, 0) + v.detach()
+        num_steps += 1
+
+        print('step {}: {} syncs'.format(step, sum(counter.counts.values())))
+        for (op, line), n in sorted(counter.counts.items(), key=lambda x: x[0][1]):
+            print('    {:4d}  {:24s} {}'.format(n, op, line))
+
+    # read once after the steps, outside the counter, as the trainer does at the end of an epoch
+    if num_steps:
+        print('mean over {} steps: {}'.format(num_steps, ', '.join(
+            '{} = {:.3f}'.format(k, v.item() / num_steps) for k, v in sums.items())))
@@ -7,9 +7,13 @@ Preprocess script.
 from __future__ import print_function
 import collections
 import struct
+import mmap
 import numpy as np
+import scipy.sparse as sp
 import multiprocessing as mp
-from functools import partial
+from multiprocessing.pool import ThreadPool
+import json
+import hashlib
 import os
 import argparse
 import shutil
@@ -24,6 +28,12 @@ BaseImage = collections.namedtuple(
     "Image", ["id", "qvec", "tvec", "camera_id", "name", "xys", "point3D_ids"])
 Point3D = collections.namedtuple(
     "Point3D", ["id", "xyz", "rgb", "error", "image_ids", "point2D_idxs"])
+# all points of a model as arrays, track i is track_*[track_offsets[i]:track_offsets[i+1]]
+Points3DArrays = collections.namedtuple(
+    "Points3DArrays", ["ids", "xyz", "rgb", "error", "track_offsets", "track_image_ids", "track_point2D_idxs"])
+# all images of a model as arrays, the 2D points of image i are xys/point3D_ids[point2D_offsets[i]:point2D_offsets[i+1]]
+ImagesArrays = collections.namedtuple(
+    "ImagesArrays", ["ids", "qvecs", "tvecs", "camera_ids", "names", "point2D_offsets", "xys", "point3D_ids"])
 
 class Image(BaseImage):
     def qvec2rotmat(self):
@@ -150,32 +160,14 @@ def read_images_binary(path_to_model_file):
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
     """
+    arrays = read_images_binary_arrays(path_to_model_file)
     images = {}
-    with open(path_to_model_file, "rb") as fid:
-        num_reg_images = read_next_bytes(fid, 8, "Q")[0]
-        for image_index in range(num_reg_images):
-            binary_image_properties = read_next_bytes(
-                fid, num_bytes=64, format_char_sequence="idddddddi")
-            image_id = binary_image_properties[0]
-            qvec = np.array(binary_image_properties[1:5])
-            tvec = np.array(binary_image_properties[5:8])
-            camera_id = binary_image_properties[8]
-            image_name = ""
-            current_char = read_next_bytes(fid, 1, "c")[0]
-            while current_char != b"\x00":   # look for the ASCII 0 entry
-                image_name += current_char.decode("utf-8")
-                current_char = read_next_bytes(fid, 1, "c")[0]
-            num_points2D = read_next_bytes(fid, num_bytes=8,
-                                           format_char_sequence="Q")[0]
-            x_y_id_s = read_next_bytes(fid, num_bytes=24*num_points2D,
-                                       format_char_sequence="ddq"*num_points2D)
-            xys = np.column_stack([tuple(map(float, x_y_id_s[0::3])),
-                                   tuple(map(float, x_y_id_s[1::3]))])
-            point3D_ids = np.array(tuple(map(int, x_y_id_s[2::3])))
-            images[image_id] = Image(
-                id=image_id, qvec=qvec, tvec=tvec,
-                camera_id=camera_id, name=image_name,
-                xys=xys, point3D_ids=point3D_ids)
+    for k, image_id in enumerate(arrays.ids):
+        begin, end = arrays.point2D_offsets[k], arrays.point2D_offsets[k+1]
+        images[int(image_id)] = Image(
+            id=int(image_id), qvec=arrays.qvecs[k], tvec=arrays.tvecs[k],
+            camera_id=int(arrays.camera_ids[k]), name=arrays.names[k],
+            xys=arrays.xys[begin:end], point3D_ids=arrays.point3D_ids[begin:end])
     return images
 
 
@@ -212,39 +204,149 @@ def read_points3d_binary(path_to_model_file):
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
         void Reconstruction::WritePoints3DBinary(const std::string& path)
     """
+    arrays = read_points3d_binary_arrays(path_to_model_file)
     points3D = {}
+    for k, point3D_id in enumerate(arrays.ids):
+        begin, end = arrays.track_offsets[k], arrays.track_offsets[k+1]
+        points3D[int(point3D_id)] = Point3D(
+            id=int(point3D_id), xyz=arrays.xyz[k], rgb=arrays.rgb[k],
+            error=arrays.error[k], image_ids=arrays.track_image_ids[begin:end],
+            point2D_idxs=arrays.track_point2D_idxs[begin:end])
+    return points3D
+
+
+#============================ bulk binary reading ============================#
+# packed record layouts of images.bin and points3D.bin
+IMAGE_HEADER_DTYPE = np.dtype([
+    ("id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<i4")])
+POINT2D_DTYPE = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+POINT3D_HEADER_DTYPE = np.dtype([
+    ("id", "<u8"), ("xyz", "<f8", 3), ("rgb", "u1", 3), ("error", "<f8"), ("track_length", "<u8")])
+TRACK_ELEM_DTYPE = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+
+
+def record_view(raw, dtype):
+    """Records of a packed dtype starting at every byte offset of raw, as a strided view without copy."""
+    return np.ndarray((max(len(raw) - dtype.itemsize + 1, 0),), dtype=dtype, buffer=raw, strides=(1,))
+
+
+def gather_records(raw, starts, dtype):
+    """Copy records of a packed dtype starting at arbitrary (unaligned) byte offsets of raw."""
+    return record_view(raw, dtype)[starts]
+
+
+def gather_csr_records(raw, record_starts, offsets, dtype, chunk_size=1 << 20):
+    """Copy the variable-length arrays of packed dtype elements starting at record_starts into one flat array.
+
+    The byte offsets of the elements are built for about chunk_size elements at a time.
+    """
+    lengths = np.diff(offsets)
+    records = record_view(raw, dtype)
+    out = np.empty(offsets[-1], dtype=dtype)
+    begin = 0
+    while begin < len(record_starts):
+        end = np.searchsorted(offsets, offsets[begin] + chunk_size, side="right") - 1
+        end = min(max(end, begin + 1), len(record_starts))
+        chunk_lengths = lengths[begin:end]
+        local = np.arange(offsets[begin], offsets[end], dtype=np.int64) - np.repeat(offsets[begin:end], chunk_lengths)
+        out[offsets[begin]:offsets[end]] = records[np.repeat(record_starts[begin:end], chunk_lengths) + dtype.itemsize * local]
+        begin = end
+    return out
+
+
+def read_images_binary_arrays(path_to_model_file):
+    """Read images.bin through a memory map into an ImagesArrays.
+
+    Only the variable-length image names are scanned in Python, the fixed-size headers and
+    the 2D points are decoded with structured dtypes.
+    """
     with open(path_to_model_file, "rb") as fid:
-        num_points = read_next_bytes(fid, 8, "Q")[0]
+        mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        num_reg_images = struct.unpack_from("<Q", mm, 0)[0]
+        header_starts, point2D_starts, counts, names = [], [], [], []
+        offset = 8
+        for image_index in range(num_reg_images):
+            header_starts.append(offset)
+            name_end = mm.find(b"\x00", offset + IMAGE_HEADER_DTYPE.itemsize)
+            names.append(mm[offset + IMAGE_HEADER_DTYPE.itemsize:name_end].decode("utf-8"))
+            num_points2D = struct.unpack_from("<Q", mm, name_end + 1)[0]
+            point2D_starts.append(name_end + 9)
+            counts.append(num_points2D)
+            offset = name_end + 9 + POINT2D_DTYPE.itemsize * num_points2D
+
+        raw = np.frombuffer(mm, dtype=np.uint8)
+        counts = np.array(counts, dtype=np.int64)
+        point2D_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        headers = gather_records(raw, np.array(header_starts, dtype=np.int64), IMAGE_HEADER_DTYPE)
+        points2D = gather_csr_records(raw, np.array(point2D_starts, dtype=np.int64), point2D_offsets, POINT2D_DTYPE)
+        del raw
+    finally:
+        mm.close()
+
+    return ImagesArrays(ids=headers["id"], qvecs=headers["qvec"], tvecs=headers["tvec"],
+                        camera_ids=headers["camera_id"], names=names, point2D_offsets=point2D_offsets,
+                        xys=points2D["xy"], point3D_ids=points2D["point3D_id"])
+
+
+def read_points3d_binary_arrays(path_to_model_file):
+    """Read points3D.bin through a memory map into a Points3DArrays.
+
+    The record boundaries are found by hopping over the track lengths, everything else is
+    gathered with structured dtypes, so no per-point Python objects are created.
+    """
+    with open(path_to_model_file, "rb") as fid:
+        mm = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        num_points = struct.unpack_from("<Q", mm, 0)[0]
+        record_starts = np.empty(num_points, dtype=np.int64)
+        lengths = np.empty(num_points, dtype=np.int64)
+        unpack_length = struct.Struct("<Q").unpack_from
+        length_offset = POINT3D_HEADER_DTYPE.itemsize - 8
+        offset = 8
         for point_line_index in range(num_points):
-            binary_point_line_properties = read_next_bytes(
-                fid, num_bytes=43, format_char_sequence="QdddBBBd")
-            point3D_id = binary_point_line_properties[0]
-            xyz = np.array(binary_point_line_properties[1:4])
-            rgb = np.array(binary_point_line_properties[4:7])
-            error = np.array(binary_point_line_properties[7])
-            track_length = read_next_bytes(
-                fid, num_bytes=8, format_char_sequence="Q")[0]
-            track_elems = read_next_bytes(
-                fid, num_bytes=8*track_length,
-                format_char_sequence="ii"*track_length)
-            image_ids = np.array(tuple(map(int, track_elems[0::2])))
-            point2D_idxs = np.array(tuple(map(int, track_elems[1::2])))
-            points3D[point3D_id] = Point3D(
-                id=point3D_id, xyz=xyz, rgb=rgb,
-                error=error, image_ids=image_ids,
-                point2D_idxs=point2D_idxs)
-    return points3D
+            record_starts[point_line_index] = offset
+            track_length = unpack_length(mm, offset + length_offset)[0]
+            lengths[point_line_index] = track_length
+            offset += POINT3D_HEADER_DTYPE.itemsize + TRACK_ELEM_DTYPE.itemsize * track_length
+
+        raw = np.frombuffer(mm, dtype=np.uint8)
+        track_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        headers = gather_records(raw, record_starts, POINT3D_HEADER_DTYPE)
+        tracks = gather_csr_records(raw, record_starts + POINT3D_HEADER_DTYPE.itemsize, track_offsets, TRACK_ELEM_DTYPE)
+        del raw
+    finally:
+        mm.close()
+
+    return Points3DArrays(ids=headers["id"].astype(np.int64), xyz=headers["xyz"], rgb=headers["rgb"],
+                          error=headers["error"], track_offsets=track_offsets,
+                          track_image_ids=tracks["image_id"], track_point2D_idxs=tracks["point2D_idx"])
+
+
+def points3d_to_arrays(points3D):
+    """Pack a dict of Point3D (as read from points3D.txt) into a Points3DArrays."""
+    point_list = [points3D[point3D_id] for point3D_id in sorted(points3D.keys())]
+    lengths = np.array([len(p.image_ids) for p in point_list], dtype=np.int64)
+    return Points3DArrays(
+        ids=np.array([p.id for p in point_list], dtype=np.int64),
+        xyz=np.array([p.xyz for p in point_list], dtype=np.float64).reshape(-1, 3),
+        rgb=np.array([p.rgb for p in point_list], dtype=np.uint8).reshape(-1, 3),
+        error=np.array([p.error for p in point_list], dtype=np.float64),
+        track_offsets=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        track_image_ids=np.concatenate([p.image_ids for p in point_list] + [[]]).astype(np.int32),
+        track_point2D_idxs=np.concatenate([p.point2D_idxs for p in point_list] + [[]]).astype(np.int32))
 
 
 def read_model(path, ext):
+    """cameras and images are dicts keyed by their COLMAP ids, the points are a Points3DArrays"""
     if ext == ".txt":
         cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
         images = read_images_text(os.path.join(path, "images" + ext))
-        points3D = read_points3D_text(os.path.join(path, "points3D") + ext)
+        points3D = points3d_to_arrays(read_points3D_text(os.path.join(path, "points3D") + ext))
     else:
         cameras = read_cameras_binary(os.path.join(path, "cameras" + ext))
         images = read_images_binary(os.path.join(path, "images" + ext))
-        points3D = read_points3d_binary(os.path.join(path, "points3D") + ext)
+        points3D = read_points3d_binary_arrays(os.path.join(path, "points3D") + ext)
     return cameras, images, points3D
 
 
@@ -276,34 +378,292 @@ def rotmat2qvec(R):
 
 
 
-def calc_score(inputs, images, points3d, extrinsic, args):
-    i, j = inputs
-    id_i = images[i+1].point3D_ids
-    id_j = images[j+1].point3D_ids
-    id_intersect = [it for it in id_i if it in id_j]
-    cam_center_i = -np.matmul(extrinsic[i+1][:3, :3].transpose(), extrinsic[i+1][:3, 3:4])[:, 0]
-    cam_center_j = -np.matmul(extrinsic[j+1][:3, :3].transpose(), extrinsic[j+1][:3, 3:4])[:, 0]
-    score = 0
-    for pid in id_intersect:
-        if pid == -1:
-            continue
-        p = points3d[pid].xyz
-        theta = (180 / np.pi) * np.arccos(np.dot(cam_center_i - p, cam_center_j - p) / np.linalg.norm(cam_center_i - p) / np.linalg.norm(cam_center_j - p))
-        score += np.exp(-(theta - args.theta0) * (theta - args.theta0) / (2 * (args.sigma1 if theta <= args.theta0 else args.sigma2) ** 2))
-    return i, j, score
+def build_visibility(images, points3d):
+    """Build the sparse image-by-point visibility matrix once.
 
-def processing_single_scene(args):
+    :return: vis (num_images x num_points csr), vis_t (its csr transpose), xyz (num_points x 3)
+    """
+    order = np.argsort(points3d.ids)
+    sorted_ids = points3d.ids[order]
+    rows, cols = [], []
+    for i in range(len(images)):
+        ids = np.asarray(images[i+1].point3D_ids, dtype=np.int64)
+        ids = np.unique(ids[ids != -1])
+        cols.append(order[np.searchsorted(sorted_ids, ids)])
+        rows.append(np.full(len(ids), i, dtype=np.int64))
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    vis = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(images), len(order)))
+    return vis, vis.T.tocsr(), points3d.xyz
+
+
+def inverse_depth_num(fx, depth_min, depth_max):
+    """Depth number by the inverse depth setting, see supplementary material.
+
+    The back-projections of the principal point and its right neighbour at depth_min are
+    depth_min / fx apart, independent of the camera pose. Works on scalars or arrays.
+    """
+    return (1 / depth_min - 1 / depth_max) / (1 / depth_min - 1 / (depth_min + depth_min / fx))
+
+
+def compute_depth_ranges(images, vis, xyz, intrinsic, extrinsic, args, max_ratio=0.1, min_ratio=0.03):
+    """relaxed depth range of every image from the depths of its visible sparse points
+
+    :return: dict image_id -> (depth_min, depth_interval, depth_num, depth_max)
+    """
+    num_images = vis.shape[0]
+    depth_min = np.zeros(num_images)
+    depth_max = np.zeros(num_images)
+    for i in range(num_images):
+        pts = vis.indices[vis.indptr[i]:vis.indptr[i+1]]
+        # only the third row of the extrinsic matters for the depth
+        zs = np.matmul(xyz[pts], extrinsic[i+1][2, :3]) + extrinsic[i+1][2, 3]
+        num_max = min(len(zs), max(5, int(len(zs) * max_ratio)))
+        num_min = max(1, int(len(zs) * min_ratio))
+        depth_min[i] = np.partition(zs, num_min - 1)[:num_min].mean()
+        depth_max[i] = np.partition(zs, len(zs) - num_max)[len(zs) - num_max:].mean()
+
+    if args.max_d == 0:
+        fx = np.array([intrinsic[images[i+1].camera_id][0, 0] for i in range(num_images)])
+        depth_num = inverse_depth_num(fx, depth_min, depth_max)
+    else:
+        depth_num = np.full(num_images, args.max_d)
+    depth_interval = (depth_max - depth_min) / (depth_num - 1) / args.interval_scale
+
+    return {i+1: (depth_min[i], depth_interval[i], depth_num[i], depth_max[i]) for i in range(num_images)}
+
+
+# view selection data shared with the worker processes, inherited through fork or set once per worker
+_view_sel_data = {}
+
+
+def _init_view_selection(data):
+    _view_sel_data.update(data)
 
-    image_dir = os.path.join(args.dense_folder, 'images')
-    model_dir = os.path.join(args.dense_folder, 'sparse')
-    cam_dir = os.path.join(args.save_folder, 'cams')
-    image_converted_dir = os.path.join(args.save_folder, 'images_post')
 
-    if os.path.exists(image_converted_dir):
+def calc_score_row(i, upper=True):
+    """Scores of image i against every image j > i (every j != i if not upper), vectorised over all co-visible points."""
+    vis, vis_t, xyz, centers = [_view_sel_data[k] for k in ['vis', 'vis_t', 'xyz', 'centers']]
+    theta0, sigma1, sigma2 = [_view_sel_data[k] for k in ['theta0', 'sigma1', 'sigma2']]
+    num_images = vis.shape[0]
+
+    # rows of the transposed visibility for the points of image i give every (point, j) co-visibility pair
+    pts = vis.indices[vis.indptr[i]:vis.indptr[i+1]]
+    shared = vis_t[pts].tocoo()
+    sel = shared.col > i if upper else shared.col != i
+    p = xyz[pts[shared.row[sel]]]
+    j = shared.col[sel]
+
+    vec_i = centers[i] - p
+    vec_j = centers[j] - p
+    cos = (vec_i * vec_j).sum(axis=1) / np.linalg.norm(vec_i, axis=1) / np.linalg.norm(vec_j, axis=1)
+    theta = (180 / np.pi) * np.arccos(np.clip(cos, -1.0, 1.0))
+    sigma = np.where(theta <= theta0, sigma1, sigma2)
+    s = np.exp(-(theta - theta0) * (theta - theta0) / (2 * sigma ** 2))
+    return i, np.bincount(j, weights=s, minlength=num_images)
+
+
+def calc_score_full_row(i):
+    return calc_score_row(i, upper=False)
+
+
+def view_selection(vis, vis_t, xyz, extrinsic, args, num_workers=None, score=None, rows=None):
+    """pairwise view selection scores (num_images x num_images) computed row by row in a process pool
+
+    Given a previous score matrix, only the rows and columns of the images in rows are recomputed.
+    """
+    num_images = vis.shape[0]
+    centers = np.stack([-np.matmul(extrinsic[i+1][:3, :3].transpose(), extrinsic[i+1][:3, 3:4])[:, 0]
+                        for i in range(num_images)])
+    data = {'vis': vis, 'vis_t': vis_t, 'xyz': xyz, 'centers': centers,
+            'theta0': args.theta0, 'sigma1': args.sigma1, 'sigma2': args.sigma2}
+
+    if score is None or rows is None:
+        score, rows, func = np.zeros((num_images, num_images)), list(range(num_images)), calc_score_row
+    else:
+        old_score = score
+        score = np.zeros((num_images, num_images))
+        num_old = min(num_images, old_score.shape[0])
+        score[:num_old, :num_old] = old_score[:num_old, :num_old]
+        func = calc_score_full_row
+    if len(rows) == 0:
+        return score
+    num_workers = num_workers or mp.cpu_count()
+    if 'fork' in mp.get_all_start_methods():
+        # workers inherit the data copy-on-write, nothing is pickled per task
+        _init_view_selection(data)
+        pool = mp.get_context('fork').Pool(processes=num_workers)
+    else:
+        pool = mp.Pool(processes=num_workers, initializer=_init_view_selection, initargs=(data,))
+    with pool:
+        for i, row in pool.imap_unordered(func, rows, chunksize=max(1, len(rows) // (4 * num_workers))):
+            if func is calc_score_row:
+                score[i, i+1:] = row[i+1:]
+                score[i+1:, i] = row[i+1:]
+            else:
+                score[i, :] = row
+                score[:, i] = row
+    return score
+
+
+IMAGE_CONVERT_SETTINGS = '.convert.json'
+
+
+def image_scale(camera, max_h, max_w):
+    """(scale_w, scale_h) that takes the images of camera to max_w x max_h, 1 if no target size is set"""
+    if max_h <= 0 or max_w <= 0:
+        return 1.0, 1.0
+    return 1.0 * max_w / camera.width, 1.0 * max_h / camera.height
+
+
+def convert_image(task):
+    """Convert one image to jpg, resizing it to (width, height) unless size is None.
+
+    Skipped when the output is newer than the source. cv2 releases the GIL, so this runs in threads.
+    """
+    src, dst, size = task
+    if os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return False
+    if size is None and src.endswith(".jpg"):
+        shutil.copyfile(src, dst)
+        return True
+    img = cv2.imread(src)
+    if size is not None and (img.shape[1], img.shape[0]) != size:
+        img = cv2.resize(img, size)
+    cv2.imwrite(dst, img)
+    return True
+
+
+def convert_images(names, image_dir, image_converted_dir, max_h=0, max_w=0, num_threads=8, stale=None):
+    """Write images_post/%08d.jpg for every image name with a thread pool.
+
+    Outputs converted with different max_h/max_w are discarded. The source name of every index is recorded,
+    an output is kept only if it was converted from the same source and is up to date.
+    If stale is given, exactly the listed indices (and missing outputs) are converted.
+    """
+    settings = {'max_h': max_h, 'max_w': max_w}
+    settings_file = os.path.join(image_converted_dir, IMAGE_CONVERT_SETTINGS)
+    old_settings = {}
+    if os.path.exists(settings_file):
+        with open(settings_file) as f:
+            old_settings = json.load(f)
+    if os.path.exists(image_converted_dir) and {k: old_settings.get(k) for k in settings} != settings:
         print("remove:{}".format(image_converted_dir))
         shutil.rmtree(image_converted_dir)
-    os.makedirs(image_converted_dir)
-    if os.path.exists(cam_dir):
+        old_settings = {}
+    os.makedirs(image_converted_dir, exist_ok=True)
+
+    size = (int(max_w), int(max_h)) if max_h > 0 and max_w > 0 else None
+    tasks = []
+    for i, name in enumerate(names):
+        tasks.append((os.path.join(image_dir, name), os.path.join(image_converted_dir, '%08d.jpg' % i), size))
+    expected = set(os.path.basename(dst) for _, dst, _ in tasks) | {IMAGE_CONVERT_SETTINGS}
+    for name in os.listdir(image_converted_dir):
+        if name not in expected:
+            os.remove(os.path.join(image_converted_dir, name))
+    # an index converted from another image (images added, removed or reordered) is converted again
+    old_names = old_settings.get('names', [])
+    for i, name in enumerate(names):
+        if (i >= len(old_names) or old_names[i] != name) and os.path.exists(tasks[i][1]):
+            os.remove(tasks[i][1])
+    if stale is not None:
+        # source digests decide instead of the mtimes
+        for i in stale:
+            if os.path.exists(tasks[i][1]):
+                os.remove(tasks[i][1])
+        tasks = [task for task in tasks if not os.path.exists(task[1])]
+
+    # recorded before converting, so an interrupted run leaves only outputs of the recorded names
+    with open(settings_file, 'w') as f:
+        json.dump(dict(settings, names=list(names)), f)
+    with ThreadPool(num_threads) as pool:
+        converted = sum(pool.imap_unordered(convert_image, tasks))
+    print('converted {} images, {} up to date'.format(converted, len(names) - converted))
+
+
+MANIFEST_DIR = '.colmap2mvsnet'
+# arguments that change the written cams/pair.txt, a change forces a full conversion
+MANIFEST_SETTINGS = ['max_d', 'interval_scale', 'theta0', 'sigma1', 'sigma2', 'model_ext', 'max_h', 'max_w']
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_digest(model_dir, ext):
+    digest = hashlib.sha1()
+    for name in ['cameras', 'images', 'points3D']:
+        digest.update(file_digest(os.path.join(model_dir, name + ext)).encode())
+    return digest.hexdigest()
+
+
+def view_signatures(cameras, images, points3d, vis, intrinsic, extrinsic):
+    """Digest of everything the cam file and the view selection scores of each image depend on:
+    its pose, its camera and the ids and positions of its visible points."""
+    signatures = []
+    for i in range(vis.shape[0]):
+        pts = vis.indices[vis.indptr[i]:vis.indptr[i+1]]
+        pts = pts[np.argsort(points3d.ids[pts])]
+        camera = cameras[images[i+1].camera_id]
+        digest = hashlib.sha1()
+        digest.update(np.array([camera.width, camera.height], dtype=np.int64).tobytes())
+        digest.update(np.ascontiguousarray(extrinsic[i+1]).tobytes())
+        digest.update(np.ascontiguousarray(intrinsic[images[i+1].camera_id]).tobytes())
+        digest.update(np.ascontiguousarray(points3d.ids[pts]).tobytes())
+        digest.update(np.ascontiguousarray(points3d.xyz[pts]).tobytes())
+        signatures.append(digest.hexdigest())
+    return signatures
+
+
+def load_manifest(args):
+    """previous conversion state of save_folder, None if missing or made with other settings"""
+    manifest_file = os.path.join(args.save_folder, MANIFEST_DIR, 'manifest.json')
+    score_file = os.path.join(args.save_folder, MANIFEST_DIR, 'score.npy')
+    if not os.path.exists(manifest_file) or not os.path.exists(score_file):
+        return None
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if manifest['settings'] != {k: getattr(args, k) for k in MANIFEST_SETTINGS}:
+        print('conversion settings changed, converting the whole scene')
+        return None
+    manifest['score'] = np.load(score_file)
+    return manifest
+
+
+def save_manifest(args, manifest):
+    os.makedirs(os.path.join(args.save_folder, MANIFEST_DIR), exist_ok=True)
+    np.save(os.path.join(args.save_folder, MANIFEST_DIR, 'score.npy'), manifest['score'])
+    state = {k: v for k, v in manifest.items() if k != 'score'}
+    state['settings'] = {k: getattr(args, k) for k in MANIFEST_SETTINGS}
+    with open(os.path.join(args.save_folder, MANIFEST_DIR, 'manifest.json'), 'w') as f:
+        json.dump(state, f)
+
+
+def image_digests(image_dir, names, old_views):
+    """sha1 of every source image, reusing the previous digest when name, size and mtime are unchanged"""
+    old = {v['name']: v for v in old_views}
+    digests = []
+    for name in names:
+        stat = os.stat(os.path.join(image_dir, name))
+        entry = old.get(name)
+        if entry is not None and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            digests.append(entry['image'])
+        else:
+            digests.append(file_digest(os.path.join(image_dir, name)))
+    return digests
+
+
+def convert_model(args, model_dir, cam_dir, manifest=None):
+    """Write cams and pair.txt of the sparse model.
+
+    With the manifest of a previous run, only the cams of images whose signature changed are
+    rewritten and only their view selection scores are recomputed.
+    :return: image names, view signatures and the view selection scores
+    """
+    if manifest is None and os.path.exists(cam_dir):
         print("remove:{}".format(cam_dir))
         shutil.rmtree(cam_dir)
 
@@ -355,58 +715,23 @@ def processing_single_scene(args):
     print('extrinsic[1]\n', extrinsic[1], end='\n\n')
 
     # depth range and interval
-    depth_ranges = {}
-    for i in range(num_images):
-        zs = []
-        for p3d_id in images[i+1].point3D_ids:
-            if p3d_id == -1:
-                continue
-            transformed = np.matmul(extrinsic[i+1], [points3d[p3d_id].xyz[0], points3d[p3d_id].xyz[1], points3d[p3d_id].xyz[2], 1])
-            zs.append(np.asscalar(transformed[2]))
-        zs_sorted = sorted(zs)
-        # relaxed depth range
-        max_ratio = 0.1
-        min_ratio = 0.03
-        num_max = max(5, int(len(zs) * max_ratio))
-        num_min = max(1, int(len(zs) * min_ratio))
-        depth_min = 1.0 * sum(zs_sorted[:num_min]) / len(zs_sorted[:num_min])
-        depth_max = 1.0 * sum(zs_sorted[-num_max:]) / len(zs_sorted[-num_max:])
-        # print("new", depth_min, depth_max, zs_sorted[-10:])
-        # depth_min = zs_sorted[int(len(zs) * .01)]
-        # depth_max = zs_sorted[int(len(zs) * .99)]
-        # print("old", depth_min, depth_max, zs_sorted[:10], zs_sorted[-10:])
-        # determine depth number by inverse depth setting, see supplementary material
-        if args.max_d == 0:
-            image_int = intrinsic[images[i+1].camera_id]
-            image_ext = extrinsic[i+1]
-            image_r = image_ext[0:3, 0:3]
-            image_t = image_ext[0:3, 3]
-            p1 = [image_int[0, 2], image_int[1, 2], 1]
-            p2 = [image_int[0, 2] + 1, image_int[1, 2], 1]
-            P1 = np.matmul(np.linalg.inv(image_int), p1) * depth_min
-            P1 = np.matmul(np.linalg.inv(image_r), (P1 - image_t))
-            P2 = np.matmul(np.linalg.inv(image_int), p2) * depth_min
-            P2 = np.matmul(np.linalg.inv(image_r), (P2 - image_t))
-            depth_num = (1 / depth_min - 1 / depth_max) / (1 / depth_min - 1 / (depth_min + np.linalg.norm(P2 - P1)))
-        else:
-            depth_num = args.max_d
-        depth_interval = (depth_max - depth_min) / (depth_num - 1) / args.interval_scale
-        depth_ranges[i+1] = (depth_min, depth_interval, depth_num, depth_max)
+    vis, vis_t, xyz = build_visibility(images, points3d)
+    depth_ranges = compute_depth_ranges(images, vis, xyz, intrinsic, extrinsic, args)
     print('depth_ranges[1]\n', depth_ranges[1], end='\n\n')
 
+    names = [images[i+1].name for i in range(num_images)]
+    signatures = view_signatures(cameras, images, points3d, vis, intrinsic, extrinsic)
+    if manifest is None:
+        changed = list(range(num_images))
+        score = view_selection(vis, vis_t, xyz, extrinsic, args)
+    else:
+        old_views = manifest['views']
+        changed = [i for i in range(num_images) if i >= len(old_views) or
+                   old_views[i]['name'] != names[i] or old_views[i]['signature'] != signatures[i]]
+        print('{} of {} views changed'.format(len(changed), num_images))
+        score = view_selection(vis, vis_t, xyz, extrinsic, args, score=manifest['score'], rows=changed)
+
     # view selection
-    score = np.zeros((len(images), len(images)))
-    queue = []
-    for i in range(len(images)):
-        for j in range(i + 1, len(images)):
-            queue.append((i, j))
-
-    p = mp.Pool(processes=mp.cpu_count())
-    func = partial(calc_score, images=images, points3d=points3d, args=args, extrinsic=extrinsic)
-    result = p.map(func, queue)
-    for i, j, s in result:
-        score[i, j] = s
-        score[j, i] = s
     view_sel = []
     for i in range(len(images)):
         sorted_score = np.argsort(score[i])[::-1]
@@ -418,7 +743,10 @@ def processing_single_scene(args):
         os.makedirs(cam_dir)
     except os.error:
         print(cam_dir + ' already exist.')
-    for i in range(num_images):
+    for name in os.listdir(cam_dir):
+        if name.endswith('_cam.txt') and int(name[:8]) >= num_images:
+            os.remove(os.path.join(cam_dir, name))
+    for i in changed:
         with open(os.path.join(cam_dir, '%08d_cam.txt' % i), 'w') as f:
             f.write('extrinsic\n')
             for j in range(4):
@@ -426,9 +754,12 @@ def processing_single_scene(args):
                     f.write(str(extrinsic[i+1][j, k]) + ' ')
                 f.write('\n')
             f.write('\nintrinsic\n')
+            # intrinsics follow the images written to images_post
+            scale_w, scale_h = image_scale(cameras[images[i+1].camera_id], args.max_h, args.max_w)
+            image_int = intrinsic[images[i+1].camera_id] * np.array([[scale_w], [scale_h], [1]])
             for j in range(3):
                 for k in range(3):
-                    f.write(str(intrinsic[images[i+1].camera_id][j, k]) + ' ')
+                    f.write(str(image_int[j, k]) + ' ')
                 f.write('\n')
             f.write('\n%f %f %f %f\n' % (depth_ranges[i+1][0], depth_ranges[i+1][1], depth_ranges[i+1][2], depth_ranges[i+1][3]))
     with open(os.path.join(args.save_folder, 'pair.txt'), 'w') as f:
@@ -439,14 +770,44 @@ def processing_single_scene(args):
                 f.write('%d %f ' % (image_id, s))
             f.write('\n')
 
+    return names, signatures, score
+
+
+def processing_single_scene(args):
+
+    image_dir = os.path.join(args.dense_folder, 'images')
+    model_dir = os.path.join(args.dense_folder, 'sparse')
+    cam_dir = os.path.join(args.save_folder, 'cams')
+    image_converted_dir = os.path.join(args.save_folder, 'images_post')
+
+    manifest = load_manifest(args) if args.incremental else None
+    model_hash = model_digest(model_dir, args.model_ext) if args.incremental else None
+    if manifest is not None and manifest['model'] == model_hash and \
+            os.path.exists(os.path.join(args.save_folder, 'pair.txt')) and \
+            all(os.path.exists(os.path.join(cam_dir, '%08d_cam.txt' % i)) for i in range(len(manifest['views']))):
+        print('sparse model unchanged, keeping cams and pair.txt')
+        names = [v['name'] for v in manifest['views']]
+        signatures = [v['signature'] for v in manifest['views']]
+        score = manifest['score']
+    else:
+        names, signatures, score = convert_model(args, model_dir, cam_dir, manifest)
+
     #convert to jpg
-    for i in range(num_images):
-        img_path = os.path.join(image_dir, images[i + 1].name)
-        if not img_path.endswith(".jpg"):
-            img = cv2.imread(img_path)
-            cv2.imwrite(os.path.join(image_converted_dir, '%08d.jpg' % i), img)
-        else:
-            shutil.copyfile(os.path.join(image_dir, images[i+1].name), os.path.join(image_converted_dir, '%08d.jpg' % i))
+    stale = None
+    if args.incremental:
+        old_views = manifest['views'] if manifest is not None else []
+        digests = image_digests(image_dir, names, old_views)
+        stale = [i for i in range(len(names)) if i >= len(old_views) or
+                 old_views[i]['name'] != names[i] or old_views[i]['image'] != digests[i]]
+    convert_images(names, image_dir, image_converted_dir, args.max_h, args.max_w, args.num_threads, stale=stale)
+
+    if args.incremental:
+        views = []
+        for i, name in enumerate(names):
+            stat = os.stat(os.path.join(image_dir, name))
+            views.append({'name': name, 'signature': signatures[i], 'image': digests[i],
+                          'size': stat.st_size, 'mtime': stat.st_mtime})
+        save_manifest(args, {'model': model_hash, 'views': views, 'score': score})
 
 
 if __name__ == '__main__':
@@ -462,6 +823,11 @@ if __name__ == '__main__':
     parser.add_argument('--sigma1', type=float, default=1)
     parser.add_argument('--sigma2', type=float, default=10)
     parser.add_argument('--model_ext', type=str, default=".bin",  choices=[".txt", ".bin"], help='sparse model ext')
+    parser.add_argument('--max_h', type=int, default=0, help='resize images_post to this height (0 keeps the size)')
+    parser.add_argument('--max_w', type=int, default=0, help='resize images_post to this width (0 keeps the size)')
+    parser.add_argument('--num_threads', type=int, default=8, help='threads for the image conversion')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only reconvert the views whose sparse data or image changed since the last run')
 
     args = parser.parse_args()
 
@@ -93,7 +93,7 @@ class BlendedMVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        depth = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth = read_pfm(filename, mmap=True, contiguous=True)[0]
         depth = self.prepare_img(depth)
         h, w = depth.shape
         depth_ms = {
@@ -106,7 +106,7 @@ class BlendedMVSDataset(Dataset):
         return depth_ms
 
     def read_mask(self, filename):
-        depth = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth = read_pfm(filename, mmap=True, contiguous=True)[0]
         np_img = (depth > 0).astype(np.float32)
         np_img = self.prepare_img(np_img)
         # np_img = cv2.resize(np_img, (768, 576), interpolation=cv2.INTER_NEAREST)
@@ -1,52 +1,81 @@
 import numpy as np
 import re
 import sys
+import json
+import struct
+import cv2
 
 
-def read_pfm(filename):
-    file = open(filename, 'rb')
-    color = None
-    width = None
-    height = None
-    scale = None
-    endian = None
+def read_pfm_header(filename):
+    """Read only the PFM header.
 
-    header = file.readline().decode('utf-8').rstrip()
-    if header == 'PF':
-        color = True
-    elif header == 'Pf':
-        color = False
-    else:
-        raise Exception('Not a PFM file.')
+    :return: shape (H, W) or (H, W, 3), scale, data dtype (with endianness) and byte offset of the data
+    """
+    with open(filename, 'rb') as file:
+        header = file.readline().decode('utf-8').rstrip()
+        if header == 'PF':
+            color = True
+        elif header == 'Pf':
+            color = False
+        else:
+            raise Exception('Not a PFM file.')
 
-    dim_match = re.match(r'^(\d+)\s(\d+)\s$', file.readline().decode('utf-8'))
-    if dim_match:
-        width, height = map(int, dim_match.groups())
-    else:
-        raise Exception('Malformed PFM header.')
+        dim_match = re.match(r'^(\d+)\s(\d+)\s$', file.readline().decode('utf-8'))
+        if dim_match:
+            width, height = map(int, dim_match.groups())
+        else:
+            raise Exception('Malformed PFM header.')
 
-    scale = float(file.readline().rstrip())
-    if scale < 0:  # little-endian
-        endian = '<'
-        scale = -scale
-    else:
-        endian = '>'  # big-endian
+        scale = float(file.readline().rstrip())
+        if scale < 0:  # little-endian
+            endian = '<'
+            scale = -scale
+        else:
+            endian = '>'  # big-endian
+        offset = file.tell()
 
-    data = np.fromfile(file, endian + 'f')
     shape = (height, width, 3) if color else (height, width)
+    return shape, scale, np.dtype(endian + 'f'), offset
 
-    data = np.reshape(data, shape)
+
+def read_pfm(filename, mmap=False, contiguous=False):
+    """Read a PFM file.
+
+    :param mmap: memory-map the data instead of loading it, the returned array is then backed by the file
+    :param contiguous: return a C-contiguous native float32 array (one copy), otherwise a flipped view of the
+                       loaded or mapped data is returned without any copy
+    :return: data (H, W) or (H, W, 3), scale
+    """
+    shape, scale, dtype, offset = read_pfm_header(filename)
+
+    if mmap:
+        data = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+        with open(filename, 'rb') as file:
+            file.seek(offset)
+            data = np.fromfile(file, dtype)
+        data = np.reshape(data, shape)
+    # PFM rows are stored bottom-to-top
     data = np.flipud(data)
-    file.close()
+    if contiguous:
+        data = np.ascontiguousarray(data, dtype=np.float32)
     return data, scale
 
 
-def save_pfm(filename, image, scale=1):
-    file = open(filename, "wb")
-    color = None
+def read_pfms(filenames, mmap=True):
+    """Read many PFM files of the same shape into one preallocated (N, H, W[, 3]) float32 array."""
+    shape = read_pfm_header(filenames[0])[0]
+    out = np.empty((len(filenames),) + shape, dtype=np.float32)
+    for i, filename in enumerate(filenames):
+        data, _ = read_pfm(filename, mmap=mmap)
+        if data.shape != shape:
+            raise Exception('PFM {} has shape {}, expected {}.'.format(filename, data.shape, shape))
+        out[i] = data
+        del data
+    return out
 
-    image = np.flipud(image)
 
+def save_pfm(filename, image, scale=1):
     if image.dtype.name != 'float32':
         raise Exception('Image dtype must be float32.')
 
@@ -57,20 +86,190 @@ def save_pfm(filename, image, scale=1):
     else:
         raise Exception('Image must have H x W x 3, H x W x 1 or H x W dimensions.')
 
-    file.write('PF\n'.encode('utf-8') if color else 'Pf\n'.encode('utf-8'))
-    file.write('{} {}\n'.format(image.shape[1], image.shape[0]).encode('utf-8'))
-
     endian = image.dtype.byteorder
 
     if endian == '<' or endian == '=' and sys.byteorder == 'little':
         scale = -scale
 
-    file.write(('%f\n' % scale).encode('utf-8'))
+    image = np.ascontiguousarray(image)
+    with open(filename, "wb") as file:
+        file.write('PF\n'.encode('utf-8') if color else 'Pf\n'.encode('utf-8'))
+        file.write('{} {}\n'.format(image.shape[1], image.shape[0]).encode('utf-8'))
+        file.write(('%f\n' % scale).encode('utf-8'))
+        # write rows bottom-to-top directly instead of materialising a flipped copy
+        for row in image[::-1]:
+            file.write(row.data)
+
+def quantise_confidence(conf, dtype='uint8'):
+    """store a confidence map in [0, 1] as uint8 (1/255 steps), float16 or float32"""
+    if np.dtype(dtype) == np.uint8:
+        return np.round(np.clip(conf, 0, 1) * 255).astype(np.uint8)
+    return conf.astype(dtype)
+
+
+def dequantise_confidence(conf):
+    if conf.dtype == np.uint8:
+        return conf.astype(np.float32) / 255.0
+    return conf.astype(np.float32)
+
+
+def save_confidence(filename, confs, dtype='uint8'):
+    """save per-stage confidence maps at their native resolution into an .npz file"""
+    np.savez(filename, **{'stage{}'.format(i + 1): quantise_confidence(conf, dtype) for i, conf in enumerate(confs)})
+
+
+def read_confidence(filename):
+    """read per-stage confidence maps written by save_confidence, as a list of float32 (h_i, w_i) arrays"""
+    with np.load(filename) as data:
+        return [dequantise_confidence(data['stage{}'.format(i + 1)]) for i in range(len(data.files))]
+
+
+def confidence_mask(conf, prob_threshold, shape=None):
+    """Threshold confidence and return a boolean (H, W) mask.
+
+    conf is either a full resolution (H, W, C) array or a list of per-stage (h_i, w_i) arrays. In the latter
+    case every stage is thresholded at its native resolution and only the boolean mask is upsampled
+    (nearest) to `shape`, which gives the same result as upsampling the confidence first.
+    """
+    mask = None
+    for i, p in enumerate(prob_threshold):
+        if isinstance(conf, (list, tuple)):
+            stage_mask = conf[i] > p
+            if shape is not None and stage_mask.shape != tuple(shape):
+                stage_mask = cv2.resize(stage_mask.astype(np.uint8), (shape[1], shape[0]),
+                                        interpolation=cv2.INTER_NEAREST) > 0
+        else:
+            stage_mask = conf[:, :, i] > p
+        mask = stage_mask if mask is None else mask & stage_mask
+    return mask
+
+
+# file name of the per-scene container inside an output scan folder
+DEPTH_CONTAINER_NAME = 'depths.mvsd'
+
+
+class DepthContainerWriter(object):
+    """Write all per-view outputs of a scene into a single indexed file.
+
+    Layout: a 16-byte header (magic, version, offset of the index), one chunk per view holding its
+    arrays back to back (each aligned to 64 bytes so it can be memory-mapped), and a JSON index at the end
+    mapping view id -> array name -> (offset, dtype, shape).
+    Depth is stored as float32 or float16, per-stage confidence at native resolution as uint8 (or
+    `conf_dtype`), cameras as float32 and the
+    reference image, optionally downsampled by `img_scale`, as uint8 (img_scale=0 skips the image).
+    """
+    MAGIC = b'MVSD'
+    VERSION = 2
+    ALIGN = 64
+
+    def __init__(self, filename, depth_dtype='float32', img_scale=1.0, conf_dtype='uint8'):
+        self.filename = filename
+        self.depth_dtype = np.dtype(depth_dtype)
+        self.conf_dtype = np.dtype(conf_dtype)
+        self.img_scale = img_scale
+        self.index = {}
+        self.file = open(filename, 'wb')
+        self.file.write(self.MAGIC + struct.pack('<IQ', self.VERSION, 0))
+
+    def _write_array(self, array):
+        array = np.ascontiguousarray(array)
+        pad = -self.file.tell() % self.ALIGN
+        self.file.write(b'\0' * pad)
+        offset = self.file.tell()
+        self.file.write(array.data)
+        return [offset, array.dtype.str, list(array.shape)]
+
+    def add_view(self, view_id, depth, conf, cam, img=None):
+        """depth: (H, W), conf: list of per-stage (h_i, w_i) maps or an (H, W, C) map in [0, 1],
+        cam: (2, 4, 4), img: (H, W, 3) in [0, 1]"""
+        if not isinstance(conf, (list, tuple)):
+            conf = [conf[:, :, i] for i in range(conf.shape[2])] if conf.ndim == 3 else [conf]
+        entry = {"depth": self._write_array(depth.astype(self.depth_dtype)),
+                 "conf": [self._write_array(quantise_confidence(c, self.conf_dtype)) for c in conf],
+                 "cam": self._write_array(cam.astype(np.float32))}
+        if img is not None and self.img_scale > 0:
+            if self.img_scale != 1.0:
+                h, w = img.shape[:2]
+                img = cv2.resize(img, (int(w * self.img_scale), int(h * self.img_scale)), interpolation=cv2.INTER_AREA)
+            entry["img"] = self._write_array(np.clip(img * 255, 0, 255).astype(np.uint8))
+        self.index[str(view_id)] = entry
+
+    def close(self):
+        if self.file is None:
+            return
+        index_offset = self.file.tell()
+        self.file.write(json.dumps(self.index).encode('utf-8'))
+        self.file.seek(len(self.MAGIC) + 4)
+        self.file.write(struct.pack('<Q', index_offset))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DepthContainer(object):
+    """Random access reader for files written by DepthContainerWriter.
+
+    Only the index is parsed on construction and no file handle is kept open, so instances can be
+    passed to DataLoader workers.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            magic = f.read(len(DepthContainerWriter.MAGIC))
+            if magic != DepthContainerWriter.MAGIC:
+                raise Exception('Not a depth container file.')
+            version, index_offset = struct.unpack('<IQ', f.read(12))
+            if version != DepthContainerWriter.VERSION:
+                raise Exception('Unsupported depth container version {}.'.format(version))
+            f.seek(index_offset)
+            self.index = json.loads(f.read().decode('utf-8'))
+
+    @property
+    def view_ids(self):
+        return sorted(int(k) for k in self.index.keys())
+
+    def has(self, view_id, name):
+        return name in self.index[str(view_id)]
+
+    def read_array(self, view_id, name, mmap=False):
+        return self._read_entry(self.index[str(view_id)][name], mmap)
+
+    def _read_entry(self, entry, mmap=False):
+        offset, dtype, shape = entry
+        if mmap:
+            return np.memmap(self.filename, dtype=np.dtype(dtype), mode='r', offset=offset, shape=tuple(shape))
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            data = np.fromfile(f, dtype=np.dtype(dtype), count=int(np.prod(shape)))
+        return data.reshape(shape)
+
+    def read_depth(self, view_id):
+        return self.read_array(view_id, "depth").astype(np.float32)
+
+    def read_conf(self, view_id):
+        """per-stage confidence maps at native resolution, a list of float32 (h_i, w_i) arrays"""
+        return [dequantise_confidence(self._read_entry(entry)) for entry in self.index[str(view_id)]["conf"]]
+
+    def read_cam(self, view_id):
+        return self.read_array(view_id, "cam")
+
+    def read_img(self, view_id, shape=None):
+        """reference image as float32 (H, W, 3) in [0, 1], resized to `shape` (H, W) if given"""
+        if not self.has(view_id, "img"):
+            return np.zeros(tuple(shape) + (3,), dtype=np.float32) if shape is not None else None
+        img = self.read_array(view_id, "img").astype(np.float32) / 255.0
+        if shape is not None and img.shape[:2] != tuple(shape):
+            img = cv2.resize(img, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        return img
 
-    image.tofile(file)
-    file.close()
 
-import random, cv2
+import random
 class RandomCrop(object):
     def __init__(self, CropSize=0.1):
         self.CropSize = CropSize
@@ -1,20 +1,107 @@
 import os
+import collections
 import numpy as np
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
 
 from .general_eval import MVSDataset
 from .blended_dataset import BlendedMVSDataset
 from .dtu_yao import DTUMVSDataset
+from utils import get_world_size
 
 np.random.seed(1234)
 
 
+def distributed_args(dataset, mode, shuffle, batch_size):
+    """
+    Sampler, shuffle flag and per-process batch size for a loader. When running
+    under torch.distributed every process gets its own shard of the dataset and
+    batch_size is split across the processes, so the effective batch stays the
+    one given in the config.
+    """
+    world_size = get_world_size()
+    if world_size < 2:
+        return None, shuffle, batch_size
+    if batch_size % world_size != 0:
+        print("batch_size {} is not divisible by the world size {}".format(batch_size, world_size))
+    sampler = DistributedSampler(dataset, shuffle=shuffle, drop_last=(mode == 'train'))
+    return sampler, False, max(1, batch_size // world_size)
+
+
+class ScanBatchSampler(Sampler):
+    """
+    Reference views of one scene in batches of batch_size; a batch never mixes two scenes, so the images of a
+    batch share the resolution of their scene and every scene ends with its own smaller batch. References keep
+    the order of metas unless reorder is set: then within a scene they are ordered greedily so that the next one
+    shares most views (reference and sources) with the recently used ones, which are the ones still in an LRU
+    FeatureCache.
+    """
+    # picks after which a used view no longer counts for the reordering
+    horizon = 16
+
+    def __init__(self, metas, batch_size, reorder=False):
+        self.metas = metas
+        self.batch_size = batch_size
+        self.order = []
+        scans = collections.OrderedDict()
+        for idx, meta in enumerate(metas):
+            scans.setdefault(meta[0], []).append(idx)
+        for indices in scans.values():
+            self.order += self.recency_order(indices) if reorder else indices
+        self.num_batches = sum(1 for _ in self)
+
+    def views(self, idx):
+        return [self.metas[idx][1]] + list(self.metas[idx][2])
+
+    def recency_order(self, indices):
+        refs = collections.defaultdict(list)
+        for idx in indices:
+            for vid in self.views(idx):
+                refs[vid].append(idx)
+        remaining = set(indices)
+        first = 0
+        last_used = {}
+        recent = collections.deque(maxlen=self.horizon)
+        order = []
+        for step in range(len(indices)):
+            # only the references sharing a view of the last picks can score, a view counts less the longer it
+            # has not been used
+            candidates = {idx for views in recent for vid in views for idx in refs[vid] if idx in remaining}
+            if candidates:
+                score = lambda i: sum(1.0 / (step - last_used[vid]) for vid in self.views(i)
+                                      if step - last_used.get(vid, -self.horizon) <= self.horizon)
+                idx = max(sorted(candidates), key=score)
+            else:
+                while indices[first] not in remaining:
+                    first += 1
+                idx = indices[first]
+            remaining.remove(idx)
+            order.append(idx)
+            for vid in self.views(idx):
+                last_used[vid] = step
+            recent.append(self.views(idx))
+        return order
+
+    def __iter__(self):
+        batch = []
+        for idx in self.order:
+            if batch and (len(batch) == self.batch_size or self.metas[batch[0]][0] != self.metas[idx][0]):
+                yield batch
+                batch = []
+            batch.append(idx)
+        if batch:
+            yield batch
+
+    def __len__(self):
+        return self.num_batches
+
+
 class DTULoader(DataLoader):
 
     def __init__(self, data_path, data_list, mode, num_srcs, num_depths, interval_scale=1.0,
                  shuffle=True, seq_size=49, batch_size=1, fix_res=False, max_h=None, max_w=None,
-                 dataset_eval='dtu', refine=True):
+                 dataset_eval='dtu', refine=True, reorder=False):
         if (mode == 'train') or (mode == 'val'):
             self.mvs_dataset = DTUMVSDataset(data_path, data_list, mode, num_srcs, num_depths, interval_scale,
                                              shuffle=shuffle, seq_size=seq_size, batch_size=batch_size)
@@ -22,9 +109,14 @@ class DTULoader(DataLoader):
             self.mvs_dataset = MVSDataset(data_path, data_list, mode, num_srcs, num_depths, interval_scale,
                                           shuffle=shuffle, seq_size=seq_size, batch_size=batch_size,
                                           max_h=max_h, max_w=max_w, fix_res=fix_res, dataset=dataset_eval, refine=refine)
-        drop_last = True if mode == 'train' else False
-        super().__init__(self.mvs_dataset, batch_size=batch_size, shuffle=shuffle,
-                         num_workers=4, pin_memory=True, drop_last=drop_last)
+        if mode == 'test':
+            batch_sampler = ScanBatchSampler(self.mvs_dataset.metas, batch_size, reorder=reorder)
+            super().__init__(self.mvs_dataset, batch_sampler=batch_sampler, num_workers=4, pin_memory=True)
+        else:
+            drop_last = True if mode == 'train' else False
+            sampler, shuffle, batch_size = distributed_args(self.mvs_dataset, mode, shuffle, batch_size)
+            super().__init__(self.mvs_dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                             num_workers=4, pin_memory=True, drop_last=drop_last)
 
         self.n_samples = len(self.mvs_dataset)
 
@@ -44,7 +136,8 @@ class BlendedLoader(DataLoader):
                                           shuffle=shuffle, seq_size=seq_size, batch_size=batch_size,
                                           max_h=max_h, max_w=max_w, fix_res=fix_res, dataset='dtu')
         drop_last = True if mode == 'train' else False
-        super().__init__(self.mvs_dataset, batch_size=batch_size, shuffle=shuffle,
+        sampler, shuffle, batch_size = distributed_args(self.mvs_dataset, mode, shuffle, batch_size)
+        super().__init__(self.mvs_dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
                          num_workers=4, pin_memory=True, drop_last=drop_last)
 
         self.n_samples = len(self.mvs_dataset)
@@ -110,12 +110,12 @@ class DTUMVSDataset(Dataset):
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return read_pfm(filename, mmap=True, contiguous=True)[0]
 
     def read_depth_hr(self, filename):
         # read pfm depth file
         #w1600-h1200-> 800-600 ; crop -> 640, 512; downsample 1/4 -> 160, 128
-        depth_hr = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth_hr = read_pfm(filename, mmap=True, contiguous=True)[0]
         depth_lr = self.prepare_img(depth_hr)
 
         h, w = depth_lr.shape
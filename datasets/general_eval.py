@@ -19,6 +19,8 @@ class MVSDataset(Dataset):
         self.fix_res = kwargs.get("fix_res", False)  #whether to fix the resolution of input image.
         self.fix_wh = False
         self.kwargs = kwargs
+        # per-scene image size {scan: (h, w)} replacing max_h x max_w, e.g. from planner.MemoryPlanner
+        self.scene_sizes = kwargs.get("scene_sizes", None)
 
         assert self.mode == "test"
         self.metas = self.build_list()
@@ -97,6 +99,18 @@ class MVSDataset(Dataset):
 
         return np_img
 
+    def img_filename(self, scan, vid):
+        img_filename = os.path.join(self.datapath, '{}/images_post/{:0>8}.jpg'.format(scan, vid))
+        if not os.path.exists(img_filename):
+            img_filename = os.path.join(self.datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
+        return img_filename
+
+    def image_size(self, scan):
+        """(h, w) of the images of a scene as read by read_img, before scaling"""
+        ref_view = [meta[1] for meta in self.metas if meta[0] == scan][0]
+        w, h = Image.open(self.img_filename(scan, ref_view)).size
+        return (h + 8, w) if self.kwargs["dataset"] == "tt" else (h, w)
+
     def scale_mvs_input(self, img, intrinsics, max_w, max_h, base=64):
         h, w = img.shape[:2]
         # if h > max_h or w > max_w:
@@ -106,6 +120,7 @@ class MVSDataset(Dataset):
         #     new_w, new_h = scale * w // base * base, scale * h // base * base
         # else:
         #     new_w, new_h = 1.0 * w // base * base, 1.0 * h // base * base
+        # (test.py --auto_res plans an aspect preserving size per scene with planner.fit_size and passes it here)
         new_h, new_w = max_h, max_w
 
         scale_w = 1.0 * new_w / w
@@ -113,7 +128,9 @@ class MVSDataset(Dataset):
         intrinsics[0, :] *= scale_w
         intrinsics[1, :] *= scale_h
 
-        img = cv2.resize(img, (int(new_w), int(new_h)))
+        # images pre-resized by colmap2mvsnet.py --max_h/--max_w already have the target size
+        if (h, w) != (int(new_h), int(new_w)):
+            img = cv2.resize(img, (int(new_w), int(new_h)))
 
         return img, intrinsics
 
@@ -129,10 +146,9 @@ class MVSDataset(Dataset):
         imgs = []
         depth_values = None
         proj_matrices = []
+        max_h, max_w = self.scene_sizes[scan] if self.scene_sizes is not None else (self.max_h, self.max_w)
         for i, vid in enumerate(view_ids):
-            img_filename = os.path.join(self.datapath, '{}/images_post/{:0>8}.jpg'.format(scan, vid))
-            if not os.path.exists(img_filename):
-                img_filename = os.path.join(self.datapath, '{}/images/{:0>8}.jpg'.format(scan, vid))
+            img_filename = self.img_filename(scan, vid)
 
             proj_mat_filename = os.path.join(self.datapath, '{}/cams/{:0>8}_cam.txt'.format(scan, vid))
 
@@ -140,7 +156,7 @@ class MVSDataset(Dataset):
             intrinsics, extrinsics, depth_min, depth_interval = self.read_cam_file(proj_mat_filename, interval_scale=
                                                                                    self.interval_scale[scene_name])
             # scale input
-            img, intrinsics = self.scale_mvs_input(img, intrinsics, self.max_w, self.max_h)
+            img, intrinsics = self.scale_mvs_input(img, intrinsics, max_w, max_h)
 
             if self.fix_res:
                 # using the same standard height or width in entire scene.
@@ -202,4 +218,5 @@ class MVSDataset(Dataset):
         return {"imgs": imgs,
                 "proj_matrices": proj_matrices_ms,
                 "depth_values": depth_values,
+                "view_ids": np.array(view_ids),
                 "filename": scan + '/{}/' + '{:0>8}'.format(view_ids[0]) + "{}"}
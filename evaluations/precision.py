@@ -66,12 +66,12 @@ class Evaluation(object):
 
     def read_depth(self, filename):
         # read pfm depth file
-        return np.array(read_pfm(filename)[0], dtype=np.float32)
+        return read_pfm(filename, mmap=True, contiguous=True)[0]
 
     def read_depth_hr(self, filename, max_w, max_h):
         # read pfm depth file
         #w1600-h1200-> 800-600 ; crop -> 640, 512; downsample 1/4 -> 160, 128
-        depth_hr = np.array(read_pfm(filename)[0], dtype=np.float32)
+        depth_hr = read_pfm(filename, mmap=True, contiguous=True)[0]
         depth_lr = self.scale_input(depth_hr, max_w=max_w, max_h=max_h)
 
         return depth_lr
@@ -82,7 +82,7 @@ class Evaluation(object):
         for idx in range(len(self.gt_depths)):
             gt_depth = self.read_depth_hr(self.gt_depths[idx], max_w=max_w, max_h=max_h)
             mask = self.read_mask_hr(self.masks[idx], max_w=max_w, max_h=max_h)
-            est_depth = np.array(read_pfm(self.est_depths[idx])[0], dtype=np.float32)
+            est_depth = read_pfm(self.est_depths[idx], mmap=True, contiguous=True)[0]
 
             eval_metrics = {"MAE": float(np.mean(np.abs(est_depth - gt_depth)[(mask > 0.5)])),
                             "RMSE": float(np.sqrt(np.mean(((est_depth - gt_depth)**2)[(mask > 0.5)]))),
@@ -0,0 +1,128 @@
+"""
+Export CDSMVSNet to ONNX for ONNX Runtime and check it against PyTorch on a synthetic scene.
+
+    python export_onnx.py --config configs/config_dtu.json --resume model.pth --output cdsmvsnet.onnx --num_view 5 --check
+
+The graph is traced through CDSMVSNetInference: inputs imgs (B, V, 3, H, W), proj_stage1..3 (B, V, 2, 4, 4)
+and depth_values (B, D); outputs the refined depth (B, H, W) and the photometric confidence of the three
+stages. Batch, height, width and the number of depth hypotheses are dynamic. The loop over source views is
+unrolled by the tracer, so the view count is fixed per file (stored as "num_view" in the model metadata);
+export one file per view count. Needs torch >= 1.12 (grid_sample is opset 16) and runs the camera matrix
+inversions through the com.microsoft Inverse op of ONNX Runtime.
+"""
+import argparse
+import inspect
+import sys
+
+import numpy as np
+import torch
+from torch.onnx import symbolic_helper
+
+import models.model as module_arch
+from utils import synthetic_scene
+
+parser = argparse.ArgumentParser(description='Export CDSMVSNet to ONNX')
+parser.add_argument('--config', default='configs/config_dtu.json', help='config with the arch args of the model')
+parser.add_argument('--resume', default=None, help='checkpoint to export, random weights if not given')
+parser.add_argument('--output', default='cdsmvsnet.onnx', help='onnx file')
+parser.add_argument('--num_view', type=int, default=5, help='number of views, fixed in the exported graph')
+parser.add_argument('--height', type=int, default=512, help='image height used for tracing')
+parser.add_argument('--width', type=int, default=640, help='image width used for tracing')
+parser.add_argument('--numdepth', type=int, default=192, help='depth hypotheses used for tracing')
+parser.add_argument('--temperature', type=float, default=0.01, help='temperature of softmax')
+parser.add_argument('--no_refinement', action="store_true", help='depth refinement in last stage')
+parser.add_argument('--opset', type=int, default=17)
+parser.add_argument('--check', action='store_true', help='compare onnxruntime with pytorch after the export')
+parser.add_argument('--check_sizes', nargs='+', default=None,
+                    help='image sizes HxW of the check, by default the tracing shape and one with a larger image, '
+                         'batch 2 and half the depth hypotheses')
+
+# the symbolics below are for the TorchScript exporter, newer torch defaults to the dynamo one
+EXPORT_KWARGS = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+INPUT_NAMES = ['imgs', 'proj_stage1', 'proj_stage2', 'proj_stage3', 'depth_values']
+OUTPUT_NAMES = ['depth', 'conf_stage1', 'conf_stage2', 'conf_stage3']
+DYNAMIC_AXES = {
+    'imgs': {0: 'batch', 3: 'height', 4: 'width'},
+    'proj_stage1': {0: 'batch'},
+    'proj_stage2': {0: 'batch'},
+    'proj_stage3': {0: 'batch'},
+    'depth_values': {0: 'batch', 1: 'num_depth'},
+    'depth': {0: 'batch', 1: 'height', 2: 'width'},
+    'conf_stage1': {0: 'batch', 1: 'height_stage1', 2: 'width_stage1'},
+    'conf_stage2': {0: 'batch', 1: 'height_stage2', 2: 'width_stage2'},
+    'conf_stage3': {0: 'batch', 1: 'height_stage3', 2: 'width_stage3'},
+}
+
+
+def inverse(g, x):
+    # 3x3 and 4x4 camera matrices, ONNX itself has no matrix inverse
+    return g.op('com.microsoft::Inverse', x).setType(x.type())
+
+
+@symbolic_helper.parse_args('v', 'v', 'v', 'v', 'v', 'b', 'f', 'f', 'b')
+def instance_norm(g, input, weight, bias, running_mean, running_var, use_input_stats, momentum, eps, cudnn_enabled):
+    # the default symbolic needs a static channel count for the unit scale of a non-affine InstanceNorm2d,
+    # which the traced shapes lose once height and width are dynamic
+    channels = g.op('Gather', g.op('Shape', input), g.op('Constant', value_t=torch.tensor([1])))
+    if weight.node().mustBeNone():
+        weight = g.op('ConstantOfShape', channels, value_t=torch.tensor([1.0]))
+    if bias.node().mustBeNone():
+        bias = g.op('ConstantOfShape', channels, value_t=torch.tensor([0.0]))
+    return g.op('InstanceNormalization', input, weight, bias, epsilon_f=eps)
+
+
+def register_symbolics(opset):
+    torch.onnx.register_custom_op_symbolic('aten::inverse', inverse, opset)
+    torch.onnx.register_custom_op_symbolic('aten::linalg_inv', inverse, opset)
+    torch.onnx.register_custom_op_symbolic('aten::instance_norm', instance_norm, opset)
+
+
+def export(net, args):
+    register_symbolics(args.opset)
+    inputs = synthetic_scene(args.height, args.width, args.num_view, args.numdepth)
+    with torch.no_grad():
+        torch.onnx.export(net, tuple(inputs), args.output, input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                          dynamic_axes=DYNAMIC_AXES, opset_version=args.opset, do_constant_folding=True, **EXPORT_KWARGS)
+    try:
+        import onnx
+    except ImportError:
+        return
+    model = onnx.load(args.output)
+    meta = model.metadata_props.add()
+    meta.key, meta.value = 'num_view', str(args.num_view)
+    onnx.save(model, args.output)
+
+
+def check(net, args):
+    """run the exported graph with onnxruntime and pytorch on synthetic scenes, False if any output differs"""
+    import onnxruntime as ort
+
+    session = ort.InferenceSession(args.output, providers=['CPUExecutionProvider'])
+    if args.check_sizes is None:
+        # the tracing shape, then every dynamic axis changed at once
+        cases = [(args.height, args.width, 1, args.numdepth), (args.height + 64, args.width + 128, 2, args.numdepth // 2)]
+    else:
+        cases = [[int(x) for x in size.split('x')] + [1, args.numdepth] for size in args.check_sizes]
+    passed = True
+    for height, width, batch_size, num_depth in cases:
+        size = '{}x{}x{}x{}'.format(batch_size, num_depth, height, width)
+        inputs = synthetic_scene(height, width, args.num_view, num_depth, batch_size=batch_size)
+        with torch.no_grad():
+            expected = [o.numpy() for o in net(*inputs)]
+        outputs = session.run(OUTPUT_NAMES, {name: x.numpy() for name, x in zip(INPUT_NAMES, inputs)})
+        for name, e, o in zip(OUTPUT_NAMES, expected, outputs):
+            # depths are compared relatively, confidences in [0, 1] absolutely
+            ok = e.shape == o.shape and np.allclose(o, e, rtol=1e-3, atol=1e-3)
+            passed = passed and ok
+            print('{} {}: shape {}, max abs diff {:.6f}, {}'.format(size, name, o.shape, np.abs(o - e).max(),
+                                                                    'ok' if ok else 'MISMATCH'))
+    return passed
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    net = module_arch.build_model(args.config, args.resume, args.no_refinement, args.temperature)
+    export(net, args)
+    print('saved', args.output)
+    if args.check and not check(net, args):
+        sys.exit(1)
@@ -4,9 +4,9 @@ import torch.nn.functional as F
 from typing import List
 
 
-def get_pixel_grids(height, width):
-    x_coord = (torch.arange(width, dtype=torch.float32).cuda() + 0.5).repeat(height, 1)
-    y_coord = (torch.arange(height, dtype=torch.float32).cuda() + 0.5).repeat(width, 1).t()
+def get_pixel_grids(height, width, device='cuda'):
+    x_coord = (torch.arange(width, dtype=torch.float32, device=device) + 0.5).repeat(height, 1)
+    y_coord = (torch.arange(height, dtype=torch.float32, device=device) + 0.5).repeat(width, 1).t()
     ones = torch.ones_like(x_coord)
     indices_grid = torch.stack([x_coord, y_coord, ones], dim=-1).unsqueeze(-1)  # hw31
     return indices_grid
@@ -49,7 +49,7 @@ def idx_cam2img(idx_cam_homo, cam):  # nhw41 -> nhw31
 def project_img(src_img, dst_depth, src_cam, dst_cam, height=None, width=None):  # nchw, n1hw -> nchw, n1hw
     if height is None: height = src_img.size()[-2]
     if width is None: width = src_img.size()[-1]
-    dst_idx_img_homo = get_pixel_grids(height, width).unsqueeze(0)  # nhw31
+    dst_idx_img_homo = get_pixel_grids(height, width, device=dst_depth.device).unsqueeze(0)  # nhw31
     dst_idx_cam_homo = idx_img2cam(dst_idx_img_homo, dst_depth, dst_cam)  # nhw41
     dst_idx_world_homo = idx_cam2world(dst_idx_cam_homo, dst_cam)  # nhw41
     dst2src_idx_cam_homo = idx_world2cam(dst_idx_world_homo, src_cam)  # nhw41
@@ -65,13 +65,20 @@ def project_img(src_img, dst_depth, src_cam, dst_cam, height=None, width=None):
     return warped_img, in_range
 
 
-def prob_filter(ref_prob, prob_thresh, greater=True):  # n31hw -> n1hw
+def prob_filter(ref_prob, prob_thresh, greater=True, shape=None):  # n3hw or [n1hw per stage] -> n1hw
+    # per-stage confidence is thresholded at its native resolution, only the mask is upsampled to shape
     mask = None
     for i, p in enumerate(prob_thresh):
+        if isinstance(ref_prob, (list, tuple)):
+            stage_mask = ref_prob[i] > p
+            if shape is not None and tuple(stage_mask.shape[-2:]) != tuple(shape):
+                stage_mask = F.interpolate(stage_mask.float(), size=tuple(shape), mode='nearest') > 0.5
+        else:
+            stage_mask = ref_prob[:, [i]] > p
         if mask is None:
-            mask = (ref_prob[:, [i]] > p)
+            mask = stage_mask
         else:
-            mask = mask & (ref_prob[:, [i]] > p)
+            mask = mask & stage_mask
     #mask = ref_prob > prob_thresh if greater else ref_prob < prob_thresh
     return mask
 
@@ -82,7 +89,7 @@ def get_reproj(ref_depth, srcs_depth, ref_cam, srcs_cam):  # n1hw, nv1hw -> n1hw
     srcs_cam_f = srcs_cam.view(n * v, 2, 4, 4)
     ref_depth_r = ref_depth.unsqueeze(1).repeat(1, v, 1, 1, 1).view(n * v, 1, h, w)
     ref_cam_r = ref_cam.unsqueeze(1).repeat(1, v, 1, 1, 1).view(n * v, 2, 4, 4)
-    idx_img = get_pixel_grids(h, w).unsqueeze(0)  # 1hw31
+    idx_img = get_pixel_grids(h, w, device=ref_depth.device).unsqueeze(0)  # 1hw31
 
     srcs_idx_cam = idx_img2cam(idx_img, srcs_depth_f, srcs_cam_f)  # Nhw41
     srcs_idx_world = idx_cam2world(srcs_idx_cam, srcs_cam_f)  # Nhw41
@@ -99,7 +106,7 @@ def get_reproj(ref_depth, srcs_depth, ref_cam, srcs_cam):  # n1hw, nv1hw -> n1hw
 
 def vis_filter(ref_depth, reproj_xyd, in_range, img_dist_thresh, depth_thresh, vthresh):
     n, v, _, h, w = reproj_xyd.size()
-    xy = get_pixel_grids(h, w).permute(3, 2, 0, 1).unsqueeze(1)[:, :, :2]  # 112hw
+    xy = get_pixel_grids(h, w, device=ref_depth.device).permute(3, 2, 0, 1).unsqueeze(1)[:, :, :2]  # 112hw
     dist_masks = (reproj_xyd[:, :, :2, :, :] - xy).norm(dim=2, keepdim=True) < img_dist_thresh  # nv1hw
     depth_masks = (ref_depth.unsqueeze(1) - reproj_xyd[:, :, 2:, :, :]).abs() < (
                 torch.max(ref_depth.unsqueeze(1), reproj_xyd[:, :, 2:, :, :]) * depth_thresh)  # nv1hw
@@ -112,3 +119,39 @@ def vis_filter(ref_depth, reproj_xyd, in_range, img_dist_thresh, depth_thresh, v
 def ave_fusion(ref_depth, reproj_xyd, masks):
     ave = ((reproj_xyd[:, :, 2:, :, :] * masks).sum(dim=1) + ref_depth) / (masks.sum(dim=1) + 1)  # n1hw
     return ave
+
+
+def disp_filter(ref_depth, reproj_xyd, in_range, ref_cam, disp_thresh, baseline=0.54):  # n1hw, nv3hw -> nv1hw
+    # fusibile compares depths in disparity space, disp = f * baseline / depth
+    focal = ref_cam[:, 1, 0, 0].view(-1, 1, 1, 1, 1)
+    reproj_depth = reproj_xyd[:, :, 2:, :, :]
+    valid = (ref_depth.unsqueeze(1) > 0) & (reproj_depth > 0)
+    ref_disp = focal * baseline / ref_depth.unsqueeze(1).clamp(min=1e-9)
+    reproj_disp = focal * baseline / reproj_depth.clamp(min=1e-9)
+    disp_masks = valid & ((ref_disp - reproj_disp).abs() < disp_thresh)
+    masks = bin_op_reduce([in_range, disp_masks.to(ref_depth.dtype)], torch.min)  # nv1hw
+    return masks
+
+
+def consistency_fusion(ref_depth, srcs_depth, ref_cam, srcs_cam, disp_thresh, num_consistent, chunk_size=4):
+    """In-process replacement of the fusibile consistency check.
+
+    Every source view is reprojected onto the reference view, a pixel is kept when at least
+    `num_consistent` views agree within `disp_thresh`, and the kept depth is the average of
+    the reference depth and the consistent reprojected depths.
+    ref_depth: (n, 1, h, w), srcs_depth: (n, v, 1, h, w), ref_cam: (n, 2, 4, 4), srcs_cam: (n, v, 2, 4, 4)
+    """
+    depth_sum = ref_depth.clone()
+    count = torch.zeros_like(ref_depth)
+    # source views are processed in chunks to bound the n*v*h*w*4*4 reprojection buffers
+    for start in range(0, srcs_depth.size(1), chunk_size):
+        chunk_depth = srcs_depth[:, start:start + chunk_size]
+        chunk_cam = srcs_cam[:, start:start + chunk_size]
+        reproj_xyd, in_range = get_reproj(ref_depth, chunk_depth, ref_cam, chunk_cam)
+        masks = disp_filter(ref_depth, reproj_xyd, in_range, ref_cam, disp_thresh)
+        depth_sum += (reproj_xyd[:, :, 2:, :, :] * masks).sum(dim=1)
+        count += masks.sum(dim=1)
+        del reproj_xyd, in_range, masks
+    mask = (count >= num_consistent) & (ref_depth > 0)  # n1hw
+    ave = depth_sum / (count + 1)
+    return ave, mask
@@ -1,6 +1,9 @@
 import os, sys, shutil, gc
+import multiprocessing as mp
+from functools import partial
 from utils import *
-from datasets.data_io import read_pfm, save_pfm
+from datasets.data_io import read_pfm, save_pfm, DepthContainer, DEPTH_CONTAINER_NAME, read_confidence, confidence_mask
+import cv2
 from struct import *
 import numpy as np
 
@@ -58,7 +61,7 @@ def write_gipuma_dmb(path, image):
 def mvsnet_to_gipuma_dmb(in_path, out_path):
     '''convert mvsnet .pfm output to Gipuma .dmb format'''
 
-    image, _ = read_pfm(in_path)
+    image, _ = read_pfm(in_path, mmap=True)
     write_gipuma_dmb(out_path, image)
 
     return
@@ -68,6 +71,12 @@ def mvsnet_to_gipuma_cam(in_path, out_path):
     '''convert mvsnet camera to gipuma camera format'''
 
     intrinsic, extrinsic = read_camera_parameters(in_path)
+    write_gipuma_cam(out_path, intrinsic, extrinsic)
+
+
+def write_gipuma_cam(out_path, intrinsic, extrinsic):
+    '''write a gipuma .P projection matrix from intrinsic and extrinsic matrices'''
+
     intrinsic_new = np.zeros((4, 4))
     intrinsic_new[:3, :3] = intrinsic
 
@@ -150,6 +159,95 @@ def mvsnet_to_gipuma(dense_folder, gipuma_point_folder):
         fake_gipuma_normal(out_depth_dmb, fake_normal_dmb)
 
 
+def read_prob_map(dense_folder, image_prefix):
+    '''per-stage native resolution confidence if saved as .npz, otherwise the full resolution pfm'''
+
+    prob_map_path = os.path.join(dense_folder, "confidence", image_prefix + '.npz')
+    if os.path.isfile(prob_map_path):
+        return read_confidence(prob_map_path)
+    return read_pfm(os.path.join(dense_folder, "confidence", image_prefix + '.pfm'), mmap=True)[0]
+
+
+def link_image(in_image_file, out_image_file):
+    '''hardlink an image into the gipuma folder, falling back to a symlink and then to a copy'''
+
+    if os.path.lexists(out_image_file):
+        os.remove(out_image_file)
+    try:
+        os.link(in_image_file, out_image_file)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(in_image_file), out_image_file)
+        except OSError:
+            shutil.copy(in_image_file, out_image_file)
+
+
+def convert_view(image_name, dense_folder, gipuma_point_folder, prob_threshold, gipuma_prefix='2333__', container=None):
+    '''filter one view by probability and write its gipuma cam, image, depth and normals in a single pass'''
+
+    image_prefix = os.path.splitext(image_name)[0]
+    out_cam_file = os.path.join(gipuma_point_folder, 'cams', image_name + '.P')
+    out_image_file = os.path.join(gipuma_point_folder, 'images', image_name)
+
+    if container is not None:
+        # all inputs come from the scene container, the image is decoded once for fusibile
+        view_id = int(image_prefix)
+        cam = container.read_cam(view_id)
+        write_gipuma_cam(out_cam_file, cam[1, :3, :3], cam[0])
+        depth_map = container.read_depth(view_id)
+        prob_map = container.read_conf(view_id)
+        img = container.read_img(view_id, shape=depth_map.shape)
+        cv2.imwrite(out_image_file, cv2.cvtColor(np.uint8(np.clip(img * 255, 0, 255)), cv2.COLOR_RGB2BGR))
+    else:
+        # convert camera
+        in_cam_file = os.path.join(dense_folder, 'cams', image_prefix + '_cam.txt')
+        mvsnet_to_gipuma_cam(in_cam_file, out_cam_file)
+
+        # link image
+        link_image(os.path.join(dense_folder, 'images', image_name), out_image_file)
+
+        # read depth and confidence once, write filtered depth and fake normals directly
+        depth_map, _ = read_pfm(os.path.join(dense_folder, "depth_est", image_prefix + '.pfm'), mmap=True, contiguous=True)
+        prob_map = read_prob_map(dense_folder, image_prefix)
+
+    mask = confidence_mask(prob_map, prob_threshold, shape=depth_map.shape)
+    depth_map[~mask] = 0
+
+    sub_depth_folder = os.path.join(gipuma_point_folder, gipuma_prefix + image_prefix)
+    if not os.path.isdir(sub_depth_folder):
+        os.mkdir(sub_depth_folder)
+    write_gipuma_dmb(os.path.join(sub_depth_folder, 'disp.dmb'), depth_map)
+
+    normal_image = np.float32(depth_map > 0) / 1.732050808
+    normal_image = np.repeat(normal_image[:, :, np.newaxis], 3, axis=2)
+    write_gipuma_dmb(os.path.join(sub_depth_folder, 'normals.dmb'), normal_image)
+
+
+def mvsnet_to_gipuma_filtered(dense_folder, gipuma_point_folder, prob_threshold, num_workers=4):
+    '''single-pass replacement of probability_filter + mvsnet_to_gipuma, parallel across views'''
+
+    for folder in [gipuma_point_folder, os.path.join(gipuma_point_folder, 'cams'),
+                   os.path.join(gipuma_point_folder, 'images')]:
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+
+    container = os.path.join(dense_folder, DEPTH_CONTAINER_NAME)
+    if os.path.isfile(container):
+        container = DepthContainer(container)
+        image_names = ['{:0>8}.jpg'.format(view_id) for view_id in container.view_ids]
+    else:
+        container = None
+        image_names = os.listdir(os.path.join(dense_folder, 'images'))
+    func = partial(convert_view, dense_folder=dense_folder, gipuma_point_folder=gipuma_point_folder,
+                   prob_threshold=prob_threshold, container=container)
+    if num_workers > 1:
+        with mp.Pool(processes=num_workers) as p:
+            p.map(func, image_names)
+    else:
+        for image_name in image_names:
+            func(image_name)
+
+
 def probability_filter(dense_folder, prob_threshold):
     image_folder = os.path.join(dense_folder, 'images')
 
@@ -158,18 +256,12 @@ def probability_filter(dense_folder, prob_threshold):
     for image_name in image_names:
         image_prefix = os.path.splitext(image_name)[0]
         init_depth_map_path = os.path.join(dense_folder, "depth_est", image_prefix + '.pfm')
-        prob_map_path = os.path.join(dense_folder, "confidence", image_prefix + '.pfm')
         out_depth_map_path = os.path.join(dense_folder, "depth_est", image_prefix + '_prob_filtered.pfm')
 
         depth_map, _ = read_pfm(init_depth_map_path)
-        prob_map, _ = read_pfm(prob_map_path)
-
-        mask = None
-        for i, p in enumerate(prob_threshold):
-            if mask is None:
-                mask = (prob_map[:, :, i] > p)
-            else:
-                mask = mask & (prob_map[:, :, i] > p)
+        prob_map = read_prob_map(dense_folder, image_prefix)
+
+        mask = confidence_mask(prob_map, prob_threshold, shape=depth_map.shape)
         #depth_map[prob_map < prob_threshold] = 0
         depth_map[~mask] = 0
         save_pfm(out_depth_map_path, depth_map)
@@ -197,7 +289,7 @@ def depth_map_fusion(point_folder, fusibile_exe_path, disp_thresh, num_consisten
     return
 
 
-def gipuma_filter(testlist, outdir, prob_threshold, disp_threshold, num_consistent, fusibile_exe_path):
+def gipuma_filter(testlist, outdir, prob_threshold, disp_threshold, num_consistent, fusibile_exe_path, num_workers=4):
 
     for scan in testlist:
 
@@ -208,13 +300,9 @@ def gipuma_filter(testlist, outdir, prob_threshold, disp_threshold, num_consiste
         if not os.path.isdir(point_folder):
             os.mkdir(point_folder)
 
-        # probability filter
-        print('filter depth map with probability map')
-        probability_filter(dense_folder, prob_threshold)
-
-        # convert to gipuma format
-        print('Convert mvsnet output to gipuma input')
-        mvsnet_to_gipuma(dense_folder, point_folder)
+        # probability filter and convert to gipuma format
+        print('Filter depth map with probability map and convert mvsnet output to gipuma input')
+        mvsnet_to_gipuma_filtered(dense_folder, point_folder, prob_threshold, num_workers)
 
         # depth map fusion with gipuma
         print('Run depth map fusion & filter')
@@ -93,11 +93,19 @@ class DynamicConv(nn.Module):
         for p in self.att_convs.parameters():
             torch.nn.init.normal_(p, std=0.1)
 
-    def forward(self, feature_vol, epipole=None, temperature=0.001):
+    def responses(self, feature_vol):
+        """the part of forward that does not depend on the epipole: the curvature responses (3 per kernel)
+        and the filtered maps of every kernel size"""
+        raw_curvs = torch.cat([att_conv(feature_vol) for att_conv in self.att_convs], dim=1) # [B, 3 * num_kernels, H, W]
+        results = torch.stack([conv(feature_vol) for conv in self.convs], dim=1) # [B, num_kernels, C, H, W]
+        return raw_curvs, results
+
+    def forward(self, feature_vol, epipole=None, temperature=0.001, responses=None):
+        raw_curvs, results = self.responses(feature_vol) if responses is None else responses
         # surface = feature_vol.mean(dim=1, keepdim=True)
-        batch_size, height, width = feature_vol.shape[0], feature_vol.shape[2], feature_vol.shape[3]
-        y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=feature_vol.device),
-                               torch.arange(0, width, dtype=torch.float32, device=feature_vol.device)])
+        batch_size, height, width = raw_curvs.shape[0], raw_curvs.shape[2], raw_curvs.shape[3]
+        y, x = torch.meshgrid([torch.arange(0, height, dtype=torch.float32, device=raw_curvs.device),
+                               torch.arange(0, width, dtype=torch.float32, device=raw_curvs.device)])
         x, y = x.contiguous(), y.contiguous()
         # print("++++++++++++++++++++++++++++"+str(epipole)+"*****************************")
         epipole_map = epipole.unsqueeze(-1).unsqueeze(-1) # [B, 2, 1, 1]
@@ -107,17 +115,15 @@ class DynamicConv(nn.Module):
         u, v = u / (normed_uv + 1e-6), v / (normed_uv + 1e-6)
 
         curvs = []
-        results = []
-        for idx, s in enumerate(self.size_kernels):
-            curv = self.att_convs[idx](feature_vol)
-            curv = (curv * torch.cat((u**2, 2*u*v, v**2), dim=1)).sum(dim=1, keepdim=True)
+        uv = torch.cat((u**2, 2*u*v, v**2), dim=1)
+        for curv in torch.split(raw_curvs, 3, dim=1):
+            curv = (curv * uv).sum(dim=1, keepdim=True)
             # w = self.att_weights[idx](feature_vol)
             curvs.append(curv) #.unsqueeze(1))
-            results.append(self.convs[idx](feature_vol).unsqueeze(1))
         curvs = torch.cat(curvs, dim=1) # [B, num_kernels, H, W]
         weights = self.att_weights(curvs)
         weights = F.softmax(weights / temperature, dim=1)
-        filtered_result = (torch.cat(results, dim=1) * weights.unsqueeze(2)).sum(dim=1)
+        filtered_result = (results * weights.unsqueeze(2)).sum(dim=1)
         norm_curv = (curvs * weights).sum(dim=1, keepdim=True)
         return filtered_result, norm_curv #, sum_mask, t11, t12, t13
 
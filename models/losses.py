@@ -3,6 +3,18 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def masked_mean(values, mask, count=None):
+    """
+    mean of values over the pixels where mask is 1, computed densely: values[mask].mean() needs a
+    nonzero and a gather with a data-dependent size, which syncs with the device.
+    :param mask: 0/1 float tensor broadcastable to values
+    :param count: number of selected elements of values, mask.sum() if the mask is not broadcast
+    """
+    if count is None:
+        count = mask.sum()
+    return (values * mask).sum() / count
+
+
 def final_loss(inputs, refine_depth_map,depth_gt_ms, mask_ms, **kwargs):
     depth_loss_weights = kwargs.get("dlossw", None)
     depth_interval_value = kwargs.get("depth_interval", 1.0)
@@ -17,28 +29,31 @@ def final_loss(inputs, refine_depth_map,depth_gt_ms, mask_ms, **kwargs):
         depth_est = stage_inputs["depth"] / depth_interval
         depth_gt = depth_gt_ms[stage_key] / depth_interval
         mask = mask_ms[stage_key]
-        mask = mask > 0.5
+        mask = (mask > 0.5).to(depth_est.dtype)
+        num_pixels = mask.sum()
 
-        depth_loss = F.smooth_l1_loss(depth_est[mask], depth_gt[mask], reduction='mean')
+        depth_loss = masked_mean(F.smooth_l1_loss(depth_est, depth_gt, reduction='none'), mask, num_pixels)
 
         if stage_key == "stage1":
             stage_idx1 = int(stage_key.replace("stage", "")) - 1
-            refine_depth_maps=refine_depth_map[stage_idx1][mask] / depth_interval_value[0]
-            depth_loss_ddr = F.smooth_l1_loss(refine_depth_maps, depth_gt[mask], reduction='mean')
+            refine_depth_maps=refine_depth_map[stage_idx1] / depth_interval_value[0]
+            depth_loss_ddr = masked_mean(F.smooth_l1_loss(refine_depth_maps, depth_gt, reduction='none'), mask, num_pixels)
             total_loss += 1.4 * depth_loss_ddr
-        norm_curv_reg = torch.mean(stage_inputs["norm_curv"].squeeze(1)[mask])
+        norm_curv_reg = masked_mean(stage_inputs["norm_curv"].squeeze(1), mask, num_pixels)
 
         feat_loss = 0.0
         if "feat_distance" in stage_inputs:
             feat_dis = stage_inputs["feat_distance"]
             target = stage_inputs["feat_target"]
             ndepths = target.size(1)
-            mask = mask.unsqueeze(1).repeat(1, ndepths, 1, 1)
-            pos_pixels = target[mask].sum()
-            neg_pixels = torch.numel(target[mask]) - pos_pixels
+            # the pixel mask is broadcast over the depth hypotheses
+            mask = mask.unsqueeze(1)
+            num_samples = num_pixels * ndepths
+            pos_pixels = (target * mask).sum()
+            neg_pixels = num_samples - pos_pixels
             balanced_weight = neg_pixels / pos_pixels
-            feat_loss = F.binary_cross_entropy_with_logits(feat_dis[mask], target[mask], reduction='mean',
-                                                           pos_weight=balanced_weight)
+            feat_loss = masked_mean(F.binary_cross_entropy_with_logits(feat_dis, target, reduction='none',
+                                                                       pos_weight=balanced_weight), mask, num_samples)
         if depth_loss_weights is not None:
             stage_idx = int(stage_key.replace("stage", "")) - 1
             total_loss = total_loss + depth_loss_weights[stage_idx] * (depth_loss + 5 * feat_loss + 0.1*norm_curv_reg)
@@ -48,8 +63,8 @@ def final_loss(inputs, refine_depth_map,depth_gt_ms, mask_ms, **kwargs):
     if "refined_depth" in inputs:
         depth_gt = depth_gt_ms["stage4"] / depth_interval
         depth_est = inputs["refined_depth"] / depth_interval
-        mask = mask_ms["stage4"] > 0.5
-        depth_loss = F.smooth_l1_loss(depth_est[mask], depth_gt[mask], reduction='mean')
+        mask = (mask_ms["stage4"] > 0.5).to(depth_est.dtype)
+        depth_loss = masked_mean(F.smooth_l1_loss(depth_est, depth_gt, reduction='none'), mask)
         total_loss = total_loss + 2*depth_loss
 
     return total_loss, depth_loss
\ No newline at end of file
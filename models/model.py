@@ -1,10 +1,13 @@
+import json
+
 import numpy
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from models.module import depth_regression, conf_regression, FeatureNet, CostRegNet, Refinement, \
-    get_depth_range_samples, ConvBnReLU, winner_take_all, unity_regression, REM, Loss_strategy
+    get_depth_range_samples, ConvBnReLU, winner_take_all, unity_head, REM, Loss_strategy, fuse_bn, \
+    channels_last_3d
 from models.utils.warping import homo_warping_3D
 from models.dynamic_conv import compute_Fmatrix, compute_epipole
 
@@ -16,7 +19,7 @@ class DepthNet(nn.Module):
         self.mode = mode
         assert self.mode in ("regression", "classification", "unification"), "Don't support {}!".format(mode)
 
-    def forward(self, cost_reg, depth_values, num_depth, interval, prob_volume_init=None):
+    def forward(self, cost_reg, depth_values, num_depth, interval, prob_volume_init=None, return_prob_volume=True):
         prob_volume_pre = cost_reg.squeeze(1)  # (b, d, h, w)
 
         if prob_volume_init is not None:
@@ -39,12 +42,12 @@ class DepthNet(nn.Module):
             photometric_confidence, _ = torch.max(prob_volume, dim=1)
         elif self.mode == "unification":
             # print("unification")
-            prob_volume = F.softmax(prob_volume_pre, dim=1)  # (b, ndepth, h, w)
-            depth = unity_regression(prob_volume, depth_values, interval)
-            photometric_confidence, _ = torch.max(F.softmax(prob_volume_pre, dim=1), dim=1)
+            depth, photometric_confidence, prob_volume = unity_head(prob_volume_pre, depth_values, interval)
             # photometric_confidence = torch.max(prob_volume, dim=1)[0] / torch.sum(prob_volume, dim=1)
         else:
             raise NotImplementedError("Don't support {}!".format(self.mode))
+        if not return_prob_volume:
+            prob_volume = None
 
         return {"depth": depth, "photometric_confidence": photometric_confidence, "prob_volume": prob_volume,
                 "depth_values": depth_values, "interval": interval}
@@ -235,8 +238,9 @@ class StageNet_Stage3(nn.Module):
 
         # prob_volume = F.softmax(prob_volume_pre, dim=1)
         # depth = depth_regression(prob_volume, depth_values=depth_values)
+        # nothing reads the probability volume of the last stage outside training
         outputs_stage = self.DepthNet(cost_reg, depth_values, num_depth=self.ndepths[stage_idx],
-                                      interval=interval)
+                                      interval=interval, return_prob_volume=self.training)
         depth=outputs_stage['depth']
         photometric_confidence = outputs_stage['photometric_confidence']
         prob_volume=outputs_stage['prob_volume']
@@ -252,7 +256,8 @@ class StageNet_Stage3(nn.Module):
 
 class CDSMVSNet(nn.Module):
     def __init__(self, refine=False, ndepths=(48, 32, 8), depth_interals_ratio=(4, 2, 1), share_cr=False,
-                 grad_method="detach", arch_mode="fpn", cr_base_chs=(8, 8, 8)):
+                 grad_method="detach", arch_mode="fpn", cr_base_chs=(8, 8, 8), checkpoint_feature=False,
+                 checkpoint_cost_reg=False, stage1_sampling="uniform"):
         super(CDSMVSNet, self).__init__()
         self.refine = refine
         self.share_cr = share_cr
@@ -262,6 +267,9 @@ class CDSMVSNet(nn.Module):
         self.arch_mode = arch_mode
         self.cr_base_chs = cr_base_chs
         self.num_stage = len(ndepths)
+        # spacing of the stage 1 hypotheses over the depth range of the image, "uniform" or "inverse" depth
+        self.stage1_sampling = stage1_sampling
+        assert stage1_sampling in ("uniform", "inverse"), "Don't support {}!".format(stage1_sampling)
 
         print("**********netphs:{}, depth_intervals_ratio:{},  grad:{}, chs:{}************".format(ndepths,
               depth_interals_ratio, self.grad_method, self.cr_base_chs))
@@ -295,7 +303,20 @@ class CDSMVSNet(nn.Module):
             #self.depth_params += list(self.refine_network.parameters())
         self.StageNet_Stage3 = StageNet_Stage3()
 
-    def forward(self, imgs, proj_matrices, depth_values, gt_depths=None, temperature=0.001):
+        # activation checkpointing trades recomputation for training memory,
+        # checkpoint_cost_reg is either one flag or one flag per stage
+        self.feature.checkpoint = checkpoint_feature
+        if isinstance(checkpoint_cost_reg, bool):
+            checkpoint_cost_reg = [checkpoint_cost_reg] * self.num_stage
+        assert len(checkpoint_cost_reg) == self.num_stage
+        if self.share_cr:
+            self.cost_regularization.checkpoint = any(checkpoint_cost_reg)
+        else:
+            for cost_reg, flag in zip(self.cost_regularization, checkpoint_cost_reg):
+                cost_reg.checkpoint = flag
+
+    def forward(self, imgs, proj_matrices, depth_values, gt_depths=None, temperature=0.001, loss_strategy=True,
+                view_ids=None, feature_cache=None):
         depth_min = depth_values[:, [0]].unsqueeze(-1).unsqueeze(-1) #float(depth_values[0, 0].cpu().numpy())
         depth_max = depth_values[:, [-1]].unsqueeze(-1).unsqueeze(-1) #float(depth_values[0, -1].cpu().numpy())
         depth_interval = (depth_values[:, 1] - depth_values[:, 0]).unsqueeze(-1).unsqueeze(-1) #(depth_max - depth_min) / depth_values.size(1)
@@ -306,16 +327,26 @@ class CDSMVSNet(nn.Module):
         # step 1. feature extraction
         features = []
         list_imgs = torch.unbind(imgs, dim=1)
-        ref_img, src_imgs = list_imgs[0], list_imgs[1:]
+        ref_img = list_imgs[0]
+        list_imgs = [F.interpolate(img, (height, width)) for img in list_imgs]
+        # the epipole independent part of the features is computed once per view instead of once per pair, the
+        # reference view is in every pair; with a feature cache (B, N) view_ids also share it across calls
+        if self.feature.checkpoint and self.training and torch.is_grad_enabled():
+            trunks = [None] * nviews  # recomputed inside the checkpointed level
+        elif feature_cache is not None:
+            trunks = [feature_cache.trunk(self.feature, img, [ids[v] for ids in view_ids])
+                      for v, img in enumerate(list_imgs)]
+        else:
+            trunks = [self.feature.trunk(img) for img in list_imgs]
         cam_params = torch.unbind(proj_matrices["stage3"], dim=1)
         ref_proj, src_projs = cam_params[0], cam_params[1:]
-        for src_img, src_proj in zip(src_imgs, src_projs):  #imgs shape (B, N, C, H, W)
+        for v, src_proj in enumerate(src_projs, 1):  #imgs shape (B, N, C, H, W)
             # compute epipoles
             fundamental_matrix = compute_Fmatrix(ref_proj, src_proj)
             ref_epipole = compute_epipole(fundamental_matrix)
             src_epipole = compute_epipole(torch.transpose(fundamental_matrix, 1, 2))
-            ref_feat = self.feature(F.interpolate(ref_img, (height, width)), epipole=ref_epipole, temperature=temperature)
-            src_feat = self.feature(F.interpolate(src_img, (height, width)), epipole=src_epipole, temperature=temperature)
+            ref_feat = self.feature(list_imgs[0], epipole=ref_epipole, temperature=temperature, trunk=trunks[0])
+            src_feat = self.feature(list_imgs[v], epipole=src_epipole, temperature=temperature, trunk=trunks[v])
             features.append({"ref": ref_feat, "src": src_feat})
 
         outputs = {}
@@ -343,7 +374,7 @@ class CDSMVSNet(nn.Module):
                     cur_depth = depth.detach()
                 else:
                     cur_depth = depth
-            if (stage_idx == 1): #一阶段要计算损失策略
+            if (stage_idx == 1) and loss_strategy: #一阶段要计算损失策略
                 depth_range_samples, depth_min, depth_max, interval = get_depth_range_samples(cur_depth=cur_depth,
                                                                         ndepth=self.ndepths[stage_idx],
                                                                         depth_inteval_pixel=self.depth_interals_ratio[stage_idx] * depth_interval,
@@ -379,15 +410,14 @@ class CDSMVSNet(nn.Module):
                                                                                               stage_idx] * depth_interval,
                                                                                           dtype=imgs[0].dtype,
                                                                                           device=imgs[0].device,
-                                                                                          shape=[imgs.shape[0], height,
-                                                                                                 width],
+                                                                                          shape=[batch_size, cur_h, cur_w],
                                                                                           uncertainty_map=uncertainty_map,
                                                                                           min_depth=min_depth,
-                                                                                          max_depth=max_depth)
-            depth_samples = F.interpolate(depth_range_samples.unsqueeze(1),
-                                          [self.ndepths[stage_idx], height // int(stage_scale),
-                                           width // int(stage_scale)], mode='trilinear',
-                                          align_corners=Align_Corners_Range).squeeze(1)
+                                                                                          max_depth=max_depth,
+                                                                                          sampling=self.stage1_sampling)
+            # the hypotheses are generated at the stage resolution from the resized depth and uncertainty maps, the
+            # per image hypotheses of stage 1 stay (B, D, 1, 1) and are broadcast over the pixels
+            depth_samples = depth_range_samples
             if (stage_idx !=2):
                 outputs_stage = self.stage_net(features_stage, proj_matrices_stage,
                                                depth_values=depth_samples,
@@ -407,7 +437,10 @@ class CDSMVSNet(nn.Module):
                                                gt_depth=gt_depth_stage, stage_idx=stage_idx)
 
             depth = outputs_stage['depth']
-            prob_volume = outputs_stage['prob_volume']
+            # outside training only the loss strategy of stage 2 reads a probability volume, the outputs drop it
+            prob_volume = outputs_stage['prob_volume'] if self.training else outputs_stage.pop('prob_volume')
+            if not (loss_strategy and stage_idx == 0):
+                prob_volume = None
             depth_values_last = outputs_stage['depth_values']
             uncertainty_map=outputs_stage['uncertaintyMap']
             if gt_depths is not None:
@@ -435,6 +468,57 @@ class CDSMVSNet(nn.Module):
         return outputs,refine_depth_map
 
 
+class CDSMVSNetInference(nn.Module):
+    """
+    Inference entry of CDSMVSNet for graph capture (torch.compile, torch.jit.trace): fixed-shape tensors in,
+    tensors out, no host syncs and none of the outputs that only the training loss needs.
+    With a FeatureCache the view ids of the images are passed too, the cache lookups are not captured.
+    fold_bn folds the BatchNorms into the convolutions and channels_last runs the cost regularization in the
+    channels_last_3d layout, both change the wrapped model in place.
+    """
+    def __init__(self, model, temperature=0.01, feature_cache=None, fold_bn=False, channels_last=False):
+        super(CDSMVSNetInference, self).__init__()
+        self.model = model
+        self.temperature = temperature
+        self.feature_cache = feature_cache
+        self.eval()
+        if fold_bn:
+            fuse_bn(model)
+        if channels_last:
+            channels_last_3d(model)
+
+    def forward(self, imgs, proj_stage1, proj_stage2, proj_stage3, depth_values, view_ids=None):
+        """
+        :param imgs: (B, V, 3, H, W)
+        :param proj_stage1, proj_stage2, proj_stage3: (B, V, 2, 4, 4) projection matrices of the stages
+        :param depth_values: (B, D) depth hypotheses of the first stage
+        :param view_ids: (B, V) hashable ids of the images, needed with a feature cache
+        :return: refined depth (B, H, W), photometric confidence of stage 1, 2 and 3 at their own resolutions
+        """
+        proj_matrices = {"stage1": proj_stage1, "stage2": proj_stage2, "stage3": proj_stage3}
+        feature_cache = self.feature_cache if view_ids is not None else None
+        outputs, _ = self.model(imgs, proj_matrices, depth_values, temperature=self.temperature, loss_strategy=False,
+                                view_ids=view_ids, feature_cache=feature_cache)
+        return outputs["refined_depth"], outputs["stage1"]["photometric_confidence"], \
+            outputs["stage2"]["photometric_confidence"], outputs["stage3"]["photometric_confidence"]
+
+
+
+def build_model(config, resume=None, no_refinement=False, temperature=0.01):
+    """CDSMVSNetInference with the arch args of a training config file and the weights of a checkpoint, random
+    weights without one"""
+    with open(config) as f:
+        arch_args = json.load(f)["arch"]["args"]
+    if no_refinement:
+        arch_args["refine"] = False
+    model = CDSMVSNet(**arch_args)
+    if resume is not None:
+        print('Loading checkpoint: {} ...'.format(resume))
+        state_dict = torch.load(resume, map_location='cpu')['state_dict']
+        model.load_state_dict({k.replace('module.', ''): v for k, v in state_dict.items()}, strict=False)
+    return CDSMVSNetInference(model, temperature=temperature)
+
+
 if __name__ == '__main__':
     model = CDSMVSNet()
     model = model.to(torch.device('cuda'))
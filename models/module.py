@@ -2,6 +2,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as init
+from torch.utils.checkpoint import checkpoint
+import inspect
+import collections
+from functools import partial
 import time
 import sys
 sys.path.append("..")
@@ -26,6 +30,91 @@ def init_uniform(module, init_method):
     return
 
 
+# torch < 1.11 only has reentrant checkpointing, which needs an input requiring grad to backprop into the parameters
+_NON_REENTRANT = 'use_reentrant' in inspect.signature(checkpoint).parameters
+
+
+def checkpoint_forward(function, *args, module=None):
+    """Run function(*args) with activation checkpointing: only args are kept for backward and the
+    activations inside function are recomputed. The recomputation updates copies of the BatchNorm running
+    statistics of module (the module function belongs to) that are dropped after it, so the statistics are
+    updated once per step as without checkpointing."""
+    calls = [0]
+
+    def run(*inputs):
+        calls[0] += 1
+        if calls[0] == 1 or module is None:
+            return function(*inputs)
+        # the recomputation updates copies of the buffers, the originals may be saved for backward and stay
+        batch_norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        buffers = [(m, name, getattr(m, name)) for m in batch_norms
+                   for name in ('running_mean', 'running_var', 'num_batches_tracked') if getattr(m, name) is not None]
+        for m, name, buffer in buffers:
+            setattr(m, name, buffer.clone())
+        # newer torch stops the recomputation early with an exception once the saved tensors are recomputed
+        try:
+            return function(*inputs)
+        finally:
+            for m, name, buffer in buffers:
+                setattr(m, name, buffer)
+
+    if _NON_REENTRANT:
+        return checkpoint(run, *args, use_reentrant=False)
+    dummy = torch.ones(1, requires_grad=True)
+    return checkpoint(lambda _, *inputs: run(*inputs), dummy, *args)
+
+
+def run_forward(function, *args):
+    return function(*args)
+
+
+def fold_bn(conv, bn):
+    """Fold the running statistics and the affine parameters of a BatchNorm into the weights and bias of the
+    convolution before it, for inference only."""
+    scale = bn.weight * torch.rsqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    # the output channels are dim 0 of a convolution weight and dim 1 of a transposed convolution weight
+    shape = [1, -1] if isinstance(conv, nn.modules.conv._ConvTransposeNd) else [-1, 1]
+    shape += [1] * (conv.weight.dim() - 2)
+    conv.weight = nn.Parameter((conv.weight * scale.view(shape)).detach())
+    conv.bias = nn.Parameter(((bias - bn.running_mean) * scale + bn.bias).detach())
+
+
+def fuse_bn(model):
+    """Fold every BatchNorm of Conv3d, Deconv3d, ConvBnReLU, Refinement and of a convolution followed by a
+    BatchNorm in an nn.Sequential into the convolution, the BatchNorm is removed. The InstanceNorm of Conv2d
+    depends on the input and stays. Returns the number of BatchNorms folded."""
+    assert not model.training, "BatchNorm is folded with its running statistics, call eval() first"
+    folded = 0
+    for module in model.modules():
+        if isinstance(module, nn.Sequential):
+            for i in range(1, len(module)):
+                if isinstance(module[i], nn.modules.batchnorm._BatchNorm) and \
+                        isinstance(module[i - 1], nn.modules.conv._ConvNd):
+                    fold_bn(module[i - 1], module[i])
+                    module[i] = nn.Identity()
+                    folded += 1
+            continue
+        if isinstance(module, (Conv3d, Deconv3d, ConvBnReLU)) and isinstance(module.bn, nn.modules.batchnorm._BatchNorm):
+            fold_bn(module.conv, module.bn)
+        elif isinstance(module, Refinement) and module.bn is not None:
+            fold_bn(module.deconv, module.bn)
+        else:
+            continue
+        module.bn = None
+        folded += 1
+    return folded
+
+
+def channels_last_3d(model):
+    """Run every CostRegNet in model in the channels_last_3d layout and convert the 3D convolution weights"""
+    for module in model.modules():
+        if isinstance(module, CostRegNet):
+            module.channels_last = True
+        elif isinstance(module, (nn.Conv3d, nn.ConvTranspose3d)):
+            module.weight.data = module.weight.data.contiguous(memory_format=torch.channels_last_3d)
+
+
 class Conv2d(nn.Module):
     """Applies a 2D convolution (optionally with batch normalization and relu activation)
     over an input signal composed of several input planes.
@@ -57,10 +146,10 @@ class Conv2d(nn.Module):
         # assert init_method in ["kaiming", "xavier"]
         # self.init_weights(init_method)
 
-    def forward(self, x, epipole=None, temperature=0.001):
+    def forward(self, x, epipole=None, temperature=0.001, responses=None):
         if self.dynamic:
             #feat, epipole, temperature = x
-            y, norm_curv = self.conv(x, epipole=epipole, temperature=temperature)
+            y, norm_curv = self.conv(x, epipole=epipole, temperature=temperature, responses=responses)
         else:
             y = self.conv(x)
         # y = self.conv(x)
@@ -196,7 +285,10 @@ class ConvBnReLU(nn.Module):
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """forward method"""
-        return F.relu(self.bn(self.conv(x)), inplace=True)
+        x = self.conv(x)
+        if self.bn is not None:
+            x = self.bn(x)
+        return F.relu(x, inplace=True)
 
 
 
@@ -236,17 +328,48 @@ class FeatureNet(nn.Module):
         self.out_channels.append(base_channels*2)
         self.out_channels.append(base_channels)
 
-    def forward(self, x, epipole=None, temperature=0.001):
-        conv00, nc00 = self.conv00(x, epipole, temperature)
-        conv01, nc01 = self.conv01(conv00, epipole, temperature)
+        # activation checkpointing of the encoder levels and the full resolution head during training
+        self.checkpoint = False
+
+    def trunk(self, x):
+        """
+        the part of the features of an image that does not depend on the epipole, i.e. on the pair the image is
+        in: the responses of the first dynamic conv. It can be computed once per image and passed to forward.
+        """
+        return self.conv00.conv.responses(x)
+
+    def forward(self, x, epipole=None, temperature=0.001, trunk=None):
+        run = partial(checkpoint_forward, module=self) if self.checkpoint and self.training and torch.is_grad_enabled() \
+            else run_forward
+
+        def level0(x, epipole, *trunk):
+            conv00, nc00 = self.conv00(x, epipole, temperature, responses=trunk or None)
+            conv01, nc01 = self.conv01(conv00, epipole, temperature)
+            return conv01, nc00, nc01
+
+        def level1(conv01, epipole):
+            conv10, nc10 = self.conv10(self.downsample1(conv01), epipole, temperature)
+            conv11, nc11 = self.conv11(conv10, epipole, temperature)
+            return conv11, nc10, nc11
+
+        def level2(conv11, epipole):
+            conv20, nc20 = self.conv20(self.downsample2(conv11), epipole, temperature)
+            conv21, nc21 = self.conv21(conv20, epipole, temperature)
+            return conv21, nc20, nc21
+
+        def head3(out, conv01, epipole):
+            intra_feat = torch.cat((F.interpolate(out, scale_factor=2, mode="nearest"), conv01), dim=1)
+            intra_feat = self.inner2(intra_feat)
+            out, nc02 = self.out3(intra_feat, epipole=epipole, temperature=temperature)
+            return self.act3(out), nc02
+
+        conv01, nc00, nc01 = run(level0, x, epipole, *(trunk or ()))
 
-        down_conv0, down_epipole0 = self.downsample1(conv01), epipole / 2
-        conv10, nc10 = self.conv10(down_conv0, down_epipole0, temperature)
-        conv11, nc11 = self.conv11(conv10, down_epipole0, temperature)
+        down_epipole0 = epipole / 2
+        conv11, nc10, nc11 = run(level1, conv01, down_epipole0)
 
-        down_conv1, down_epipole1 = self.downsample2(conv11), epipole / 4
-        conv20, nc20 = self.conv20(down_conv1, down_epipole1, temperature)
-        conv21, nc21 = self.conv21(conv20, down_epipole1, temperature)
+        down_epipole1 = epipole / 4
+        conv21, nc20, nc21 = run(level2, conv11, down_epipole1)
 
         
         intra_feat = conv21
@@ -263,15 +386,64 @@ class FeatureNet(nn.Module):
         nc_sum = (nc10 ** 2 + nc11 ** 2 + nc12 ** 2) / 3
         outputs["stage2"] = out, nc_sum, nc12.abs()
 
-        intra_feat = torch.cat((F.interpolate(out, scale_factor=2, mode="nearest"), conv01), dim=1)
-        intra_feat = self.inner2(intra_feat)
-        out, nc02 = self.out3(intra_feat, epipole=epipole, temperature=temperature)
-        out = self.act3(out)
+        out, nc02 = run(head3, out, conv01, epipole)
         nc_sum = (nc00 ** 2 + nc01 ** 2 + nc02 ** 2) / 3
         outputs["stage3"] = out, nc_sum, nc02.abs()
 
         return outputs
 
+
+class FeatureCache(object):
+    """
+    LRU of FeatureNet.trunk outputs for inference over a scene, keyed by view id and image size and bounded by
+    max_mb. A view is a source of about ten references of a scan and its trunk is computed once while it stays
+    cached; views of consecutive references of a scan overlap most (see ScanBatchSampler).
+    """
+
+    def __init__(self, max_mb=1024):
+        self.max_bytes = max_mb * 2 ** 20
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+
+    def trunk(self, feature, imgs, view_ids):
+        """trunk of imgs (B, 3, H, W), view_ids holds one hashable id per image"""
+        keys = [(view_id, tuple(imgs.shape[-2:])) for view_id in view_ids]
+        trunks = {}
+        for key in keys:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                trunks[key] = self.entries[key]
+        missing = [i for i, key in enumerate(keys) if key not in trunks]
+        # a view that is in the batch twice is computed once
+        missing = [i for i in missing if keys.index(keys[i]) == i]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            computed = feature.trunk(imgs[missing])
+            for j, i in enumerate(missing):
+                # a slice of a batch would keep the whole batch alive in the cache
+                trunks[keys[i]] = tuple(t[j] if len(missing) == 1 else t[j].clone() for t in computed)
+        outputs = tuple(torch.stack(ts) for ts in zip(*[trunks[key] for key in keys]))
+        for i in missing:
+            self.put(keys[i], trunks[keys[i]])
+        return outputs
+
+    def put(self, key, trunk):
+        nbytes = sum(t.numel() * t.element_size() for t in trunk)
+        if nbytes > self.max_bytes:
+            return
+        while self.nbytes + nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= sum(t.numel() * t.element_size() for t in evicted)
+        self.entries[key] = trunk
+        self.nbytes += nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
 class CostRegNet(nn.Module):
     def __init__(self, in_channels, base_channels, last_layer=True, full_res=False):
         super(CostRegNet, self).__init__()
@@ -318,16 +490,25 @@ class CostRegNet(nn.Module):
             else:
                 self.prob = nn.Conv3d(base_channels, 1, 3, stride=1, padding=1, bias=False)
 
+        # activation checkpointing of every UNet level during training, only the level outputs are kept
+        self.checkpoint = False
+        # run the volumes in the channels_last_3d layout, the 3D convolution weights are converted separately
+        self.channels_last = False
+
     def forward(self, x):
-        conv0 = self.conv0(x)
-        conv2 = self.conv2(self.conv1(conv0))
-        conv4 = self.conv4(self.conv3(conv2))
-        x = self.conv6(self.conv5(conv4))
-        x = conv4 + self.conv8(self.conv7(x))
-        x = conv2 + self.conv10(self.conv9(x))
-        x = conv0 + self.conv12(self.conv11(x))
+        run = partial(checkpoint_forward, module=self) if self.checkpoint and self.training and torch.is_grad_enabled() \
+            else run_forward
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last_3d)
+        conv0 = run(self.conv0, x)
+        conv2 = run(lambda t: self.conv2(self.conv1(t)), conv0)
+        conv4 = run(lambda t: self.conv4(self.conv3(t)), conv2)
+        x = run(lambda t: self.conv6(self.conv5(t)), conv4)
+        x = conv4 + run(lambda t: self.conv8(self.conv7(t)), x)
+        x = conv2 + run(lambda t: self.conv10(self.conv9(t)), x)
+        x = conv0 + run(lambda t: self.conv12(self.conv11(t)), x)
         if self.last_layer:
-            x = self.prob(x)
+            x = run(self.prob, x)
         return x
 
 class REM(nn.Module):
@@ -396,7 +577,10 @@ class Refinement(nn.Module):
 
         conv0 = self.conv0(img)
         #deconv = F.relu(self.deconv(self.conv2(self.conv1(depth))), inplace=True)
-        deconv = F.relu(self.bn(self.deconv(self.conv2(self.conv1(depth)))), inplace=True)
+        deconv = self.deconv(self.conv2(self.conv1(depth)))
+        if self.bn is not None:
+            deconv = self.bn(deconv)
+        deconv = F.relu(deconv, inplace=True)
         cat = torch.cat((deconv, conv0), dim=1)
         del deconv, conv0
         # depth residual
@@ -421,10 +605,11 @@ def depth_regression(p, depth_values):
 def winner_take_all(prob_volume, depth_values):
     """
     :param prob_volume: (b, d, h, w)
-    :param depth_values: (b, d, h, w)
+    :param depth_values: (b, d, h, w) or (b, d, 1, 1)
     :return: (b, h, w)
     """
     _, idx = torch.max(prob_volume, dim=1, keepdim=True)
+    depth_values = depth_values.expand(-1, -1, *prob_volume.shape[2:])
     depth = torch.gather(depth_values, 1, idx).squeeze(1)
     return depth
 
@@ -444,7 +629,7 @@ def unity_regression(prob_volume, depth_values, interval):
     # print((1 - val).size())
     # print(interval.size())
     # print("+++++++++++++++++++++++++++++++")
-    interval=interval[0]
+    interval=interval.view(-1, 1, 1, 1)
     # print(interval.size())
     offset = (1 - val) * interval
     offset=offset.squeeze(1)
@@ -454,6 +639,20 @@ def unity_regression(prob_volume, depth_values, interval):
 
     return depth
 
+def unity_head(prob_volume_pre, depth_values, interval):
+    """
+    softmax, unity regression and photometric confidence of a stage in one place, the max of the probability
+    volume is both the offset weight of the regression and the confidence
+    :param prob_volume_pre: (b, d, h, w) regularized cost volume
+    :param depth_values: (b, d, h, w) or (b, d, 1, 1)
+    :param interval: (b, )
+    :return: depth (b, h, w), photometric confidence (b, h, w), prob_volume (b, d, h, w)
+    """
+    prob_volume = F.softmax(prob_volume_pre, dim=1)
+    val = torch.amax(prob_volume, dim=1)
+    depth = torch.sum(prob_volume * depth_values, 1) + (1 - val) * interval.view(-1, 1, 1)
+    return depth, val, prob_volume
+
 def conf_regression(p, n=4):
     ndepths = p.size(1)
     with torch.no_grad():
@@ -469,12 +668,11 @@ def conf_regression(p, n=4):
 def get_cur_depth_range_samples(cur_depth, ndepth, depth_inteval_pixel, uncertainty_map,min_depth,max_depth):
     #shape, (B, H, W)
     #cur_depth: (B, H, W)
-    #return depth_range_values: (B, D, H, W)
+    #return depth_range_values: (B, D, H, W) at the resolution of cur_depth
     
     new_interval = (ndepth * depth_inteval_pixel) / (ndepth - 1)
-    depth_inteval_pixel=depth_inteval_pixel.squeeze(1).squeeze(1)
-    depth_inteval_pixel=depth_inteval_pixel[0]
-    depth_inteval_pixel=float(depth_inteval_pixel)
+    # (B, 1, 1), every sample of a batch keeps its own interval
+    depth_inteval_pixel=depth_inteval_pixel.view(-1, 1, 1)
     # print("-------------------------------------------")
     # print((ndepth / 2 * uncertainty_map * depth_inteval_pixel * 1.5).size())
     # print((2 * uncertainty_map * depth_inteval_pixel * 1.5).size())
@@ -486,8 +684,8 @@ def get_cur_depth_range_samples(cur_depth, ndepth, depth_inteval_pixel, uncertai
     cur_depth_max = (cur_depth + ndepth / 2 * depth_inteval_pixel*uncertainty_map*1.5)
     
     if min_depth.dim()==1:
-       cur_depth_min=cur_depth_min.clamp(min=min_depth[0].item())
-       cur_depth_max=cur_depth_max.clamp(max=max_depth[0].item())
+       cur_depth_min=torch.max(cur_depth_min, min_depth.view(-1, 1, 1))
+       cur_depth_max=torch.min(cur_depth_max, max_depth.view(-1, 1, 1))
 
     depth_range_samples = cur_depth_min.unsqueeze(1) + (torch.arange(0, ndepth, device=cur_depth.device,
                                                                   dtype=cur_depth.dtype,
@@ -497,20 +695,29 @@ def get_cur_depth_range_samples(cur_depth, ndepth, depth_inteval_pixel, uncertai
     return depth_range_samples,cur_depth_min,cur_depth_max,new_interval
 
 
-def get_depth_range_samples(cur_depth, ndepth, depth_inteval_pixel, device, dtype, shape,uncertainty_map,min_depth,max_depth):
+def get_depth_range_samples(cur_depth, ndepth, depth_inteval_pixel, device, dtype, shape,uncertainty_map,min_depth,max_depth,
+                            sampling="uniform"):
     #shape: (B, H, W)
     #cur_depth: (B, H, W) or (B, D)
-    #return depth_range_samples: (B, D, H, W)
+    #sampling: spacing of the per image hypotheses, "uniform" in depth or "inverse" (uniform in inverse depth)
+    #return depth_range_samples: (B, D, H, W), or (B, D, 1, 1) for per image hypotheses, broadcast over the pixels
     if cur_depth.dim() == 2:
         cur_depth_min = cur_depth[:, 0]  # (B,)
         cur_depth_max = cur_depth[:, -1]
         new_interval = (cur_depth_max - cur_depth_min) / (ndepth - 1)  # (B, )
         #new_interval = (ndepth * depth_inteval_pixel) / (ndepth - 1)
 
-        depth_range_samples = cur_depth_min.unsqueeze(1) + (torch.arange(0, ndepth, device=device, dtype=dtype,
-                                                                       requires_grad=False).reshape(1, -1) * new_interval.unsqueeze(1)) #(B, D)
+        steps = torch.arange(0, ndepth, device=device, dtype=dtype, requires_grad=False).reshape(1, -1)
+        if sampling == "inverse":
+            # dense near the camera, sparse far away, the same pixel disparity between neighbouring planes
+            inv_interval = (1.0 / cur_depth_max - 1.0 / cur_depth_min) / (ndepth - 1)
+            depth_range_samples = 1.0 / (1.0 / cur_depth_min.unsqueeze(1) + steps * inv_interval.unsqueeze(1)) #(B, D)
+            # spacing of the two nearest planes, the smallest one, so the regression offset stays below one plane
+            new_interval = depth_range_samples[:, 1] - depth_range_samples[:, 0]
+        else:
+            depth_range_samples = cur_depth_min.unsqueeze(1) + (steps * new_interval.unsqueeze(1)) #(B, D)
 
-        depth_range_samples = depth_range_samples.unsqueeze(-1).unsqueeze(-1).repeat(1, 1, shape[1], shape[2]) #(B, D, H, W)
+        depth_range_samples = depth_range_samples.unsqueeze(-1).unsqueeze(-1) #(B, D, 1, 1)
 
     else:
 
@@ -531,7 +738,7 @@ def Loss_strategy(pro_volume,depth_values,depth_min,depth_max,interval):
     temp=temp.clamp(min=0)
     depth_values_clamp=temp+depth_min
 
-    pro_volume_clamp=torch.where(depth_values!=depth_values_clamp,torch.full_like(pro_volume,0),pro_volume)
+    pro_volume_clamp=pro_volume.masked_fill(depth_values!=depth_values_clamp,0)
     pro_volume_clamp=pro_volume_clamp+eps
     pro_volume_normal=get_normal(pro_volume_clamp)
 
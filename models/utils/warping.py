@@ -70,7 +70,7 @@ def homo_warping_3D(src_fea, src_proj, ref_proj, depth_values):
     # src_fea: [B, C, H, W]
     # src_proj: [B, 4, 4]
     # ref_proj: [B, 4, 4]
-    # depth_values: [B, Ndepth] o [B, Ndepth, H, W]
+    # depth_values: [B, Ndepth], [B, Ndepth, 1, 1] or [B, Ndepth, H, W]
     # out: [B, C, Ndepth, H, W]
     batch, channels = src_fea.shape[0], src_fea.shape[1]
     num_depth = depth_values.shape[1]
@@ -88,8 +88,8 @@ def homo_warping_3D(src_fea, src_proj, ref_proj, depth_values):
         xyz = torch.stack((x, y, torch.ones_like(x)))  # [3, H*W]
         xyz = torch.unsqueeze(xyz, 0).repeat(batch, 1, 1)  # [B, 3, H*W]
         rot_xyz = torch.matmul(rot, xyz)  # [B, 3, H*W]
-        rot_depth_xyz = rot_xyz.unsqueeze(2).repeat(1, 1, num_depth, 1) * depth_values.view(batch, 1, num_depth,
-                                                                                            -1)  # [B, 3, Ndepth, H*W]
+        # per image depth values ([B, Ndepth] or [B, Ndepth, 1, 1]) are broadcast over the pixels
+        rot_depth_xyz = rot_xyz.unsqueeze(2) * depth_values.view(batch, 1, num_depth, -1)  # [B, 3, Ndepth, H*W]
         proj_xyz = rot_depth_xyz + trans.view(batch, 3, 1, 1)  # [B, 3, Ndepth, H*W]
         proj_xy = proj_xyz[:, :2, :, :] / (proj_xyz[:, 2:3, :, :] + 1e-6) # [B, 2, Ndepth, H*W]
         proj_x_normalized = proj_xy[:, 0, :, :] / ((width - 1) / 2) - 1
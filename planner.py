@@ -0,0 +1,94 @@
+"""
+Memory planner for depth inference: picks the largest image size of a scene whose peak memory fits a budget.
+
+The peak memory of CDSMVSNet is modelled as alpha * cost volume elements + beta * feature elements. The cost
+volume term is the largest stage volume, ndepths[i] * (feature channels + cr_base_chs[i]) per pixel of the
+stage; the feature term grows with the number of views. Both are proportional to the number of pixels, so two
+probe runs of the real network at a small size with two view counts calibrate alpha and beta, and the
+prediction is extrapolated to any size.
+"""
+import math
+
+import torch
+
+from utils import synthetic_scene
+
+
+def peak_memory(net, inputs):
+    """peak memory in bytes allocated while net(*inputs) runs, on top of what is allocated before"""
+    if inputs[0].is_cuda:
+        device = inputs[0].device
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        with torch.no_grad():
+            net(*inputs)
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+    # on CPU from the allocations of the ops and the frees in between, in the order they happened
+    with torch.no_grad(), torch.autograd.profiler.profile(profile_memory=True) as prof:
+        net(*inputs)
+    timeline = sorted((e.time_range.start, e.cpu_memory_usage if e.name == '[memory]' else e.self_cpu_memory_usage)
+                      for e in prof.function_events if e.name == '[memory]' or e.self_cpu_memory_usage)
+    current, peak = 0, 0
+    for _, delta in timeline:
+        current += delta
+        peak = max(peak, current)
+    return peak
+
+
+def fit_size(height, width, scale, base=64):
+    """height x width scaled by scale and rounded down to multiples of base, the aspect ratio is kept"""
+    return int(height * scale) // base * base, int(width * scale) // base * base
+
+
+class MemoryPlanner(object):
+
+    def __init__(self, model):
+        # model: CDSMVSNet, the stage sizes and channels are read from it
+        self.refine = model.refine
+        self.ndepths = list(model.ndepths)
+        self.cr_base_chs = list(model.cr_base_chs)
+        self.channels = list(model.feature.out_channels)
+        self.scales = [model.stage_infos["stage{}".format(i + 1)]["scale"] for i in range(model.num_stage)]
+        self.alpha, self.beta = None, None
+
+    def elements(self, height, width, num_view):
+        """cost volume and feature elements of one reference view"""
+        # the features and the stages run at half the image size with refinement
+        pixels = height * width / (4 if self.refine else 1)
+        stage_pixels = [pixels / s ** 2 for s in self.scales]
+        volume = max(d * p * (c + cr) for d, p, c, cr in zip(self.ndepths, stage_pixels, self.channels, self.cr_base_chs))
+        feature = num_view * sum(c * p for c, p in zip(self.channels, stage_pixels))
+        return volume, feature
+
+    def calibrate(self, net, num_view, device, height=256, width=320, num_depth=192):
+        """run net (CDSMVSNetInference) on synthetic scenes with 2 and num_view views"""
+        view_counts = [2, max(num_view, 3)]
+        peaks = [peak_memory(net, synthetic_scene(height, width, v, num_depth, device=device)) for v in view_counts]
+        (vol0, feat0), (vol1, feat1) = [self.elements(height, width, v) for v in view_counts]
+        # the volume term does not depend on the number of views
+        self.beta = max(peaks[1] - peaks[0], 0) / (feat1 - feat0)
+        self.alpha = max(peaks[0] - self.beta * feat0, 0) / vol0
+        print("memory planner: probe {}x{} peaks {:.0f}/{:.0f}MB for {}/{} views".format(
+            height, width, peaks[0] / 2 ** 20, peaks[1] / 2 ** 20, *view_counts))
+
+    def predict(self, height, width, num_view):
+        """predicted peak memory in bytes of one reference view"""
+        volume, feature = self.elements(height, width, num_view)
+        return self.alpha * volume + self.beta * feature
+
+    def plan(self, height, width, budget, max_h, max_w, num_view, base=64):
+        """
+        largest size with the aspect ratio of height x width, within max_h x max_w and multiples of base, whose
+        predicted peak memory fits budget bytes, None if not even base x base fits
+        """
+        assert self.alpha is not None, "calibrate the planner first"
+        scale = min(max_h / height, max_w / width)
+        # the prediction is proportional to the number of pixels
+        scale = min(scale, scale * math.sqrt(budget / self.predict(height * scale, width * scale, num_view)))
+        h, w = fit_size(height, width, scale, base)
+        while h >= base and w >= base and self.predict(h, w, num_view) > budget:
+            scale *= 0.95
+            h, w = fit_size(height, width, scale, base)
+        return (h, w) if h >= base and w >= base else None
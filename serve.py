@@ -0,0 +1,259 @@
+"""
+Long-running depth inference server: the model and the checkpoint are loaded once and scan/view jobs are
+sent over HTTP, so a small job does not pay for the interpreter start, the config and the checkpoint.
+
+    python serve.py --config configs/config_dtu.json --resume model.pth --testpath <DTU test set> --port 8600
+    python serve.py --request scan1 --views 0 1 2 --url http://127.0.0.1:8600 --outdir outputs
+
+A job is a JSON object POSTed to /depth: {"scan": "scan1", "views": [0, 1, 2]} plus optional "testpath",
+"num_view", "numdepth", "max_h", "max_w", "interval_scale", "dataset" overriding the server defaults; all
+reference views of the scan are run when "views" is missing. The samples are read with MVSDataset, so the scan
+folder has the layout test.py expects. One GPU worker runs the network: samples waiting in the queue with the
+same image size, view count and number of depth hypotheses, from the same or from concurrent jobs, are stacked
+into one batch of up to --max_batch.
+
+The reply is streamed per reference view as soon as its batch is done: a JSON header line
+{"scan", "view", "nbytes", ...} followed by nbytes of an .npz holding "depth" (H, W), "conf_stage1..3" at their
+native resolution and "cam" (2, 4, 4) of the reference view. The last line is {"done": true, ...}, or
+{"error": ...} if the job failed.
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+import numpy as np
+import torch
+
+from datasets.general_eval import MVSDataset
+from datasets.data_io import save_pfm, save_confidence
+from models.model import build_model
+from models.module import FeatureCache
+
+parser = argparse.ArgumentParser(description='Serve CDSMVSNet depth inference over HTTP')
+parser.add_argument('--config', default='configs/config_dtu.json', help='config with the arch args of the model')
+parser.add_argument('--resume', default=None, help='checkpoint to serve, random weights if not given')
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8600)
+parser.add_argument('--max_batch', type=int, default=4, help='max reference views per forward pass')
+parser.add_argument('--batch_wait', type=float, default=0.02,
+                    help='seconds to wait for more compatible samples before running a partial batch')
+parser.add_argument('--temperature', type=float, default=0.01, help='temperature of softmax')
+parser.add_argument('--no_refinement', action="store_true", help='depth refinement in last stage')
+parser.add_argument('--feature_cache_mb', type=int, default=0,
+                    help='keep the epipole independent features of recently used views in an LRU of this size')
+# job defaults, the same meaning as in test.py
+parser.add_argument('--testpath', default=None, help='testing data dir, jobs may give their own')
+parser.add_argument('--dataset', default='dtu', help='select dataset')
+parser.add_argument('--num_view', type=int, default=5, help='num of view')
+parser.add_argument('--numdepth', type=int, default=192, help='the number of depth values')
+parser.add_argument('--interval_scale', type=float, default=1.06, help='the depth interval scale')
+parser.add_argument('--max_h', type=int, default=1152, help='testing max h')
+parser.add_argument('--max_w', type=int, default=1536, help='testing max w')
+# client
+parser.add_argument('--request', default=None, help='send a job for this scan to a running server and exit')
+parser.add_argument('--views', type=int, nargs='+', default=None, help='reference views of the job, all if not given')
+parser.add_argument('--url', default='http://127.0.0.1:8600')
+parser.add_argument('--outdir', default='outputs', help='client: depth_est/*.pfm and confidence/*.npz per scan')
+parser.add_argument('--conf_dtype', type=str, default='float16', choices=["float32", "float16", "uint8"],
+                    help='client: dtype of the saved confidence')
+
+JOB_KEYS = ['testpath', 'dataset', 'num_view', 'numdepth', 'interval_scale', 'max_h', 'max_w']
+
+
+class DepthWorker(object):
+    """
+    Owns the network. Jobs put (sample, reply, tag) into the queue, the worker thread stacks samples with the
+    same input shapes into batches and puts (tag, result dict) per sample into its reply queue, in the order the
+    batches finish.
+    """
+
+    def __init__(self, net, device, max_batch=4, batch_wait=0.02):
+        self.net = net
+        self.device = device
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue()
+        self.pending = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def batch_key(sample):
+        # samples with different depth ranges may share a batch, every sample keeps its own depth interval and range
+        return sample["imgs"].shape, sample["depth_values"].shape
+
+    def next_batch(self):
+        if not self.pending:
+            self.pending.append(self.queue.get())
+        key = self.batch_key(self.pending[0][0])
+        batch = [item for item in self.pending if self.batch_key(item[0]) == key][:self.max_batch]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            self.pending.append(item)
+            if self.batch_key(item[0]) == key:
+                batch.append(item)
+        self.pending = [item for item in self.pending if not any(item is b for b in batch)]
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            start_time = time.time()
+            try:
+                results = self.forward([item[0] for item in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            print('batch {} Res:{} Time:{:.3f}'.format(len(batch), batch[0][0]["imgs"].shape[-2:],
+                                                      time.time() - start_time))
+            for result, (_, reply, tag) in zip(results, batch):
+                reply.put((tag, result))
+
+    def forward(self, samples):
+        stack = lambda get: torch.from_numpy(np.stack([get(s) for s in samples])).to(self.device)
+        inputs = [stack(lambda s: s["imgs"])] + \
+                 [stack(lambda s, k=k: s["proj_matrices"][k]) for k in ["stage1", "stage2", "stage3"]] + \
+                 [stack(lambda s: s["depth_values"])]
+        view_ids = [s["view_keys"] for s in samples] if self.net.feature_cache is not None else None
+        with torch.no_grad():
+            outputs = [o.cpu().numpy() for o in self.net(*inputs, view_ids=view_ids)]
+        last_stage = max(samples[0]["proj_matrices"].keys())
+        return [{"depth": outputs[0][i], "conf_stage1": outputs[1][i], "conf_stage2": outputs[2][i],
+                 "conf_stage3": outputs[3][i], "cam": s["proj_matrices"][last_stage][0]} for i, s in enumerate(samples)]
+
+
+def build_dataset(job, refine):
+    dataset = MVSDataset(job["testpath"], [job["scan"]], "test", int(job["num_view"]), int(job["numdepth"]),
+                         float(job["interval_scale"]), max_h=job["max_h"], max_w=job["max_w"], dataset=job["dataset"],
+                         refine=refine)
+    if job.get("views") is not None:
+        views = set(job["views"])
+        dataset.metas = [meta for meta in dataset.metas if meta[1] in views]
+    return dataset
+
+
+class DepthHandler(BaseHTTPRequestHandler):
+    worker = None
+    defaults = None
+    refine = True
+    # MVSDataset keeps the per-scene resolution in module globals, samples are read one at a time
+    dataset_lock = threading.Lock()
+
+    def send_line(self, obj):
+        self.wfile.write((json.dumps(obj) + '\n').encode('utf-8'))
+
+    def send_result(self, job, dataset, idx, result):
+        if isinstance(result, Exception):
+            raise result
+        buffer = io.BytesIO()
+        np.savez(buffer, **result)
+        self.send_line({"scan": job["scan"], "view": dataset.metas[idx][1], "shape": list(result["depth"].shape),
+                        "nbytes": buffer.tell()})
+        self.wfile.write(buffer.getvalue())
+        self.wfile.flush()
+
+    def do_POST(self):
+        if self.path != '/depth':
+            self.send_error(404)
+            return
+        try:
+            job = dict(self.defaults)
+            job.update(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            assert job.get("testpath") is not None, "no testpath given"
+            dataset = build_dataset(job, self.refine)
+        except Exception as e:
+            self.send_response(400)
+            self.end_headers()
+            self.send_line({"error": repr(e)})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.end_headers()
+
+        start_time = time.time()
+        reply = queue.Queue()
+        try:
+            # samples are read while earlier ones run, at most two batches of this job are held in memory
+            in_flight = 0
+            for idx in range(len(dataset)):
+                if in_flight >= 2 * self.worker.max_batch:
+                    self.send_result(job, dataset, *reply.get())
+                    in_flight -= 1
+                with self.dataset_lock:
+                    sample = dataset[idx]
+                # the same view of a scan gives the same image for every job with the same testpath and dataset
+                sample["view_keys"] = [(job["testpath"], job["dataset"], job["scan"], vid)
+                                       for vid in sample["view_ids"].tolist()]
+                self.worker.queue.put((sample, reply, idx))
+                in_flight += 1
+            for _ in range(in_flight):
+                self.send_result(job, dataset, *reply.get())
+            self.send_line({"done": True, "views": len(dataset), "time": time.time() - start_time})
+        except Exception as e:
+            self.send_line({"error": repr(e)})
+        print("{} {} views:{} time:{:.3f}".format(self.client_address[0], job["scan"], len(dataset),
+                                                  time.time() - start_time))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def request_depth(url, job):
+    """send a job to the server, yields (header, arrays) per reference view as the results arrive"""
+    data = json.dumps(job).encode('utf-8')
+    with urlopen(Request(url.rstrip('/') + '/depth', data=data, headers={'Content-Type': 'application/json'})) as f:
+        while True:
+            header = json.loads(f.readline())
+            if "error" in header:
+                raise Exception(header["error"])
+            if header.get("done"):
+                return
+            with np.load(io.BytesIO(f.read(header["nbytes"]))) as arrays:
+                yield header, {k: arrays[k] for k in arrays.files}
+
+
+def serve(args):
+    device = torch.device(args.device)
+    net = build_model(args.config, args.resume, args.no_refinement, args.temperature).to(device)
+    if args.feature_cache_mb > 0:
+        net.feature_cache = FeatureCache(args.feature_cache_mb)
+    DepthHandler.worker = DepthWorker(net, device, args.max_batch, args.batch_wait)
+    DepthHandler.defaults = {k: getattr(args, k) for k in JOB_KEYS}
+    DepthHandler.refine = not args.no_refinement
+    server = ThreadingHTTPServer((args.host, args.port), DepthHandler)
+    print('serving on http://{}:{}'.format(args.host, args.port))
+    server.serve_forever()
+
+
+def client(args):
+    job = {"scan": args.request}
+    if args.views is not None:
+        job["views"] = args.views
+    if args.testpath is not None:
+        job["testpath"] = args.testpath
+    scan_folder = os.path.join(args.outdir, args.request)
+    os.makedirs(os.path.join(scan_folder, 'depth_est'), exist_ok=True)
+    os.makedirs(os.path.join(scan_folder, 'confidence'), exist_ok=True)
+    for header, arrays in request_depth(args.url, job):
+        save_pfm(os.path.join(scan_folder, 'depth_est/{:0>8}.pfm'.format(header["view"])), arrays["depth"])
+        save_confidence(os.path.join(scan_folder, 'confidence/{:0>8}.npz'.format(header["view"])),
+                        [arrays["conf_stage{}".format(i)] for i in range(1, 4)], args.conf_dtype)
+        print('{} view {} {}'.format(header["scan"], header["view"], header["shape"]))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.request is not None:
+        client(args)
+    else:
+        serve(args)
@@ -1,6 +1,5 @@
 import argparse, os, time, sys, gc, cv2
 
-import numpy
 from PIL import Image
 import torch
 import torch.nn.parallel
@@ -11,10 +10,13 @@ from torch.utils.data import Dataset, DataLoader, SequentialSampler
 from parse_config import ConfigParser
 import datasets.data_loaders as module_data
 import models.model as module_arch
-from datasets.data_io import read_pfm, save_pfm
+from models.module import FeatureCache
+from planner import MemoryPlanner, peak_memory
+from datasets.data_io import read_pfm, read_pfms, save_pfm, DepthContainer, DepthContainerWriter, DEPTH_CONTAINER_NAME, \
+    save_confidence, read_confidence
 from plyfile import PlyData, PlyElement
 from gipuma import gipuma_filter
-from utils import tocuda, print_args, tensor2numpy
+from utils import tocuda, print_args, tensor2numpy, synthetic_scene
 import fusion
 import pathlib
 #temp = pathlib.PosixPath
@@ -32,7 +34,8 @@ parser.add_argument('--testpath', help='testing data dir for some scenes',defaul
 parser.add_argument('--testpath_single_scene', help='testing data path for single scene')
 parser.add_argument('--testlist', help='testing scene list',default="lists/dtu/test1.txt")
 
-parser.add_argument('--batch_size', type=int, default=1, help='testing batch size')
+parser.add_argument('--batch_size', type=int, default=1,
+                    help='reference views of a scan per forward pass, 0 to fit the free GPU memory')
 parser.add_argument('--numdepth', type=int, default=192, help='the number of depth values')
 
 parser.add_argument('--resume', default="saved_UR/2/models/CDS-MVSNet/0325_195114/checkpoint-epoch23.pth", help='load a specific checkpoint')
@@ -53,14 +56,33 @@ parser.add_argument('--num_view', type=int, default=5, help='num of view')
 parser.add_argument('--max_h', type=int, default=1152, help='testing max h')
 parser.add_argument('--max_w', type=int, default=1536, help='testing max w')
 parser.add_argument('--fix_res', action='store_true', help='scene all using same res')
+parser.add_argument('--auto_res', action='store_true',
+                    help='per scene, the largest size within max_h x max_w keeping the aspect ratio that fits the memory budget')
+parser.add_argument('--mem_budget_mb', type=float, default=0,
+                    help='memory budget of --auto_res per forward pass, 0 for 90%% of the free GPU memory')
 parser.add_argument('--depth_scale', type=float, default=1.0, help='depth scale')
 parser.add_argument('--temperature', type=float, default=0.01, help='temperature of softmax')
+parser.add_argument('--compile', action='store_true', help='run the network through torch.compile (torch >= 2.0)')
+parser.add_argument('--fold_bn', action='store_true', help='fold the BatchNorms into the convolutions')
+parser.add_argument('--channels_last', action='store_true',
+                    help='run the cost regularization in the channels_last_3d layout')
+parser.add_argument('--feature_cache_mb', type=int, default=0,
+                    help='keep the epipole independent features of the views of a scan in an LRU of this size')
 
 parser.add_argument('--num_worker', type=int, default=4, help='depth_filer worker')
 parser.add_argument('--save_freq', type=int, default=20, help='save freq of local pcd')
+parser.add_argument('--save_format', type=str, default='pfm', choices=["pfm", "container"],
+                    help='save per-view pfm/txt/jpg files or a single container file per scan')
+parser.add_argument('--container_dtype', type=str, default='float32', choices=["float32", "float16"],
+                    help='depth dtype in the container')
+parser.add_argument('--container_img_scale', type=float, default=1.0,
+                    help='scale of the reference image stored in the container, 0 to skip it')
+parser.add_argument('--conf_dtype', type=str, default=None, choices=["float32", "float16", "uint8"],
+                    help='float32 saves full resolution pfm confidence, float16/uint8 save each stage at native resolution; '
+                         'float32 by default, uint8 with --save_format container')
 
 
-parser.add_argument('--filter_method', type=str, default='gipuma', choices=["gipuma", "normal"], help="filter method")
+parser.add_argument('--filter_method', type=str, default='gipuma', choices=["gipuma", "normal", "native"], help="filter method")
 
 # filter
 parser.add_argument('--conf', type=str, default='0.0,0.0,0.0', help='prob confidence')
@@ -77,6 +99,9 @@ parser.add_argument('--num_consistent', type=float, default='2')
 
 # parse arguments and check
 args = parser.parse_args()
+if args.conf_dtype is None:
+    # the container stores quantised confidence unless asked otherwise
+    args.conf_dtype = 'uint8' if args.save_format == 'container' else 'float32'
 print("argv:", sys.argv[1:])
 print_args(args)
 if args.testpath_single_scene:
@@ -154,26 +179,87 @@ def write_cam(file, cam):
     f.close()
 
 
+def free_gpu_memory(device):
+    if hasattr(torch.cuda, 'mem_get_info'):
+        return torch.cuda.mem_get_info(device)[0]
+    return torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_reserved(device)
+
+
+# largest batch of reference views that fits in the free GPU memory, from the peak memory of a single view
+def auto_batch_size(net, device, reserved=0):
+    if device.type != 'cuda':
+        return 1
+    # every view is resized to max_h x max_w, the memory does not depend on the image content
+    inputs = synthetic_scene(args.max_h, args.max_w, args.num_view, args.numdepth, device=device)
+    torch.cuda.empty_cache()
+    peak = peak_memory(net, inputs)
+    del inputs
+    torch.cuda.empty_cache()
+    free = free_gpu_memory(device)
+    batch_size = max(1, int((0.9 * free - reserved) // peak))
+    print("peak memory per view: {:.0f}MB, free: {:.0f}MB, batch size: {}".format(peak / 2 ** 20, free / 2 ** 20,
+                                                                               batch_size))
+    return batch_size
+
+
+# image size of every scene from the memory planner, calibrated by probe runs of the network
+def plan_scene_sizes(net, device, dataset, testlist, batch_size, reserved=0):
+    if args.mem_budget_mb > 0:
+        budget = args.mem_budget_mb * 2 ** 20
+    else:
+        assert device.type == 'cuda', "--auto_res on CPU needs --mem_budget_mb"
+        budget = 0.9 * free_gpu_memory(device)
+    budget = (budget - reserved) / batch_size
+    planner = MemoryPlanner(net.model)
+    planner.calibrate(net, args.num_view, device)
+    scene_sizes = {}
+    for scan in testlist:
+        h, w = dataset.image_size(scan)
+        size = planner.plan(h, w, budget, args.max_h, args.max_w, args.num_view)
+        assert size is not None, "{}: no image size fits in {:.0f}MB".format(scan, budget / 2 ** 20)
+        scene_sizes[scan] = size
+        print("{}: {}x{} -> {}x{}, predicted peak memory {:.0f}MB".format(
+            scan, h, w, size[0], size[1], planner.predict(size[0], size[1], args.num_view) / 2 ** 20))
+    return scene_sizes
+
+
 # run model to save depth maps and confidence maps
-def save_depth(testlist, config):
-    # dataset, dataloader
+class ScanContainers(object):
+    """
+    One DepthContainerWriter open at a time. The batches of a scan are contiguous, so the container of a scan is
+    closed, and its index written, as soon as the next scan starts, and on the way out of a with block on errors too.
+    """
+
+    def __init__(self, outdir, **kwargs):
+        self.outdir = outdir
+        self.kwargs = kwargs
+        self.scan, self.writer = None, None
+        self.done = set()
+
+    def get(self, scan):
+        if scan != self.scan:
+            self.close()
+            # reopening would truncate the container of the scan
+            assert scan not in self.done, "views of scan {} are not contiguous".format(scan)
+            os.makedirs(os.path.join(self.outdir, scan), exist_ok=True)
+            self.writer = DepthContainerWriter(os.path.join(self.outdir, scan, DEPTH_CONTAINER_NAME), **self.kwargs)
+            self.scan = scan
+        return self.writer
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.done.add(self.scan)
+        self.scan, self.writer = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
-    init_kwags = {
-        "data_path": args.testpath,
-        "data_list": testlist,
-        "mode": "test",
-        "num_srcs": args.num_view,
-        "num_depths": args.numdepth,
-        "interval_scale": Interval_Scale,
-        "shuffle": False,
-        "batch_size": 1,
-        "fix_res": args.fix_res,
-        "max_h": args.max_h,
-        "max_w": args.max_w,
-        "dataset_eval": args.dataset,
-        "refine": not args.no_refinement
-    }
-    test_data_loader = module_data.DTULoader(**init_kwags)
+
+def save_depth(testlist, config):
     # model
     # build models architecture
     if args.no_refinement:
@@ -195,10 +281,51 @@ def save_depth(testlist, config):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model = model.to(device)
     model.eval()
+    # tensors in, tensors out: only the refined depth and the per-stage confidences are computed and copied back
+    net = module_arch.CDSMVSNetInference(model.module if isinstance(model, torch.nn.DataParallel) else model,
+                                         temperature=args.temperature, fold_bn=args.fold_bn,
+                                         channels_last=args.channels_last)
+    # --auto_res picks the size for a given batch, --batch_size 0 the batch for a given size
+    assert not (args.auto_res and args.batch_size == 0), "--auto_res needs a fixed --batch_size"
+    batch_size = args.batch_size if args.batch_size > 0 else \
+        auto_batch_size(net, device, reserved=args.feature_cache_mb * 2 ** 20)
+    feature_cache = None
+    if args.feature_cache_mb > 0:
+        # the view ids change every call, a compiled graph would be recompiled for each of them
+        assert not args.compile, "--feature_cache_mb does not work with --compile"
+        feature_cache = net.feature_cache = FeatureCache(args.feature_cache_mb)
+    # dataset, dataloader
+    # the views of a scan share the resolution, a batch only holds views of one scan
+    init_kwags = {
+        "data_path": args.testpath,
+        "data_list": testlist,
+        "mode": "test",
+        "num_srcs": args.num_view,
+        "num_depths": args.numdepth,
+        "interval_scale": Interval_Scale,
+        "shuffle": False,
+        "batch_size": batch_size,
+        "fix_res": args.fix_res,
+        "max_h": args.max_h,
+        "max_w": args.max_w,
+        "dataset_eval": args.dataset,
+        "refine": not args.no_refinement,
+        # references reusing recently encoded views only pay off with the feature cache
+        "reorder": args.feature_cache_mb > 0
+    }
+    test_data_loader = module_data.DTULoader(**init_kwags)
+    if args.auto_res:
+        test_data_loader.mvs_dataset.scene_sizes = plan_scene_sizes(net, device, test_data_loader.mvs_dataset, testlist,
+                                                                    batch_size, reserved=args.feature_cache_mb * 2 ** 20)
+    if args.compile:
+        # every view of a scan has the same shape, the graph is captured once per batch size and scene size
+        net = torch.compile(net, dynamic=False)
 
     times = []
+    containers = ScanContainers(args.outdir, depth_dtype=args.container_dtype, img_scale=args.container_img_scale,
+                                conf_dtype=args.conf_dtype)
 
-    with torch.no_grad():
+    with torch.no_grad(), containers:
         for batch_idx, sample in enumerate(test_data_loader):
             torch.cuda.synchronize()
             start_time = time.time()
@@ -206,52 +333,40 @@ def save_depth(testlist, config):
             num_stage = 3 if args.no_refinement else 4
             depth_values_test=sample_cuda["depth_values"]
             imgs, cam_params = sample_cuda["imgs"], sample_cuda["proj_matrices"]
-            outputs,refine_depth_ma = model(imgs, cam_params, sample_cuda["depth_values"], temperature=args.temperature)
+            view_ids = None
+            if feature_cache is not None:
+                view_ids = [[(filename.split('/')[0], vid) for vid in vids]
+                            for filename, vids in zip(sample["filename"], sample["view_ids"].tolist())]
+            outputs = net(imgs, cam_params["stage1"], cam_params["stage2"], cam_params["stage3"], depth_values_test,
+                          view_ids=view_ids)
             torch.cuda.synchronize()
             # outputs["ps_map"] = model.feature.extract_ps_map()
 
             end_time = time.time()
-            times.append(end_time - start_time)
-            for key, value in outputs.items():
-                if key=="uncertaintyMap":
-                    uncertaintyMap = numpy.ndarray(None)
-                    uncertaintyMap1 = torch.from_numpy(uncertaintyMap)
-                    outputs["uncertaintyMap"] = uncertaintyMap1
-                    break
-                else:
-                    continue
-            for key, value in outputs.items():
-                if key == "stage3":
-                    for key, value in outputs["stage3"].items():
-                        if key=="uncertaintyMap":
-                            uncertaintyMap = numpy.ndarray(None)
-                            uncertaintyMap1=torch.from_numpy(uncertaintyMap)
-                            outputs["stage3"]["uncertaintyMap"]=uncertaintyMap1
-                            break
-                        else:
-                            continue
-                else:
-                    continue
-
-            # if(outputs["stage3"]["uncertaintyMap"]==None):
-            #     uncertaintyMap = numpy.ndarray(None)
-            #     uncertaintyMap1=torch.from_numpy(uncertaintyMap)
-            #     outputs["stage3"]["uncertaintyMap"]=uncertaintyMap1
-            outputs = tensor2numpy(outputs)
+            times.append((end_time - start_time) / len(sample["filename"]))
+            refined_depth, confs_stage1, confs_stage2, confs_stage3 = tensor2numpy(outputs)
             del sample_cuda
             filenames = sample["filename"]
             cams = sample["proj_matrices"]["stage{}".format(num_stage)].numpy()
             imgs = sample["imgs"].numpy()
-            print('Iter {}/{}, Time:{} Res:{}'.format(batch_idx, len(test_data_loader), end_time - start_time,
-                                                      outputs["refined_depth"][0].shape))
+            print('Iter {}/{}, Time:{} Res:{} Views:{}'.format(batch_idx, len(test_data_loader), end_time - start_time,
+                                                               refined_depth[0].shape, len(filenames)))
 
             # save depth maps and confidence maps
-            for filename, cam, img, depth_est, conf_stage1, conf_stage2, conf_stage3 in zip(filenames, cams, imgs, outputs["refined_depth"], outputs["stage1"]["photometric_confidence"], outputs["stage2"]["photometric_confidence"],
-                                                                             outputs["photometric_confidence"]): #, outputs["ps_map"]):
+            for filename, cam, img, depth_est, conf_stage1, conf_stage2, conf_stage3 in zip(filenames, cams, imgs, refined_depth, confs_stage1, confs_stage2,
+                                                                             confs_stage3): #, outputs["ps_map"]):
                 img = img[0]  # ref view
                 cam = cam[0]  # ref cam
+                if args.save_format == "container":
+                    h, w = depth_est.shape[0], depth_est.shape[1]
+                    img = cv2.resize(np.transpose(img, (1, 2, 0)), (w, h), interpolation=cv2.INTER_NEAREST)
+                    view_id = int(os.path.basename(filename.format('', '')))
+                    scan = filename.split('/')[0]
+                    containers.get(scan).add_view(view_id, depth_est, [conf_stage1, conf_stage2, conf_stage3], cam, img)
+                    continue
                 depth_filename = os.path.join(args.outdir, filename.format('depth_est', '.pfm'))
-                confidence_filename = os.path.join(args.outdir, filename.format('confidence', '.pfm'))
+                confidence_filename = os.path.join(args.outdir, filename.format(
+                    'confidence', '.pfm' if args.conf_dtype == 'float32' else '.npz'))
                 cam_filename = os.path.join(args.outdir, filename.format('cams', '_cam.txt'))
                 img_filename = os.path.join(args.outdir, filename.format('images', '.jpg'))
                 #ps_filename = os.path.join(args.outdir, filename.format('ps_maps', '.png'))
@@ -264,11 +379,15 @@ def save_depth(testlist, config):
                 save_pfm(depth_filename, depth_est)
                 # save confidence maps
                 h, w = depth_est.shape[0], depth_est.shape[1]
-                conf_stage1 = cv2.resize(conf_stage1, (w, h), interpolation=cv2.INTER_NEAREST)
-                conf_stage2 = cv2.resize(conf_stage2, (w, h), interpolation=cv2.INTER_NEAREST)
-                conf_stage3 = cv2.resize(conf_stage3, (w, h), interpolation=cv2.INTER_NEAREST)
-                photometric_confidence = np.stack([conf_stage1, conf_stage2, conf_stage3]).transpose([1,2,0])
-                save_pfm(confidence_filename, photometric_confidence)
+                if args.conf_dtype == 'float32':
+                    conf_stage1 = cv2.resize(conf_stage1, (w, h), interpolation=cv2.INTER_NEAREST)
+                    conf_stage2 = cv2.resize(conf_stage2, (w, h), interpolation=cv2.INTER_NEAREST)
+                    conf_stage3 = cv2.resize(conf_stage3, (w, h), interpolation=cv2.INTER_NEAREST)
+                    photometric_confidence = np.stack([conf_stage1, conf_stage2, conf_stage3]).transpose([1,2,0])
+                    save_pfm(confidence_filename, photometric_confidence)
+                else:
+                    # stage-native resolution, upsampled lazily by the filters
+                    save_confidence(confidence_filename, [conf_stage1, conf_stage2, conf_stage3], args.conf_dtype)
                 # save cams, img
                 img = np.transpose(img, (1, 2, 0))
                 img = cv2.resize(img, (w, h), interpolation=cv2.INTER_NEAREST)
@@ -291,59 +410,77 @@ def save_depth(testlist, config):
                 # plt.imshow(photometric_confidence)
                 # plt.show()
 
-    print("average time: ", sum(times) / len(times))
+    print("average time per view: ", sum(times) / len(times))
+    if feature_cache is not None:
+        print("feature cache hits: {}, misses: {}".format(feature_cache.hits, feature_cache.misses))
     torch.cuda.empty_cache()
     gc.collect()
 
 
 class TTDataset(Dataset):
-    def __init__(self, pair_folder, scan_folder, n_src_views=10):
+    def __init__(self, pair_folder, scan_folder, n_src_views=10, container=None):
         super(TTDataset, self).__init__()
         pair_file = os.path.join(pair_folder, "pair.txt")
         self.scan_folder = scan_folder
         self.pair_data = read_pair_file(pair_file)
         self.n_src_views = n_src_views
+        # read every view from a single container file instead of per-view pfm/txt/jpg files
+        self.container = DepthContainer(container) if container is not None else None
 
     def __len__(self):
         return len(self.pair_data)
 
+    def read_cam(self, vid):
+        cam = np.zeros((2, 4, 4), dtype=np.float32)
+        if self.container is not None:
+            container_cam = self.container.read_cam(vid)
+            cam[0] = container_cam[0]
+            cam[1, :3, :3] = container_cam[1, :3, :3]
+        else:
+            intrinsics, extrinsics = read_camera_parameters(
+                os.path.join(self.scan_folder, 'cams/{:0>8}_cam.txt'.format(vid)))
+            cam[0] = extrinsics
+            cam[1, :3, :3] = intrinsics
+        cam[1, 3, 3] = 1.0
+        return cam
+
+    def read_conf(self, vid):
+        # (3, H, W) full resolution confidence, or a list of per-stage (1, h_i, w_i) maps at native resolution
+        if self.container is not None:
+            return [c[np.newaxis] for c in self.container.read_conf(vid)]
+        conf_filename = os.path.join(self.scan_folder, 'confidence/{:0>8}.npz'.format(vid))
+        if os.path.isfile(conf_filename):
+            return [c[np.newaxis] for c in read_confidence(conf_filename)]
+        conf_filename = os.path.join(self.scan_folder, 'confidence/{:0>8}.pfm'.format(vid))
+        return read_pfm(conf_filename, mmap=True, contiguous=True)[0].transpose([2, 0, 1])
+
     def __getitem__(self, idx):
         id_ref, id_srcs = self.pair_data[idx]
         id_srcs = id_srcs[:self.n_src_views]
 
-        ref_intrinsics, ref_extrinsics = read_camera_parameters(
-            os.path.join(self.scan_folder, 'cams/{:0>8}_cam.txt'.format(id_ref)))
-        ref_cam = np.zeros((2, 4, 4), dtype=np.float32)
-        ref_cam[0] = ref_extrinsics
-        ref_cam[1, :3, :3] = ref_intrinsics
-        ref_cam[1, 3, 3] = 1.0
-        # load the reference image
-        ref_img = read_img(os.path.join(self.scan_folder, 'images/{:0>8}.jpg'.format(id_ref)))
-        ref_img = ref_img.transpose([2, 0, 1])
-        # load the estimated depth of the reference view
-        ref_depth_est = read_pfm(os.path.join(self.scan_folder, 'depth_est/{:0>8}.pfm'.format(id_ref)))[0]
-        ref_depth_est = np.array(ref_depth_est, dtype=np.float32)
-        # load the photometric mask of the reference view
-        confidence = read_pfm(os.path.join(self.scan_folder, 'confidence/{:0>8}.pfm'.format(id_ref)))[0]
-        confidence = np.array(confidence, dtype=np.float32).transpose([2, 0, 1])
-
-        src_depths, src_confs, src_cams = [], [], []
-        for ids in id_srcs:
-            src_intrinsics, src_extrinsics = read_camera_parameters(
-                os.path.join(self.scan_folder, 'cams/{:0>8}_cam.txt'.format(ids)))
-            src_proj = np.zeros((2, 4, 4), dtype=np.float32)
-            src_proj[0] = src_extrinsics
-            src_proj[1, :3, :3] = src_intrinsics
-            src_proj[1, 3, 3] = 1.0
-            src_cams.append(src_proj)
-            # the estimated depth of the source view
-            src_depth_est = read_pfm(os.path.join(self.scan_folder, 'depth_est/{:0>8}.pfm'.format(ids)))[0]
-            src_depths.append(np.array(src_depth_est, dtype=np.float32))
-            src_conf = read_pfm(os.path.join(self.scan_folder, 'confidence/{:0>8}.pfm'.format(ids)))[0]
-            src_confs.append(np.array(src_conf, dtype=np.float32).transpose([2, 0, 1]))
-        src_depths = np.expand_dims(np.stack(src_depths, axis=0), axis=1)
-        src_confs = np.stack(src_confs, axis=0)
-        src_cams = np.stack(src_cams, axis=0)
+        ref_cam = self.read_cam(id_ref)
+        src_cams = np.stack([self.read_cam(ids) for ids in id_srcs], axis=0)
+        # load the photometric confidence of the reference and source views
+        confidence = self.read_conf(id_ref)
+        src_confs = [self.read_conf(ids) for ids in id_srcs]
+        if isinstance(confidence, list):
+            src_confs = [np.stack([c[i] for c in src_confs], axis=0) for i in range(len(confidence))]  # [v1hw]
+        else:
+            src_confs = np.stack(src_confs, axis=0)  # v3hw
+        if self.container is not None:
+            ref_depth_est = self.container.read_depth(id_ref)
+            ref_img = self.container.read_img(id_ref, shape=ref_depth_est.shape).transpose([2, 0, 1])
+            src_depths = np.stack([self.container.read_depth(ids) for ids in id_srcs], axis=0)
+        else:
+            # load the reference image
+            ref_img = read_img(os.path.join(self.scan_folder, 'images/{:0>8}.jpg'.format(id_ref)))
+            ref_img = ref_img.transpose([2, 0, 1])
+            # load the estimated depth of the reference view
+            ref_depth_est = read_pfm(os.path.join(self.scan_folder, 'depth_est/{:0>8}.pfm'.format(id_ref)),
+                                     mmap=True, contiguous=True)[0]
+            # the estimated depths of the source views
+            src_depths = read_pfms([os.path.join(self.scan_folder, 'depth_est/{:0>8}.pfm'.format(ids)) for ids in id_srcs])
+        src_depths = np.expand_dims(src_depths, axis=1)
         return {"ref_depth": np.expand_dims(ref_depth_est, axis=0),
                 "ref_cam": ref_cam,
                 "ref_conf": confidence, #np.expand_dims(confidence, axis=0),
@@ -355,7 +492,9 @@ class TTDataset(Dataset):
 
 
 def filter_depth(pair_folder, scan_folder, out_folder, plyfilename):
-    tt_dataset = TTDataset(pair_folder, scan_folder, n_src_views=10)
+    container = os.path.join(scan_folder, DEPTH_CONTAINER_NAME)
+    tt_dataset = TTDataset(pair_folder, scan_folder, n_src_views=10,
+                           container=container if os.path.isfile(container) else None)
     sampler = SequentialSampler(tt_dataset)
     tt_dataloader = DataLoader(tt_dataset, batch_size=1, shuffle=False, sampler=sampler, num_workers=2,
                                pin_memory=True, drop_last=False)
@@ -364,11 +503,16 @@ def filter_depth(pair_folder, scan_folder, out_folder, plyfilename):
     prob_threshold = [float(p) for p in prob_threshold.split(',')]
     for batch_idx, sample_np in enumerate(tt_dataloader):
         sample = tocuda(sample_np)
+        depth_shape = sample["ref_depth"].shape[-2:]
         for ids in range(sample["src_depths"].size(1)):
-            src_prob_mask = fusion.prob_filter(sample['src_confs'][:, ids, ...], prob_threshold)
+            if isinstance(sample['src_confs'], list):
+                src_conf = [c[:, ids, ...] for c in sample['src_confs']]
+            else:
+                src_conf = sample['src_confs'][:, ids, ...]
+            src_prob_mask = fusion.prob_filter(src_conf, prob_threshold, shape=depth_shape)
             sample["src_depths"][:, ids, ...] *= src_prob_mask.float()
 
-        prob_mask = fusion.prob_filter(sample['ref_conf'], prob_threshold)
+        prob_mask = fusion.prob_filter(sample['ref_conf'], prob_threshold, shape=depth_shape)
 
         reproj_xyd, in_range = fusion.get_reproj(
             *[sample[attr] for attr in ['ref_depth', 'src_depths', 'ref_cam', 'src_cams']])
@@ -402,7 +546,10 @@ def filter_depth(pair_folder, scan_folder, out_folder, plyfilename):
 
     print('Write combined PCD')
     p_all, c_all = [np.concatenate([v[k] for key, v in views.items()], axis=0) for k in range(2)]
+    write_ply(plyfilename, p_all, c_all)
 
+
+def write_ply(plyfilename, p_all, c_all):
     vertexs = np.array([tuple(v) for v in p_all], dtype=[('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
     vertex_colors = np.array([tuple(v) for v in c_all], dtype=[('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
 
@@ -417,6 +564,80 @@ def filter_depth(pair_folder, scan_folder, out_folder, plyfilename):
     print("saving the final model to", plyfilename)
 
 
+# fuse the depth maps of a scan in-process with fusibile's consistency check, no gipuma conversion needed
+def fuse_depth_native(scan_folder, plyfilename, prob_threshold, disp_threshold, num_consistent):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # load every view of the scan once, all views are kept in memory during fusion
+    container = os.path.join(scan_folder, DEPTH_CONTAINER_NAME)
+    if os.path.isfile(container):
+        container = DepthContainer(container)
+        view_ids = container.view_ids
+        depths = np.stack([container.read_depth(vid) for vid in view_ids])
+        confs = [container.read_conf(vid) for vid in view_ids]
+    else:
+        container = None
+        view_ids = sorted(int(os.path.splitext(f)[0]) for f in os.listdir(os.path.join(scan_folder, 'images')))
+        depths = read_pfms([os.path.join(scan_folder, 'depth_est/{:0>8}.pfm'.format(vid)) for vid in view_ids])
+        if os.path.isfile(os.path.join(scan_folder, 'confidence/{:0>8}.npz'.format(view_ids[0]))):
+            confs = [read_confidence(os.path.join(scan_folder, 'confidence/{:0>8}.npz'.format(vid))) for vid in view_ids]
+        else:
+            confs = read_pfms([os.path.join(scan_folder, 'confidence/{:0>8}.pfm'.format(vid)) for vid in view_ids])
+    depths = torch.from_numpy(depths).to(device).unsqueeze(1)  # v1hw
+    if isinstance(confs, list):
+        # per-stage confidence at native resolution, [v1hw]
+        confs = [torch.from_numpy(np.stack([c[i] for c in confs])).to(device).unsqueeze(1) for i in range(len(confs[0]))]
+    else:
+        confs = torch.from_numpy(confs).to(device).permute(0, 3, 1, 2)  # v3hw
+    depths = depths * fusion.prob_filter(confs, prob_threshold, shape=depths.shape[-2:]).float()
+    del confs
+    cams, imgs = [], []
+    for vid in view_ids:
+        cam = np.zeros((2, 4, 4), dtype=np.float32)
+        if container is not None:
+            container_cam = container.read_cam(vid)
+            cam[0] = container_cam[0]
+            cam[1, :3, :3] = container_cam[1, :3, :3]
+            imgs.append(container.read_img(vid, shape=depths.shape[-2:]))
+        else:
+            intrinsics, extrinsics = read_camera_parameters(os.path.join(scan_folder, 'cams/{:0>8}_cam.txt'.format(vid)))
+            cam[0] = extrinsics
+            cam[1, :3, :3] = intrinsics
+            imgs.append(read_img(os.path.join(scan_folder, 'images/{:0>8}.jpg'.format(vid))))
+        cam[1, 3, 3] = 1.0
+        cams.append(cam)
+    cams = torch.from_numpy(np.stack(cams)).to(device)  # v244
+
+    views = {}
+    for ref_idx, vid in enumerate(view_ids):
+        src_idx = [i for i in range(len(view_ids)) if i != ref_idx]
+        ref_depth, ref_cam = depths[[ref_idx]], cams[[ref_idx]]
+        ref_depth_ave, mask = fusion.consistency_fusion(ref_depth, depths[src_idx].unsqueeze(0), ref_cam,
+                                                        cams[src_idx].unsqueeze(0), disp_threshold, num_consistent)
+
+        idx_img = fusion.get_pixel_grids(*ref_depth_ave.size()[-2:], device=device).unsqueeze(0)
+        idx_cam = fusion.idx_img2cam(idx_img, ref_depth_ave, ref_cam)
+        points = fusion.idx_cam2world(idx_cam, ref_cam)[..., :3, 0].permute(0, 3, 1, 2)
+
+        points_np = points[0].cpu().numpy()
+        mask_np = mask[0, 0].cpu().numpy().astype(bool)
+        p_f = np.stack([points_np[k][mask_np] for k in range(3)], -1)
+        c_f = imgs[ref_idx][mask_np] * 255
+        views[vid] = (p_f, c_f.astype(np.uint8))
+        print("processing {}, ref-view{:0>2}, final-mask:{}".format(scan_folder, vid, mask.float().mean().item()))
+
+    print('Write combined PCD')
+    p_all, c_all = [np.concatenate([v[k] for key, v in views.items()], axis=0) for k in range(2)]
+    write_ply(plyfilename, p_all, c_all)
+
+
+def native_filter(testlist, prob_threshold, disp_threshold, num_consistent):
+    for scan in testlist:
+        scan_folder = os.path.join(args.outdir, scan)
+        fuse_depth_native(scan_folder, os.path.join(args.outdir, '{}.ply'.format(scan)), prob_threshold,
+                          disp_threshold, num_consistent)
+
+
 def pcd_filter_worker(scan):
     save_name = '{}.ply'.format(scan)
     pair_folder = os.path.join(args.testpath, scan)
@@ -447,11 +668,15 @@ if __name__ == '__main__':
 
     # step2. filter saved depth maps with photometric confidence maps and geometric constraints
 
-    if args.filter_method != "gipuma":
+    if args.filter_method == "normal":
          #support multi-processing, the default number of worker is 4
         pcd_filter(testlist)
+    elif args.filter_method == "native":
+        prob_threshold = args.prob_threshold
+        prob_threshold = [float(p) for p in prob_threshold.split(',')]
+        native_filter(testlist, prob_threshold, args.disp_threshold, args.num_consistent)
     else:
         prob_threshold = args.prob_threshold
         prob_threshold = [float(p) for p in prob_threshold.split(',')]
         gipuma_filter(testlist, args.outdir, prob_threshold, args.disp_threshold, args.num_consistent,
-                      args.fusibile_exe_path)
+                      args.fusibile_exe_path, args.num_worker)
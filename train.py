@@ -2,6 +2,8 @@ import argparse, collections
 import torch
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+from datetime import datetime
 from tensorboardX import SummaryWriter
 
 import datasets.data_loaders as module_data
@@ -9,6 +11,7 @@ import models.model as module_arch
 import models.losses as module_loss
 from trainer import Trainer
 from parse_config import ConfigParser
+from utils import init_distributed, is_main_process
 
 
 SEED = 123
@@ -17,7 +20,9 @@ cudnn.benchmark = False
 cudnn.deterministic = True
 
 import os
-os.environ["CUDA_VISIBLE_DEVICES"] = "1"
+if int(os.environ.get("WORLD_SIZE", 1)) < 2:
+    # torchrun assigns one device per process itself
+    os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 def main(config):
     logger = config.get_logger('train')
 
@@ -46,7 +51,8 @@ def main(config):
 
     # build models architecture, then print to console
     model = config.init_obj('arch', module_arch)
-    logger.info(model)
+    if is_main_process():
+        logger.info(model)
 
     # get function handles of loss and metrics
     criterion = getattr(module_loss, config['loss'])
@@ -57,7 +63,7 @@ def main(config):
     optimizer = mvsnet_optimizer
     lr_scheduler = config.init_obj('lr_scheduler', torch.optim.lr_scheduler, optimizer)
 
-    writer = SummaryWriter(config.log_dir)
+    writer = SummaryWriter(config.log_dir) if is_main_process() else None
 
     trainer = Trainer(model, criterion, optimizer, config=config, data_loader=train_data_loaders,
                       valid_data_loader=valid_data_loaders, lr_scheduler=lr_scheduler, writer=writer)
@@ -80,5 +86,16 @@ if __name__ == '__main__':
         CustomArgs(['--lr', '--learning_rate'], type=float, target='optimizer;args;lr'),
         CustomArgs(['--bs', '--batch_size'], type=int, target='data_loader;args;batch_size')
     ]
-    config = ConfigParser.from_args(args, options)
+
+    # distributed data parallel when launched with torchrun, e.g.
+    # torchrun --nproc_per_node=2 train.py --config configs/config_dtu.json
+    run_id = None
+    if init_distributed() is not None:
+        # all processes save into the run directory named by the first one
+        run_id = [datetime.now().strftime(r'%m%d_%H%M%S')]
+        dist.broadcast_object_list(run_id, src=0)
+        run_id = run_id[0]
+    config = ConfigParser.from_args(args, options, run_id=run_id)
     main(config)
+    if dist.is_initialized():
+        dist.destroy_process_group()
@@ -3,11 +3,13 @@ import os
 import torch
 import torch.nn.functional as F
 import time
+from contextlib import nullcontext
 from PIL import Image
 import matplotlib.pyplot as plt
 
 from base import BaseTrainer
-from utils import AbsDepthError_metrics, Thres_metrics, tocuda, DictAverageMeter, inf_loop, tensor2float, tensor2numpy, save_images
+from utils import AbsDepthError_metrics, Thres_metrics, todevice, DictAverageMeter, inf_loop, tensor2float, tensor2numpy, save_images, \
+    is_main_process, reduce_scalar_outputs
 
 
 class Trainer(BaseTrainer):
@@ -31,6 +33,8 @@ class Trainer(BaseTrainer):
         self.do_validation = self.valid_data_loader is not None
         self.lr_scheduler = lr_scheduler
         self.log_step = config['trainer']['logging_every'] # int(np.sqrt(data_loader.batch_size))
+        # number of batches whose gradients are summed before an optimizer step
+        self.accumulation_steps = config['trainer'].get('accumulation_steps', 1)
         self.depth_scale = config["trainer"]["depth_scale"]
         self.train_metrics = DictAverageMeter()
         self.valid_metrics = DictAverageMeter()
@@ -47,21 +51,35 @@ class Trainer(BaseTrainer):
             temperature = np.power(10.0, -p)
         else:
             temperature = 0.01
-        print('Epoch {} temperature {}'.format(epoch, temperature))
+        if is_main_process():
+            print('Epoch {} temperature {}'.format(epoch, temperature))
 
         # self.data_loader.dataset.generate_indices()
         outputs = None
         # training
         for dl in self.data_loader:
+            if dl.sampler is not None and hasattr(dl.sampler, 'set_epoch'):
+                # reshuffle the shards of the distributed sampler every epoch
+                dl.sampler.set_epoch(epoch)
             dataset_name = dl.mvs_dataset.datapath
             dlossw = self.config["trainer"]["dlossw"]
             if 'blended' in dataset_name:
                 dlossw = [w * 1.0 for w in dlossw]
+            num_steps = (len(dl) + self.accumulation_steps - 1) // self.accumulation_steps
+            # losses are summed on the device and only read back every logging_every steps
+            metric_sums, metric_count = {}, 0
             for batch_idx, sample in enumerate(dl): #self.data_loader):
-                start_time = time.time()
+                # the batches of one optimizer step; the last group of an epoch may be shorter
+                step_idx, micro_idx = divmod(batch_idx, self.accumulation_steps)
+                group_size = min(self.accumulation_steps, len(dl) - step_idx * self.accumulation_steps)
+                last_micro = micro_idx == group_size - 1
+                if micro_idx == 0:
+                    start_time = time.time()
+                    self.optimizer.zero_grad()
+                    group_loss, group_depth_loss = 0.0, 0.0
 
                 # modified from the original by Khang
-                sample_cuda = tocuda(sample)
+                sample_cuda = todevice(sample, self.device)
                 # is_begin = sample_cuda['is_begin'].type(torch.uint8)
                 depth_gt_ms = sample_cuda["depth"]
                 mask_ms = sample_cuda["mask"]
@@ -71,33 +89,57 @@ class Trainer(BaseTrainer):
 
                 imgs, cam_params = sample_cuda["imgs"], sample_cuda["proj_matrices"]
 
-                self.optimizer.zero_grad()
-
                 depth_values = sample_cuda["depth_values"]
                 depth_interval = depth_values[:, 1] - depth_values[:, 0]
-                outputs,refine_depth_map = self.model(imgs, cam_params, depth_values, gt_depths=depth_gt_ms, temperature=temperature)
-
-                loss, depth_loss = self.criterion(outputs,refine_depth_map, depth_gt_ms, mask_ms, dlossw=dlossw, depth_interval=depth_interval)
-                loss.backward()
+                # DDP only has to all-reduce the gradients on the last batch of a group
+                sync = nullcontext() if last_micro or not self.distributed else self.model.no_sync()
+                with sync:
+                    outputs,refine_depth_map = self.model(imgs, cam_params, depth_values, gt_depths=depth_gt_ms, temperature=temperature)
+
+                    loss, depth_loss = self.criterion(outputs,refine_depth_map, depth_gt_ms, mask_ms, dlossw=dlossw, depth_interval=depth_interval)
+                    # the summed gradients of a group equal those of the mean loss over its batches
+                    (loss / group_size).backward()
+                for k, v in {"loss": loss, "depth_loss": depth_loss}.items():
+                    metric_sums[k] = metric_sums.get(k, 0.0) + v.detach()
+                metric_count += imgs.size(0)
+                group_loss = group_loss + loss.detach() / group_size
+                group_depth_loss = group_depth_loss + depth_loss.detach() / group_size
+                if not last_micro:
+                    continue
                 self.optimizer.step()
                 # self.lr_scheduler.step()
 
-                if batch_idx % self.log_step == 0:
+                if step_idx % self.log_step == 0:
+                    metric_sums, metric_count = self._flush_train_metrics(metric_sums, metric_count)
+                if step_idx % self.log_step == 0 and is_main_process():
                     # save_scalars(self.writer, 'train', scalar_outputs, global_step)
                     # save_images(self.writer, 'train', image_outputs, global_step)
                     print(
                         "Epoch {}/{}, Iter {}/{}, lr {:.6f}, train loss = {:.3f}, depth loss = {:.3f}, time = {:.3f}".format(
-                            epoch, self.epochs, batch_idx, len(dl),
-                            self.optimizer.param_groups[0]["lr"], loss, depth_loss, time.time() - start_time))
+                            epoch, self.epochs, step_idx, num_steps,
+                            self.optimizer.param_groups[0]["lr"], group_loss, group_depth_loss, time.time() - start_time))
                 # del scalar_outputs, image_outputs
-                self.train_metrics.update({"loss": loss.item(), "depth_loss": depth_loss.item()}, n=imgs.size(0))
+            self._flush_train_metrics(metric_sums, metric_count)
         self.lr_scheduler.step()
 
         if (epoch % self.config["trainer"]["eval_freq"] == 0) or (epoch == self.epochs - 1):
             del outputs
             self._valid_epoch(epoch, 0.01)
 
-        return self.train_metrics.mean()
+        return self._reduce_metrics(self.train_metrics.mean())
+
+    def _flush_train_metrics(self, metric_sums, metric_count):
+        """move the losses summed on the device into train_metrics, the only sync of the training loop"""
+        if metric_count > 0:
+            self.train_metrics.update(tensor2float(metric_sums), n=metric_count)
+        return {}, 0
+
+    def _reduce_metrics(self, metrics):
+        """average a dict of float metrics over the processes of a distributed run"""
+        if not self.distributed:
+            return metrics
+        metrics = {k: torch.tensor(v, device=self.device) for k, v in metrics.items()}
+        return tensor2float(reduce_scalar_outputs(metrics))
 
     def _valid_epoch(self, epoch, temperature, save_folder='saved/samples'):
         """
@@ -109,6 +151,7 @@ class Trainer(BaseTrainer):
         #                                                                             self.valid_data_loader.batch_size))
 
         self.model.eval()
+        avg_test_scalars = {}
         with torch.no_grad():
             for dl in self.valid_data_loader:
                 dataset_name = dl.mvs_dataset.datapath
@@ -120,7 +163,7 @@ class Trainer(BaseTrainer):
                     start_time = time.time()
 
                     # modified from the original by Khang
-                    sample_cuda = tocuda(sample)
+                    sample_cuda = todevice(sample, self.device)
                     # is_begin = sample['is_begin'].type(torch.uint8)
                     depth_gt_ms = sample_cuda["depth"]
                     mask_ms = sample_cuda["mask"]
@@ -164,7 +207,7 @@ class Trainer(BaseTrainer):
                                       }
 
                         #self.valid_metrics.update(tensor2float(scalar_outputs))
-                    if batch_idx % self.log_step == 0:
+                    if batch_idx % self.log_step == 0 and is_main_process():
                         # save_scalars(logger, 'test', scalar_outputs, global_step)
                         # save_images(logger, 'test', image_outputs, global_step)
                         print("Epoch {}/{}, Iter {}/{}, test loss = {:.3f}, depth loss = {:.3f}, time = {:3f}".format(
@@ -173,9 +216,11 @@ class Trainer(BaseTrainer):
                             time.time() - start_time))
                     self.valid_metrics.update(tensor2float(scalar_outputs))
                     del scalar_outputs  # , image_outputs
-                print(dataset_name, "avg_test_scalars:", self.valid_metrics.mean())
+                avg_test_scalars = self._reduce_metrics(self.valid_metrics.mean())
+                if is_main_process():
+                    print(dataset_name, "avg_test_scalars:", avg_test_scalars)
 
         # save_scalars(logger, 'fulltest', avg_test_scalars.mean(), global_step)
         # print("avg_test_scalars:", self.valid_metrics.mean())
 
-        return self.valid_metrics.mean()
+        return avg_test_scalars
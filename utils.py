@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import torchvision.utils as vutils
 import torch, random
@@ -71,6 +72,19 @@ def tocuda(vars):
         raise NotImplementedError("invalid input type {} for tensor2numpy".format(type(vars)))
 
 
+def todevice(vars, device):
+    @make_recursive_func
+    def wrapper(vars):
+        if isinstance(vars, torch.Tensor):
+            return vars.to(device, non_blocking=True)
+        elif isinstance(vars, str):
+            return vars
+        else:
+            raise NotImplementedError("invalid input type {} for todevice".format(type(vars)))
+
+    return wrapper(vars)
+
+
 def save_scalars(logger, mode, scalar_dict, global_step):
     scalar_dict = tensor2float(scalar_dict)
     for key, value in scalar_dict.items():
@@ -188,6 +202,35 @@ def get_world_size():
         return 1
     return dist.get_world_size()
 
+def get_rank():
+    if not dist.is_available():
+        return 0
+    if not dist.is_initialized():
+        return 0
+    return dist.get_rank()
+
+def is_main_process():
+    return get_rank() == 0
+
+def init_distributed():
+    """
+    Initialize the default process group from the environment set by torchrun
+    (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT). Uses nccl when
+    CUDA is available and gloo otherwise.
+    :return: local rank, or None when not launched with more than one process
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) < 2:
+        return None
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        backend = "nccl"
+    else:
+        backend = "gloo"
+    dist.init_process_group(backend=backend, init_method="env://")
+    synchronize()
+    return local_rank
+
 def reduce_scalar_outputs(scalar_outputs):
     world_size = get_world_size()
     if world_size < 2:
@@ -199,11 +242,10 @@ def reduce_scalar_outputs(scalar_outputs):
             names.append(k)
             scalars.append(scalar_outputs[k])
         scalars = torch.stack(scalars, dim=0)
-        dist.reduce(scalars, dst=0)
-        if dist.get_rank() == 0:
-            # only main process gets accumulated, so only divide by
-            # world_size in this case
-            scalars /= world_size
+        # every process gets the mean, so decisions made on the metrics
+        # (early stopping, best checkpoint) agree across processes
+        dist.all_reduce(scalars)
+        scalars /= world_size
         reduced_scalars = {k: v for k, v in zip(names, scalars)}
 
     return reduced_scalars
@@ -267,6 +309,36 @@ def set_random_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
+def synthetic_scene(height, width, num_view=5, num_depth=192, batch_size=1, device='cpu'):
+    """
+    random images of a DTU-like camera rig for benchmarks and export checks
+    :return: imgs (B, V, 3, H, W), projection matrices (B, V, 2, 4, 4) of stage1, stage2, stage3 and
+             depth hypotheses (B, D), in the order of CDSMVSNetInference
+    """
+    imgs = torch.rand(batch_size, num_view, 3, height, width)
+    intrinsic = torch.tensor([[2892.3 * width / 1600, 0, width / 2], [0, 2883.2 * height / 1200, height / 2], [0, 0, 2]])
+    projs = []
+    for v in range(num_view):
+        angle = 0.05 * v
+        extrinsic = torch.eye(4)
+        extrinsic[:3, :3] = torch.tensor([[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], [-np.sin(angle), 0, np.cos(angle)]])
+        extrinsic[:3, 3] = torch.tensor([-20.0 * v, 3.0 * v, 5.0 * v])
+        proj = torch.zeros(2, 4, 4)
+        proj[0] = extrinsic
+        # stage3 runs at half the image size when the depth is refined
+        proj[1, :3, :3] = intrinsic / 2
+        projs.append(proj)
+    projs = torch.stack(projs).unsqueeze(0).repeat(batch_size, 1, 1, 1, 1)
+    proj_stages = []
+    for scale in [0.25, 0.5, 1.0]:
+        proj = projs.clone()
+        proj[:, :, 1, :2, :] *= scale
+        proj_stages.append(proj.to(device))
+    depth_values = 425.0 + 2.5 * 192 / num_depth * torch.arange(num_depth, dtype=torch.float32)
+    depth_values = depth_values.unsqueeze(0).repeat(batch_size, 1)
+    return [imgs.to(device)] + proj_stages + [depth_values.to(device)]
+
+
 def local_pcd(depth, intr):
     nx = depth.shape[1]  # w
     ny = depth.shape[0]  # h